@@ -0,0 +1,4 @@
+"""Benchmarks of the sync endpoints, run against a local Postgres database.
+
+See `benchmarks/sync.py` to run them, and `benchmarks/compare.py` to compare
+the results of two runs."""
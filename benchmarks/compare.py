@@ -0,0 +1,88 @@
+"""Compares the results of two runs of the benchmarks, such as the ones of
+two commits.
+
+    PYTHONPATH=. python -m benchmarks.compare base.json new.json
+
+Exits with a non-zero status when any of the benchmarks of `new.json` is
+slower than in `base.json` by more than `--threshold`."""
+
+from __future__ import annotations
+
+import argparse
+import json
+import sys
+from typing import Any
+
+
+def compare(
+    base: dict[str, Any], new: dict[str, Any], threshold: float = 0.1
+) -> tuple[list[dict[str, Any]], bool]:
+    """Returns the change of each benchmark found in both results, and whether
+    any got slower by more than `threshold` (e.g. 0.1 for 10%)"""
+    changes = []
+    regressed = False
+
+    for name, result in new['results'].items():
+        if name not in base['results']:
+            continue
+
+        before = base['results'][name]
+        change = dict(
+            name=name,
+            seconds=(before['seconds'], result['seconds']),
+            ratio=result['seconds'] / before['seconds']
+            if before['seconds'] > 0
+            else None,
+            peak_memory_bytes=(
+                before.get('peak_memory_bytes'),
+                result.get('peak_memory_bytes'),
+            ),
+        )
+        change['regressed'] = (
+            change['ratio'] is not None and change['ratio'] > 1 + threshold
+        )
+        regressed = regressed or change['regressed']
+        changes.append(change)
+
+    return changes, regressed
+
+
+def _format_bytes(n: int | None) -> str:
+    if n is None:
+        return '-'
+
+    return '{:.1f}MB'.format(n / 1024 / 1024)
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('base')
+    parser.add_argument('new')
+    parser.add_argument('--threshold', type=float, default=0.1)
+    args = parser.parse_args(argv)
+
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+
+    if base.get('patients') != new.get('patients'):
+        print('warning: the results are for datasets of different sizes')
+
+    changes, regressed = compare(base, new, args.threshold)
+    for c in changes:
+        print(
+            '{:<18} {:>9.3f}s -> {:>9.3f}s ({:>+7.1%})  memory {} -> {}{}'.format(
+                c['name'],
+                *c['seconds'],
+                (c['ratio'] or 1) - 1,
+                *(_format_bytes(m) for m in c['peak_memory_bytes']),
+                '  REGRESSED' if c['regressed'] else '',
+            )
+        )
+
+    sys.exit(1 if regressed else 0)
+
+
+if __name__ == '__main__':
+    main()
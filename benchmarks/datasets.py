@@ -0,0 +1,341 @@
+"""Generates synthetic clinic datasets to benchmark the sync against.
+
+The rows are generated by Postgres itself, so that the largest datasets don't
+have to go through Python. Every generated row can be traced back to the
+benchmark clinic, which is how they are removed afterwards."""
+
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+import uuid
+
+import bcrypt
+from psycopg import Connection
+
+SCALES = {
+    '10k': 10_000,
+    '100k': 100_000,
+    '1m': 1_000_000,
+}
+"""Number of patients of each of the dataset scales"""
+
+ATTRIBUTES_PER_PATIENT = 3
+VISITS_PER_PATIENT = 2
+EVENTS_PER_VISIT = 2
+APPOINTMENT_EVERY = 2
+"""One in every `APPOINTMENT_EVERY` patients has an appointment"""
+PRESCRIPTION_EVERY = 3
+"""One in every `PRESCRIPTION_EVERY` patients has a prescription"""
+
+BENCHMARK_EMAIL_DOMAIN = 'benchmark.hikmahealth.invalid'
+
+
+@dataclass
+class Dataset:
+    clinic_id: str
+    user_id: str
+    email: str
+    password: str
+    patients: int
+    rows: dict[str, int] = field(default_factory=dict)
+
+    @property
+    def total_rows(self) -> int:
+        return sum(self.rows.values())
+
+
+def _count_rows(cur, dataset: Dataset):
+    for table in ('visits', 'appointments'):
+        cur.execute(
+            'SELECT count(*) FROM {} WHERE clinic_id = %s'.format(table),
+            [dataset.clinic_id],
+        )
+        dataset.rows[table] = cur.fetchone()[0]
+
+    cur.execute(
+        'SELECT count(*) FROM prescriptions WHERE pickup_clinic_id = %s',
+        [dataset.clinic_id],
+    )
+    dataset.rows['prescriptions'] = cur.fetchone()[0]
+
+    for table in ('patients', 'patient_additional_attributes', 'events'):
+        key = 'id' if table == 'patients' else 'patient_id'
+        cur.execute(
+            """
+            SELECT count(*) FROM {table}
+            WHERE {key} IN (SELECT patient_id FROM visits WHERE clinic_id = %s)
+            """.format(table=table, key=key),
+            [dataset.clinic_id],
+        )
+        dataset.rows[table] = cur.fetchone()[0]
+
+
+def generate(conn: Connection, patients: int) -> Dataset:
+    """Creates a clinic, along with a user to sync with, and `patients` patients
+    seen there over the past year, with their attributes, visits, events (with
+    form data), appointments and prescriptions"""
+    suffix = uuid.uuid4().hex[:8]
+    dataset = Dataset(
+        clinic_id=str(uuid.uuid4()),
+        user_id=str(uuid.uuid4()),
+        email=f'sync-{suffix}@{BENCHMARK_EMAIL_DOMAIN}',
+        password=uuid.uuid4().hex,
+        patients=patients,
+    )
+    params = dict(
+        clinic_id=dataset.clinic_id,
+        user_id=dataset.user_id,
+        patients=patients,
+        attributes=ATTRIBUTES_PER_PATIENT,
+        visits=VISITS_PER_PATIENT,
+        events=EVENTS_PER_VISIT,
+        appointment_every=APPOINTMENT_EVERY,
+        prescription_every=PRESCRIPTION_EVERY,
+    )
+
+    with conn.cursor() as cur:
+        cur.execute(
+            "INSERT INTO clinics (id, name) VALUES (%s, 'Benchmark clinic')",
+            [dataset.clinic_id],
+        )
+        cur.execute(
+            """
+            INSERT INTO users (id, clinic_id, name, role, email, hashed_password)
+            VALUES (%s, %s, 'Benchmark', 'provider', %s, %s)
+            """,
+            [
+                dataset.user_id,
+                dataset.clinic_id,
+                dataset.email,
+                bcrypt.hashpw(dataset.password.encode(), bcrypt.gensalt()).decode(),
+            ],
+        )
+
+        # spread over the past year, so that incremental
+        # pulls only see part of the dataset
+        cur.execute(
+            """
+            CREATE TEMPORARY TABLE bench_patients ON COMMIT DROP AS
+            SELECT
+                gen_random_uuid() AS id,
+                n,
+                now() - random() * interval '365 days' AS created_at
+            FROM generate_series(1, %(patients)s) n
+            """,
+            params,
+        )
+        cur.execute(
+            """
+            INSERT INTO patients
+            (id, given_name, surname, date_of_birth, citizenship, hometown, sex,
+             phone, camp, additional_data, government_id, external_patient_id,
+             created_at, updated_at, last_modified, server_created_at)
+            SELECT
+                id,
+                'Given ' || n,
+                'Surname ' || (n %% 5000),
+                date '1950-01-01' + (n %% 25000),
+                'Citizenship',
+                'Hometown ' || (n %% 200),
+                CASE WHEN n %% 2 = 0 THEN 'female' ELSE 'male' END,
+                '+1555' || lpad((n %% 10000000)::text, 7, '0'),
+                'Camp ' || (n %% 20),
+                jsonb_build_object('n', n),
+                'GOV-' || n,
+                'EXT-' || n,
+                created_at, created_at, created_at, created_at
+            FROM bench_patients
+            """,
+            params,
+        )
+        cur.execute(
+            """
+            INSERT INTO patient_additional_attributes
+            (id, patient_id, attribute_id, attribute, string_value, number_value,
+             metadata, is_deleted, created_at, updated_at, last_modified,
+             server_created_at)
+            SELECT
+                gen_random_uuid(),
+                p.id,
+                'attribute-' || a,
+                'Attribute ' || a,
+                'value ' || p.n,
+                p.n * a,
+                '{}',
+                false,
+                p.created_at, p.created_at, p.created_at, p.created_at
+            FROM bench_patients p, generate_series(1, %(attributes)s) a
+            """,
+            params,
+        )
+        cur.execute(
+            """
+            CREATE TEMPORARY TABLE bench_visits ON COMMIT DROP AS
+            SELECT
+                gen_random_uuid() AS id,
+                p.id AS patient_id,
+                p.n,
+                v,
+                p.created_at + (now() - p.created_at) * v / (%(visits)s + 1)
+                    AS created_at
+            FROM bench_patients p, generate_series(1, %(visits)s) v
+            """,
+            params,
+        )
+        cur.execute(
+            """
+            INSERT INTO visits
+            (id, patient_id, clinic_id, provider_id, provider_name,
+             check_in_timestamp, created_at, updated_at, last_modified,
+             server_created_at)
+            SELECT
+                id, patient_id, %(clinic_id)s, %(user_id)s, 'Benchmark',
+                created_at, created_at, created_at, created_at, created_at
+            FROM bench_visits
+            """,
+            params,
+        )
+        cur.execute(
+            """
+            INSERT INTO events
+            (id, patient_id, visit_id, event_type, form_data, created_at,
+             updated_at, last_modified, server_created_at)
+            SELECT
+                gen_random_uuid(),
+                v.patient_id,
+                v.id,
+                'Vitals',
+                jsonb_build_array(
+                    jsonb_build_object(
+                        'fieldId', 'weight', 'name', 'Weight',
+                        'inputType', 'number', 'value', 40 + v.n %% 60
+                    ),
+                    jsonb_build_object(
+                        'fieldId', 'notes', 'name', 'Notes',
+                        'inputType', 'text', 'value', 'Seen for visit ' || v.v
+                    ),
+                    jsonb_build_object(
+                        'fieldId', 'diagnosis', 'name', 'Diagnosis',
+                        'inputType', 'select', 'value', 'Diagnosis ' || e
+                    )
+                ),
+                v.created_at, v.created_at, v.created_at, v.created_at
+            FROM bench_visits v, generate_series(1, %(events)s) e
+            """,
+            params,
+        )
+        cur.execute(
+            """
+            INSERT INTO appointments
+            (id, provider_id, clinic_id, patient_id, user_id, current_visit_id,
+             timestamp, duration, reason, notes, status, is_deleted,
+             created_at, updated_at, last_modified, server_created_at)
+            SELECT
+                gen_random_uuid(), %(user_id)s, %(clinic_id)s, patient_id,
+                %(user_id)s, id, created_at + interval '30 days', 30,
+                'Follow up', '', 'pending', false,
+                created_at, created_at, created_at, created_at
+            FROM bench_visits
+            WHERE v = 1 AND n %% %(appointment_every)s = 0
+            """,
+            params,
+        )
+        cur.execute(
+            """
+            INSERT INTO prescriptions
+            (id, patient_id, provider_id, pickup_clinic_id, visit_id,
+             prescribed_at, items, created_at, updated_at, last_modified,
+             server_created_at)
+            SELECT
+                gen_random_uuid(), patient_id, %(user_id)s, %(clinic_id)s, id,
+                created_at, '[{"name": "Paracetamol", "dose": 500}]',
+                created_at, created_at, created_at, created_at
+            FROM bench_visits
+            WHERE v = 1 AND n %% %(prescription_every)s = 0
+            """,
+            params,
+        )
+
+        _count_rows(cur, dataset)
+
+    conn.commit()
+
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            ANALYZE patients, patient_additional_attributes, visits, events,
+                appointments, prescriptions
+            """
+        )
+    conn.commit()
+
+    return dataset
+
+
+def touch(conn: Connection, dataset: Dataset, fraction: float) -> int:
+    """Marks `fraction` of the patients, along with their visits and events, as
+    updated now. Returns the number of updated rows"""
+    updated = 0
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            CREATE TEMPORARY TABLE bench_touched ON COMMIT DROP AS
+            SELECT DISTINCT patient_id AS id FROM visits
+            WHERE clinic_id = %s AND random() < %s
+            """,
+            [dataset.clinic_id, fraction],
+        )
+        for table, key in (
+            ('patients', 'id'),
+            ('visits', 'patient_id'),
+            ('events', 'patient_id'),
+        ):
+            cur.execute(
+                """
+                UPDATE {table}
+                SET updated_at = now(), last_modified = now()
+                WHERE {key} IN (SELECT id FROM bench_touched)
+                """.format(table=table, key=key)
+            )
+            updated += cur.rowcount
+
+    conn.commit()
+    return updated
+
+
+def remove(conn: Connection, dataset: Dataset, patient_ids: list[str] | None = None):
+    """Deletes the dataset, along with the `patient_ids` pushed to it"""
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            CREATE TEMPORARY TABLE bench_removed ON COMMIT DROP AS
+            SELECT patient_id AS id FROM visits WHERE clinic_id = %s
+            UNION
+            SELECT unnest(%s::uuid[])
+            """,
+            [dataset.clinic_id, patient_ids or []],
+        )
+        cur.execute(
+            'DELETE FROM prescriptions WHERE pickup_clinic_id = %s',
+            [dataset.clinic_id],
+        )
+        cur.execute(
+            'DELETE FROM appointments WHERE clinic_id = %s', [dataset.clinic_id]
+        )
+        for table, key in (
+            ('events', 'patient_id'),
+            ('visits', 'patient_id'),
+            ('patient_additional_attributes', 'patient_id'),
+            ('patients', 'id'),
+        ):
+            cur.execute(
+                'DELETE FROM {} WHERE {} IN (SELECT id FROM bench_removed)'.format(
+                    table, key
+                )
+            )
+
+        cur.execute('DELETE FROM tokens WHERE user_id = %s', [dataset.user_id])
+        cur.execute('DELETE FROM users WHERE id = %s', [dataset.user_id])
+        cur.execute('DELETE FROM clinics WHERE id = %s', [dataset.clinic_id])
+
+    conn.commit()
@@ -0,0 +1,355 @@
+"""Benchmarks the initial pull, the incremental pull and the push of the sync,
+against a synthetic dataset generated in the configured database.
+
+    PYTHONPATH=. python -m benchmarks.sync --scale 10k
+
+The requests go through the Flask app, so the numbers include the encoding of
+the responses. The sync is configured with the same environment variables as
+the server (e.g. `SYNC_PULL_STREAMING=true`), and the settings used are stored
+along with the results, in `benchmarks/results/<scale>-<commit>.json` unless
+given an `--output`. Runs are compared with `benchmarks/compare.py`.
+
+🔥 Only run this against a local database. The dataset is removed afterwards,
+but the tables are written to heavily 🔥"""
+
+from __future__ import annotations
+
+import argparse
+import base64
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import time
+import tracemalloc
+from typing import Any, Callable
+import uuid
+
+from flask import Flask
+from psycopg import Connection
+
+from benchmarks import datasets
+from hikmahealth.server import config
+from hikmahealth.server.client import db
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+
+PUSH_FRACTION = 0.01
+"""Number of patients pushed at once, as a fraction of the dataset"""
+
+MIN_PUSHED_PATIENTS = 100
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(__file__),
+            text=True,
+            stderr=subprocess.DEVNULL,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def _to_unix_ms(t: datetime.datetime) -> int:
+    return int(t.timestamp() * 1000)
+
+
+def _count_pulled(body: dict) -> int:
+    return sum(
+        len(delta['created']) + len(delta['updated']) + len(delta['deleted'])
+        for delta in body['changes'].values()
+    )
+
+
+def measure(
+    run: Callable[[Any], tuple[int, int]],
+    prepare: Callable[[], Any] = lambda: None,
+    repeat: int = 3,
+    memory: bool = True,
+) -> dict[str, Any]:
+    """Times `repeat` calls to `run`, which returns the number of rows synced
+    and the size of the body sent. `prepare` is called before each run,
+    outside of the timing.
+
+    When `memory` is set, the peak memory allocated by Python is traced over
+    one more run, as tracing slows the run down."""
+    runs = []
+    rows, size = 0, 0
+    for _ in range(repeat):
+        state = prepare()
+        start = time.perf_counter()
+        rows, size = run(state)
+        runs.append(time.perf_counter() - start)
+
+    seconds = statistics.median(runs)
+    result = dict(
+        seconds=seconds,
+        runs=runs,
+        rows=rows,
+        rows_per_second=rows / seconds if seconds > 0 else None,
+        body_bytes=size,
+    )
+
+    if memory:
+        state = prepare()
+        tracemalloc.start()
+        try:
+            run(state)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        result['peak_memory_bytes'] = peak
+
+    return result
+
+
+def _patient_push_body(count: int, dataset: datasets.Dataset):
+    """Changes pushed by a device registering `count` patients, each with their
+    attributes and a visit with its events"""
+    now = _to_unix_ms(datetime.datetime.now(tz=datetime.UTC))
+    patients, attributes, visits, events = [], [], [], []
+
+    for n in range(count):
+        patient_id = str(uuid.uuid4())
+        patients.append(
+            dict(
+                id=patient_id,
+                given_name=f'Pushed {n}',
+                surname='Benchmark',
+                date_of_birth='1990-01-01',
+                sex='female' if n % 2 == 0 else 'male',
+                camp='Camp',
+                citizenship='Citizenship',
+                hometown='Hometown',
+                phone='+15550000000',
+                government_id=f'GOV-P{n}',
+                external_patient_id=f'EXT-P{n}',
+                additional_data=dict(n=n),
+                created_at=now,
+                updated_at=now,
+            )
+        )
+        for a in range(datasets.ATTRIBUTES_PER_PATIENT):
+            attributes.append(
+                dict(
+                    id=str(uuid.uuid4()),
+                    patient_id=patient_id,
+                    attribute_id=f'attribute-{a}',
+                    attribute=f'Attribute {a}',
+                    string_value=f'value {n}',
+                    number_value=n * a,
+                    date_value=None,
+                    boolean_value=None,
+                    metadata={},
+                    created_at=now,
+                    updated_at=now,
+                )
+            )
+
+        visit_id = str(uuid.uuid4())
+        visits.append(
+            dict(
+                id=visit_id,
+                patient_id=patient_id,
+                clinic_id=dataset.clinic_id,
+                provider_id=dataset.user_id,
+                provider_name='Benchmark',
+                check_in_timestamp=now,
+                metadata={},
+                created_at=now,
+                updated_at=now,
+            )
+        )
+        for e in range(datasets.EVENTS_PER_VISIT):
+            events.append(
+                dict(
+                    id=str(uuid.uuid4()),
+                    patient_id=patient_id,
+                    visit_id=visit_id,
+                    form_id=None,
+                    event_type='Vitals',
+                    form_data=[
+                        dict(fieldId='weight', name='Weight', value=40 + n % 60),
+                        dict(fieldId='notes', name='Notes', value=f'Event {e}'),
+                    ],
+                    metadata={},
+                    created_at=now,
+                    updated_at=now,
+                )
+            )
+
+    body = {
+        'patients': dict(created=patients, updated=[], deleted=[]),
+        'patient_additional_attributes': dict(
+            created=attributes, updated=[], deleted=[]
+        ),
+        'visits': dict(created=visits, updated=[], deleted=[]),
+        'events': dict(created=events, updated=[], deleted=[]),
+    }
+    rows = len(patients) + len(attributes) + len(visits) + len(events)
+
+    return body, rows, [p['id'] for p in patients]
+
+
+def run_benchmarks(
+    app: Flask,
+    conn: Connection,
+    patients: int,
+    repeat: int = 3,
+    memory: bool = True,
+    touched: float = 0.01,
+    keep: bool = False,
+) -> dict[str, Any]:
+    """Generates a dataset of `patients` patients, and benchmarks the sync
+    against it. The dataset is removed afterwards, unless `keep` is set"""
+    client = app.test_client()
+    results: dict[str, Any] = {}
+    pushed_patient_ids: list[str] = []
+
+    start = time.perf_counter()
+    dataset = datasets.generate(conn, patients)
+    generated_in = time.perf_counter() - start
+
+    credentials = base64.b64encode(
+        f'{dataset.email}:{dataset.password}'.encode()
+    ).decode()
+    headers = {'Authorization': f'Basic {credentials}'}
+
+    def pull(last_pulled_at: int):
+        def run(_state):
+            response = client.get(
+                f'/v1/api/sync?last_pulled_at={last_pulled_at}', headers=headers
+            )
+            assert response.status_code == 200, response.get_data(as_text=True)
+            data = response.get_data()
+            return _count_pulled(json.loads(data)), len(data)
+
+        return run
+
+    try:
+        results['initial_pull'] = measure(pull(0), repeat=repeat, memory=memory)
+
+        since = conn.execute('SELECT now()').fetchone()[0]
+        conn.commit()
+        touched_rows = datasets.touch(conn, dataset, touched)
+        results['incremental_pull'] = measure(
+            pull(_to_unix_ms(since)), repeat=repeat, memory=memory
+        )
+        results['incremental_pull']['touched_rows'] = touched_rows
+
+        def prepare_push():
+            body, rows, patient_ids = _patient_push_body(
+                max(MIN_PUSHED_PATIENTS, int(patients * PUSH_FRACTION)), dataset
+            )
+            pushed_patient_ids.extend(patient_ids)
+            return json.dumps(body).encode(), rows
+
+        def push(state):
+            data, rows = state
+            response = client.post(
+                '/v1/api/sync?last_pulled_at={}'.format(
+                    _to_unix_ms(datetime.datetime.now(tz=datetime.UTC))
+                ),
+                headers=headers | {'Content-Type': 'application/json'},
+                data=data,
+            )
+            assert response.status_code == 200, response.get_data(as_text=True)
+            return rows, len(data)
+
+        results['bulk_push'] = measure(
+            push, prepare=prepare_push, repeat=repeat, memory=memory
+        )
+    finally:
+        if not keep:
+            datasets.remove(conn, dataset, pushed_patient_ids)
+
+    server_version = conn.execute('SHOW server_version').fetchone()[0]
+    conn.commit()
+
+    return dict(
+        commit=_git_commit(),
+        created_at=datetime.datetime.now(tz=datetime.UTC).isoformat(),
+        patients=patients,
+        rows=dataset.rows,
+        generated_in_seconds=generated_in,
+        environment=dict(
+            python=platform.python_version(),
+            postgres=server_version,
+            settings={
+                k: v
+                for k, v in vars(config).items()
+                if k.startswith(('SYNC_', 'COMPRESSION_', 'DB_POOL_'))
+            },
+        ),
+        results=results,
+    )
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    size = parser.add_mutually_exclusive_group()
+    size.add_argument('--scale', choices=datasets.SCALES.keys(), default='10k')
+    size.add_argument('--patients', type=int, help='instead of a --scale')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument(
+        '--touched',
+        type=float,
+        default=0.01,
+        help='fraction of the patients changed before the incremental pull',
+    )
+    parser.add_argument(
+        '--no-memory', action='store_true', help="don't trace the peak memory"
+    )
+    parser.add_argument(
+        '--keep', action='store_true', help="don't remove the dataset afterwards"
+    )
+    parser.add_argument('--output', help='file the results are written to')
+    args = parser.parse_args(argv)
+
+    if config.APP_ENV == config.EnvironmentType.Prod:
+        parser.error(
+            'refusing to run against a production database. '
+            'Set APP_ENV to dev_local to run against a local one'
+        )
+
+    patients = args.patients or datasets.SCALES[args.scale]
+    label = args.scale if args.patients is None else str(args.patients)
+
+    # imported here, as the app connects to the database when loaded
+    from hikmahealth.server.server import app
+
+    with db.get_connection() as conn:
+        report = run_benchmarks(
+            app,
+            conn,
+            patients,
+            repeat=args.repeat,
+            memory=not args.no_memory,
+            touched=args.touched,
+            keep=args.keep,
+        )
+    report['scale'] = label
+
+    output = args.output or os.path.join(
+        RESULTS_DIR, '{}-{}.json'.format(label, report['commit'][:12])
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2, default=str)
+
+    for name, result in report['results'].items():
+        print(
+            '{:<18} {:>9.3f}s {:>12.0f} rows/s {:>10} rows'.format(
+                name, result['seconds'], result['rows_per_second'] or 0, result['rows']
+            )
+        )
+    print(f'results written to {output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -8,6 +8,7 @@ from psycopg.cursor import Cursor
 from hikmahealth import sync
 from hikmahealth.entity import core, fields, helpers
 from .sync import (
+    BulkUpsert,
     SyncToClient,
     SyncToServer,
 )
@@ -21,7 +22,8 @@ from datetime import date
 import itertools
 
 from hikmahealth.server.client import db
-from typing import Any
+from typing import Any, Iterator
+from contextlib import contextmanager
 
 from psycopg.rows import class_row, dict_row
 import dataclasses
@@ -48,9 +50,33 @@ import uuid
 # TODO: 👇🏽 that one
 
 
+def _escape_like(value: str) -> str:
+    """Escapes the wildcards of a `LIKE` pattern"""
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+_pg_trgm_installed: bool | None = None
+
+
+def has_trigram_search(conn: Connection) -> bool:
+    """Whether the `pg_trgm` extension is installed, which the patient search
+    uses when available. Checked once per process"""
+    global _pg_trgm_installed
+    if _pg_trgm_installed is None:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm')"
+            )
+            _pg_trgm_installed = bool(cur.fetchone()[0])
+
+    return _pg_trgm_installed
+
+
 @core.dataentity
 class Patient(SyncToClient, SyncToServer, helpers.SimpleCRUD):
     TABLE_NAME = 'patients'
+    CLINIC_SCOPE_PATIENT_COLUMN = 'id'
+    SYNC_EXCLUDED_COLUMNS = ('attributes_doc',)
 
     id: str
     given_name: str | None = None
@@ -69,6 +95,45 @@ class Patient(SyncToClient, SyncToServer, helpers.SimpleCRUD):
     created_at: fields.UTCDateTime = fields.UTCDateTime(default_factory=utc.now)
     updated_at: fields.UTCDateTime = fields.UTCDateTime(default_factory=utc.now)
 
+    BULK_UPSERT = BulkUpsert(
+        columns=(
+            'id',
+            'given_name',
+            'surname',
+            'date_of_birth',
+            'citizenship',
+            'hometown',
+            'sex',
+            'phone',
+            'camp',
+            'additional_data',
+            'image_timestamp',
+            'photo_url',
+            'government_id',
+            'external_patient_id',
+            'created_at',
+            'updated_at',
+            'last_modified',
+        ),
+        conflict=('id',),
+        update=(
+            'given_name',
+            'surname',
+            'date_of_birth',
+            'citizenship',
+            'hometown',
+            'sex',
+            'phone',
+            'camp',
+            'additional_data',
+            'government_id',
+            'external_patient_id',
+            'created_at',
+            'updated_at',
+            'last_modified',
+        ),
+    )
+
     @classmethod
     def create_from_delta(cls, ctx, cur: Cursor, data: dict):
         cur.execute(
@@ -101,71 +166,45 @@ class Patient(SyncToClient, SyncToServer, helpers.SimpleCRUD):
 
     @classmethod
     def delete_from_delta(cls, ctx, cur: Cursor, id: str):
+        return cls.delete_many_from_delta(ctx, cur, [id])
+
+    @classmethod
+    def delete_many_from_delta(cls, ctx, cur: Cursor, ids: list[str]):
+        now = utc.now()
+
         cur.execute(
             """INSERT INTO patients
                   (id, is_deleted, given_name, surname, date_of_birth, citizenship, hometown, sex, phone, camp, additional_data, image_timestamp, photo_url, government_id, external_patient_id, created_at, updated_at, last_modified, deleted_at)
-                VALUES
-                  (%s::uuid, true, '', '', NULL, '', '', '', '', '', '{}', NULL, '', NULL, NULL, %s, %s, %s, %s)
+                SELECT
+                  id, true, '', '', NULL, '', '', '', '', '', '{}', NULL, '', NULL, NULL, %(now)s, %(now)s, %(now)s, %(now)s
+                FROM unnest(%(ids)s::uuid[]) AS id
                 ON CONFLICT (id) DO UPDATE
                 SET is_deleted = true,
                     deleted_at = EXCLUDED.deleted_at,
                     updated_at = EXCLUDED.updated_at,
                     last_modified = EXCLUDED.last_modified;
             """,
-            (id, utc.now(), utc.now(), utc.now(), utc.now()),
-        )
-
-        # Soft delete patient_additional_attributes for deleted patients
-        cur.execute(
-            """
-            UPDATE patient_additional_attributes
-            SET is_deleted = true,
-                deleted_at = %s,
-                updated_at = %s,
-                last_modified = %s
-            WHERE patient_id = %s::uuid;
-            """,
-            (utc.now(), utc.now(), utc.now(), id),
-        )
-
-        # Soft delete visits for deleted patients
-        cur.execute(
-            """
-            UPDATE visits
-            SET is_deleted = true,
-                deleted_at = %s,
-                updated_at = %s,
-                last_modified = %s
-            WHERE patient_id = %s::uuid;
-            """,
-            (utc.now(), utc.now(), utc.now(), id),
-        )
-
-        # Soft delete events for deleted patients
-        cur.execute(
-            """
-            UPDATE events
-            SET is_deleted = true,
-                deleted_at = %s,
-                updated_at = %s,
-                last_modified = %s
-            WHERE patient_id = %s::uuid;
-            """,
-            (utc.now(), utc.now(), utc.now(), id),
+            dict(ids=ids, now=now),
         )
 
-        # Soft delete appointments for deleted patients
-        cur.execute(
-            """
-            UPDATE appointments
-            SET is_deleted = true,
-                deleted_at = %s,
-                updated_at = %s,
-                last_modified = %s
-            WHERE patient_id = %s::uuid;
-            """,
-            (utc.now(), utc.now(), utc.now(), id),
-        )
+        # Soft delete the records of the deleted patients
+        for table in (
+            'patient_additional_attributes',
+            'visits',
+            'events',
+            'appointments',
+        ):
+            cur.execute(
+                f"""
+                UPDATE {table}
+                SET is_deleted = true,
+                    deleted_at = %(now)s,
+                    updated_at = %(now)s,
+                    last_modified = %(now)s
+                WHERE patient_id = ANY(%(ids)s::uuid[]);
+                """,
+                dict(ids=ids, now=now),
+            )
 
     @classmethod
     def transform_delta(cls, ctx, action: str, data: Any):
@@ -352,100 +391,195 @@ class Patient(SyncToClient, SyncToServer, helpers.SimpleCRUD):
         with db.get_connection() as conn:
             with conn.cursor(row_factory=dict_row) as cur:
                 query = """
-                SELECT
-                    p.*,
-                    COALESCE(json_object_agg(
-                        pa.attribute_id,
-                        json_build_object(
-                            'attribute', pa.attribute,
-                            'number_value', pa.number_value,
-                            'string_value', pa.string_value,
-                            'date_value', pa.date_value,
-                            'boolean_value', pa.boolean_value
-                        )
-                    ) FILTER (WHERE pa.attribute_id IS NOT NULL), '{}') AS additional_attributes
+                SELECT p.*
                 FROM patients p
-                LEFT JOIN patient_additional_attributes pa ON p.id = pa.patient_id
                 WHERE p.is_deleted = false
-                GROUP BY p.id
                 ORDER BY p.updated_at DESC
                 """
+                params = []
                 if count is not None:
-                    query += f' LIMIT {count}'
-                cur.execute(query)
+                    query += ' LIMIT %s'
+                    params.append(int(count))
+                cur.execute(query, params)
                 patients = cur.fetchall()
 
                 for patient in patients:
-                    # Convert additional_attributes from JSON string to dict
-                    # patient['additional_attributes'] = json.loads(
-                    #     patient['additional_attributes'])
-
-                    # Convert datetime objects to ISO format strings
-                    for key in [
-                        'created_at',
-                        'updated_at',
-                        'last_modified',
-                        'deleted_at',
-                    ]:
-                        if patient[key]:
-                            patient[key] = patient[key].isoformat()
-
-                    # Convert date objects to ISO format strings
-                    if patient['date_of_birth']:
-                        patient['date_of_birth'] = patient['date_of_birth'].isoformat()
+                    cls._to_admin_row(patient)
 
                 return patients
 
     @classmethod
-    def search(cls, query, conn: Connection):
-        # Only supporting search by either first or surname
-        # TODO: add support for text searching some of the attributes
+    def get_page_with_attributes(
+        cls,
+        conn: Connection,
+        limit: int,
+        after: tuple[datetime, str] | None = None,
+    ) -> tuple[list[dict], tuple[datetime, str] | None]:
+        """Returns up to `limit` of the patients, most recently updated first,
+        along with their attributes.
+
+        `after` is the position `(updated_at, id)` of the last patient of the
+        previous page. Along with the patients, returns the position of the last
+        one, or `None` when there are no more patients left. Patients without an
+        `updated_at` come last."""
+        where = ['p.is_deleted = false']
+        params: dict[str, Any] = dict(limit=limit + 1)
+        if after is not None:
+            where.append(
+                "(COALESCE(p.updated_at, 'epoch'::timestamptz), p.id)"
+                ' < (%(after_at)s, %(after_id)s::uuid)'
+            )
+            params.update(after_at=after[0], after_id=after[1])
+
         with conn.cursor(row_factory=dict_row) as cur:
-            search_query = """
+            cur.execute(
+                """
                 SELECT
                     p.*,
-                    COALESCE(json_object_agg(
-                        pa.attribute_id,
-                        json_build_object(
-                            'attribute', pa.attribute,
-                            'number_value', pa.number_value,
-                            'string_value', pa.string_value,
-                            'date_value', pa.date_value,
-                            'boolean_value', pa.boolean_value
-                        )
-                    ) FILTER (WHERE pa.attribute_id IS NOT NULL), '{}') AS additional_attributes
+                    COALESCE(p.updated_at, 'epoch'::timestamptz) AS __page_at
                 FROM patients p
-                LEFT JOIN patient_additional_attributes pa ON p.id = pa.patient_id
-                WHERE p.is_deleted = false
-                AND (LOWER(p.given_name) LIKE LOWER(%s) OR LOWER(p.surname) LIKE LOWER(%s))
-                GROUP BY p.id
-                ORDER BY p.updated_at DESC
-                """
-            search_pattern = f'%{query}%'
-            cur.execute(search_query, (search_pattern, search_pattern))
+                WHERE {where}
+                ORDER BY COALESCE(p.updated_at, 'epoch'::timestamptz) DESC, p.id DESC
+                LIMIT %(limit)s
+                """.format(where=' AND '.join(where)),
+                params,
+            )
             patients = cur.fetchall()
 
-            for patient in patients:
-                # Convert datetime objects to ISO format strings
-                for key in [
-                    'created_at',
-                    'updated_at',
-                    'last_modified',
-                    'deleted_at',
-                ]:
-                    if patient[key]:
-                        patient[key] = patient[key].isoformat()
+        position = None
+        if len(patients) > limit:
+            patients = patients[:limit]
+            position = (patients[-1]['__page_at'], str(patients[-1]['id']))
+
+        for patient in patients:
+            del patient['__page_at']
+            cls._to_admin_row(patient)
+
+        return patients, position
+
+    @classmethod
+    def estimate_count(cls, conn: Connection) -> int:
+        """Returns the number of patients that are not deleted, as estimated by the
+        query planner. Unlike `COUNT(*)`, it doesn't read the table"""
+        with conn.cursor() as cur:
+            cur.execute(
+                'EXPLAIN (FORMAT JSON) SELECT 1 FROM patients WHERE is_deleted = false'
+            )
+            return int(cur.fetchone()[0][0]['Plan']['Plan Rows'])
 
-                # Convert date objects to ISO format strings
-                if patient['date_of_birth']:
-                    patient['date_of_birth'] = patient['date_of_birth'].isoformat()
+    @classmethod
+    def _to_admin_row(cls, patient: dict):
+        """Returns the `attributes_doc` of the patient row as its
+        `additional_attributes`. Dates are written in ISO 8601 by the app's JSON
+        provider"""
+        patient['additional_attributes'] = patient.pop('attributes_doc', dict())
+
+    SEARCH_COLUMNS = (
+        'given_name',
+        'surname',
+        'phone',
+        'government_id',
+        'external_patient_id',
+    )
+    """Columns matched by `search`, each with a trigram index"""
 
-            return patients
+    @classmethod
+    def search(
+        cls, query: str, conn: Connection, limit: int | None = None, offset: int = 0
+    ):
+        """Returns the patients whose names or identifiers match the `query`, most
+        similar first, along with their attributes.
+
+        With `pg_trgm` installed, the patients are matched on their trigrams, so
+        that misspelled names are found as well. Otherwise, only the patients
+        holding the query as is are returned, most recently updated first"""
+        params: dict[str, Any] = dict(
+            query=query, pattern='%{}%'.format(_escape_like(query)), offset=offset
+        )
+        matches = ['{} ILIKE %(pattern)s'.format(c) for c in cls.SEARCH_COLUMNS]
+
+        if has_trigram_search(conn):
+            matches += ['%(query)s <%% {}'.format(c) for c in cls.SEARCH_COLUMNS]
+            score = 'GREATEST({})'.format(
+                ', '.join(
+                    'word_similarity(%(query)s, {})'.format(c)
+                    for c in cls.SEARCH_COLUMNS
+                )
+            )
+        else:
+            score = "EXTRACT(EPOCH FROM COALESCE(updated_at, 'epoch'::timestamptz))"
+
+        page = ''
+        if limit is not None:
+            page = 'LIMIT %(limit)s'
+            params.update(limit=limit)
+
+        with conn.cursor(row_factory=dict_row) as cur:
+            cur.execute(
+                """
+                WITH matched AS (
+                    SELECT id, {score} AS score
+                    FROM patients
+                    WHERE is_deleted = false AND ({matches})
+                    ORDER BY score DESC, id
+                    {page} OFFSET %(offset)s
+                )
+                SELECT p.*
+                FROM matched m JOIN patients p ON p.id = m.id
+                ORDER BY m.score DESC, m.id
+                """.format(
+                    score=score,
+                    matches=' OR '.join(matches),
+                    page=page,
+                ),
+                params,
+            )
+            patients = cur.fetchall()
+
+        for patient in patients:
+            cls._to_admin_row(patient)
+
+        return patients
 
 
 @core.dataentity
 class PatientAttribute(SyncToClient, SyncToServer):
     TABLE_NAME = 'patient_additional_attributes'
+    CLINIC_SCOPE_PATIENT_COLUMN = 'patient_id'
+
+    BULK_UPSERT = BulkUpsert(
+        columns=(
+            'id',
+            'patient_id',
+            'attribute_id',
+            'attribute',
+            'number_value',
+            'string_value',
+            'date_value',
+            'boolean_value',
+            'metadata',
+            'created_at',
+            'updated_at',
+        ),
+        expressions=dict(
+            is_deleted='false',
+            last_modified='current_timestamp',
+            server_created_at='current_timestamp',
+        ),
+        conflict=('patient_id', 'attribute_id'),
+        update=(
+            'patient_id',
+            'attribute_id',
+            'attribute',
+            'number_value',
+            'string_value',
+            'date_value',
+            'boolean_value',
+            'metadata',
+            'updated_at',
+            'last_modified',
+        ),
+    )
 
     @classmethod
     def transform_delta(cls, ctx, action: str, data: Any):
@@ -497,6 +631,7 @@ class PatientAttribute(SyncToClient, SyncToServer):
 @core.dataentity
 class Event(SyncToClient, SyncToServer):
     TABLE_NAME = 'events'
+    CLINIC_SCOPE_PATIENT_COLUMN = 'patient_id'
 
     id: str
     patient_id: str | None = None
@@ -506,6 +641,33 @@ class Event(SyncToClient, SyncToServer):
     form_data: dict | None = None
     metadata: dict | None = None
 
+    BULK_UPSERT = BulkUpsert(
+        columns=(
+            'id',
+            'patient_id',
+            'form_id',
+            'visit_id',
+            'event_type',
+            'form_data',
+            'metadata',
+            'created_at',
+            'updated_at',
+        ),
+        expressions=dict(is_deleted='false', last_modified='current_timestamp'),
+        conflict=('id',),
+        update=(
+            'patient_id',
+            'form_id',
+            'visit_id',
+            'event_type',
+            'form_data',
+            'metadata',
+            'created_at',
+            'updated_at',
+            'last_modified',
+        ),
+    )
+
     @classmethod
     def transform_delta(cls, ctx, action: str, data: Any):
         if action == sync.ACTION_CREATE or action == sync.ACTION_UPDATE:
@@ -526,108 +688,77 @@ class Event(SyncToClient, SyncToServer):
             return event
 
     @classmethod
-    def create_from_delta(cls, ctx, cur: Cursor, data: dict):
-        assert data['id'] is not None, "missing 'id' from the event data"
-        # NOTE: might need to delete the patient_id
-        assert data['patient_id'] is not None
-        patient_id = data['patient_id']
-        patient_exists = False
+    def prepare_row(cls, ctx, cur: Cursor, data: dict):
+        return cls.prepare_rows(ctx, cur, [data])[0]
+
+    @classmethod
+    def prepare_rows(cls, ctx, cur: Cursor, rows: list[dict]):
+        """Makes sure the patients of the events exist, and drops references
+        to visits and forms that don't. All the events are checked at once"""
+        # first event referring to each patient
+        events_of_patient = dict()
+        for data in rows:
+            assert data['id'] is not None, "missing 'id' from the event data"
+            # NOTE: might need to delete the patient_id
+            assert data['patient_id'] is not None
+            events_of_patient.setdefault(str(data['patient_id']), data['id'])
 
         # --------------------------------------
-        # Check if patient exists
-        # Upsert then if not
+        # We are choosing to create patients dynamically here if they don't exist.
+        # We can also choose to skip events for non-existent patients.
         cur.execute(
-            'SELECT EXISTS(SELECT 1 FROM patients WHERE id = %s)',
-            (patient_id,),
-        )
-        d = cur.fetchone()
-        if d is not None:
-            patient_exists = d[0]
-
-        if not patient_exists:
-            # We are choosing to create patients dynamically here if they don't exist.
-            # We can also choose to skip events for non-existent patients.
-            placeholder_metadata = json.dumps({
-                'artificially_created': True,
-                'created_from': 'server_event_creation',
-                'original_event_id': data['id'],
-            })
-            cur.execute(
-                """
-                INSERT INTO patients (id, given_name, surname, is_deleted, deleted_at, created_at, updated_at, metadata)
-                VALUES (%s, '', '', true, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP, %s)
-                ON CONFLICT (id) DO NOTHING
+            """
+            INSERT INTO patients (id, given_name, surname, is_deleted, deleted_at, created_at, updated_at, metadata)
+            SELECT p.id, '', '', true, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP, p.metadata
+            FROM unnest(%s::uuid[], %s::jsonb[]) AS p(id, metadata)
+            ON CONFLICT (id) DO NOTHING
             """,
-                (patient_id, placeholder_metadata),
-            )
+            (
+                list(events_of_patient.keys()),
+                [
+                    json.dumps({
+                        'artificially_created': True,
+                        'created_from': 'server_event_creation',
+                        'original_event_id': event_id,
+                    })
+                    for event_id in events_of_patient.values()
+                ],
+            ),
+        )
 
-            ctx.conn.commit()
         # --------------------------------------
+        visit_ids = _get_existing_ids(
+            cur, 'visits', [d['visit_id'] for d in rows if d.get('visit_id')]
+        )
+        form_ids = _get_existing_ids(
+            cur, 'event_forms', [d['form_id'] for d in rows if d['form_id']]
+        )
 
-        vid = data.get('visit_id')
-        if vid is not None:
-            exists = False
-
-            cur.execute(
-                """
-                SELECT EXISTS(SELECT 1 FROM visits WHERE id = %s)
-                """,
-                (vid,),
-            )
-
-            d = cur.fetchone()
-            if d is not None:
-                exists = d[0]
-
-            if not exists:
+        for data in rows:
+            vid = data.get('visit_id')
+            if vid is not None and str(vid) not in visit_ids:
                 logging.warning(
                     f'Event {data["id"]} references non-existent visit {
-                        data["visit_id"]
+                        vid
                     }. Setting visit_id to None.'
                 )
-                print(
-                    f'REVIEWER WARNING: Event {
-                        data["id"]
-                    } references non-existent visit {
-                        data["visit_id"]
-                    }. visit_id will be set to None.'
-                )
-
                 data['visit_id'] = None
 
-        # --------------------------------------
-
-        fid = data['form_id']
-        if fid is not None:
-            exists = False
-
-            cur.execute(
-                """
-                SELECT EXISTS(SELECT 1 FROM event_forms WHERE id = %s)
-                """,
-                (fid,),
-            )
-
-            d = cur.fetchone()
-            if d is not None:
-                exists = d[0]
-
-            if not exists:
+            fid = data['form_id']
+            if fid is not None and str(fid) not in form_ids:
                 logging.warning(
-                    f'Event {data["id"]} references non-existent visit {
-                        data["form_id"]
+                    f'Event {data["id"]} references non-existent form {
+                        fid
                     }. Setting form_id to None.'
                 )
-                print(
-                    f'REVIEWER WARNING: Event {
-                        data["id"]
-                    } references non-existent visit {
-                        data["form_id"]
-                    }. visit_id will be set to None.'
-                )
-
                 data['form_id'] = None
 
+        return rows
+
+    @classmethod
+    def create_from_delta(cls, ctx, cur: Cursor, data: dict):
+        data = cls.prepare_row(ctx, cur, data)
+
         # AT THIS POINT: We know that the patient must exist.
         # AT THIS POINT: We know that the visit may exist.
         # AT THIS POINT: We know that the form may exist.
@@ -909,26 +1040,15 @@ class Event(SyncToClient, SyncToServer):
                 'external_patient_id', p.external_patient_id,
                 'created_at', p.created_at,
                 'updated_at', p.updated_at,
-                'additional_attributes', COALESCE(json_object_agg(
-                    pa.attribute_id,
-                    json_build_object(
-                        'attribute', pa.attribute,
-                        'number_value', pa.number_value,
-                        'string_value', pa.string_value,
-                        'date_value', pa.date_value,
-                        'boolean_value', pa.boolean_value
-                    )
-                ) FILTER (WHERE pa.attribute_id IS NOT NULL), '{}'::json)
+                'additional_attributes', p.attributes_doc
             ) AS patient
         FROM events
         JOIN patients p ON events.patient_id = p.id
-        LEFT JOIN patient_additional_attributes pa ON p.id = pa.patient_id
         WHERE events.form_id = %s
         AND events.is_deleted = false
         AND events.created_at >= %s
         AND events.created_at <= %s
         AND p.is_deleted = false
-        GROUP BY events.id, events.patient_id, events.visit_id, events.form_id, events.event_type, events.form_data, events.metadata, events.is_deleted, events.created_at, events.updated_at, p.id
         """
 
         with db.get_connection() as conn:
@@ -962,6 +1082,7 @@ class Event(SyncToClient, SyncToServer):
 @core.dataentity
 class Visit(SyncToClient, SyncToServer, helpers.SimpleCRUD):
     TABLE_NAME = 'visits'
+    CLINIC_SCOPE_PATIENT_COLUMN = 'patient_id'
 
     check_in_timestamp: fields.UTCDateTime
     clinic_id: str
@@ -973,6 +1094,33 @@ class Visit(SyncToClient, SyncToServer, helpers.SimpleCRUD):
     created_at: fields.UTCDateTime = fields.UTCDateTime(default_factory=utc.now)
     updated_at: fields.UTCDateTime = fields.UTCDateTime(default_factory=utc.now)
 
+    BULK_UPSERT = BulkUpsert(
+        columns=(
+            'id',
+            'patient_id',
+            'clinic_id',
+            'provider_id',
+            'provider_name',
+            'check_in_timestamp',
+            'metadata',
+            'created_at',
+            'updated_at',
+            'last_modified',
+        ),
+        conflict=('id',),
+        update=(
+            'patient_id',
+            'clinic_id',
+            'provider_id',
+            'provider_name',
+            'check_in_timestamp',
+            'metadata',
+            'created_at',
+            'updated_at',
+            'last_modified',
+        ),
+    )
+
     @classmethod
     def create_from_delta(cls, ctx, cur: Cursor, data: dict):
         """Writes the data to the database."""
@@ -1003,6 +1151,10 @@ class Visit(SyncToClient, SyncToServer, helpers.SimpleCRUD):
 
     @classmethod
     def delete_from_delta(cls, ctx, cur: Cursor, id: str):
+        return cls.delete_many_from_delta(ctx, cur, [id])
+
+    @classmethod
+    def delete_many_from_delta(cls, ctx, cur: Cursor, ids: list[str]):
         now = utc.now()
 
         # Soft delete visit and related records
@@ -1010,13 +1162,13 @@ class Visit(SyncToClient, SyncToServer, helpers.SimpleCRUD):
             """
             UPDATE visits
             SET is_deleted = true,
-                deleted_at = %s,
-                updated_at = %s,
-                last_modified = %s
-            WHERE id = %s::uuid
+                deleted_at = %(now)s,
+                updated_at = %(now)s,
+                last_modified = %(now)s
+            WHERE id = ANY(%(ids)s::uuid[])
             RETURNING id;
             """,
-            (now, now, now, id),
+            dict(ids=ids, now=now),
         )
 
         updated_visit_ids = [row[0] for row in cur.fetchall()]
@@ -1026,24 +1178,24 @@ class Visit(SyncToClient, SyncToServer, helpers.SimpleCRUD):
                 """
                 UPDATE events
                 SET is_deleted = true,
-                    deleted_at = %s,
-                    updated_at = %s,
-                    last_modified = %s
-                WHERE visit_id = ANY(%s);
+                    deleted_at = %(now)s,
+                    updated_at = %(now)s,
+                    last_modified = %(now)s
+                WHERE visit_id = ANY(%(ids)s);
                 """,
-                (now, now, now, updated_visit_ids),
+                dict(ids=updated_visit_ids, now=now),
             )
 
             cur.execute(
                 """
                 UPDATE appointments
                 SET is_deleted = true,
-                    deleted_at = %s,
-                    updated_at = %s,
-                    last_modified = %s
-                WHERE current_visit_id = ANY(%s) OR fulfilled_visit_id = ANY(%s);
+                    deleted_at = %(now)s,
+                    updated_at = %(now)s,
+                    last_modified = %(now)s
+                WHERE current_visit_id = ANY(%(ids)s) OR fulfilled_visit_id = ANY(%(ids)s);
                 """,
-                (now, now, now, updated_visit_ids, updated_visit_ids),
+                dict(ids=updated_visit_ids, now=now),
             )
 
             # TODO: Soft delete prescriptions for deleted visits
@@ -1051,12 +1203,12 @@ class Visit(SyncToClient, SyncToServer, helpers.SimpleCRUD):
                 """
                 UPDATE prescriptions
                 SET is_deleted = true,
-                    deleted_at = %s,
-                    updated_at = %s,
-                    last_modified = %s
-                WHERE visit_id = ANY(%s);
+                    deleted_at = %(now)s,
+                    updated_at = %(now)s,
+                    last_modified = %(now)s
+                WHERE visit_id = ANY(%(ids)s);
                 """,
-                (now, now, now, updated_visit_ids),
+                dict(ids=updated_visit_ids, now=now),
             )
 
         return now
@@ -1084,6 +1236,7 @@ class Visit(SyncToClient, SyncToServer, helpers.SimpleCRUD):
 @core.dataentity
 class Clinic(SyncToClient):
     TABLE_NAME = 'clinics'
+    SYNC_VERSIONED = True
 
     id: str
     name: str | None = None
@@ -1098,6 +1251,7 @@ class Clinic(SyncToClient):
 @core.dataentity
 class PatientRegistrationForm(SyncToClient, helpers.SimpleCRUD):
     TABLE_NAME = 'patient_registration_forms'
+    SYNC_VERSIONED = True
 
     id: str
     name: str
@@ -1111,6 +1265,7 @@ class PatientRegistrationForm(SyncToClient, helpers.SimpleCRUD):
 @core.dataentity
 class EventForm(SyncToClient, helpers.SimpleCRUD):
     TABLE_NAME = 'event_forms'
+    SYNC_VERSIONED = True
 
     id: str
     name: str
@@ -1129,16 +1284,21 @@ class EventForm(SyncToClient, helpers.SimpleCRUD):
 @core.dataentity
 class StringId(SyncToClient):
     TABLE_NAME = 'string_ids'
+    SYNC_VERSIONED = True
 
 
 @core.dataentity
 class StringContent(SyncToClient):
     TABLE_NAME = 'string_content'
+    SYNC_VERSIONED = True
+    # the same string id has content in multiple languages
+    SYNC_KEY_COLUMNS = ('id', 'language')
 
 
 @core.dataentity
 class Appointment(SyncToClient, SyncToServer):
     TABLE_NAME = 'appointments'
+    CLINIC_SCOPE_PATIENT_COLUMN = 'patient_id'
 
     id: str
     timestamp: fields.UTCDateTime = fields.UTCDateTime(default_factory=utc.now)
@@ -1158,6 +1318,54 @@ class Appointment(SyncToClient, SyncToServer):
     last_modified: fields.UTCDateTime = fields.UTCDateTime(default_factory=utc.now)
     server_created_at: fields.UTCDateTime = fields.UTCDateTime(default_factory=utc.now)
 
+    BULK_UPSERT = BulkUpsert(
+        columns=(
+            'id',
+            'timestamp',
+            'duration',
+            'reason',
+            'notes',
+            'provider_id',
+            'clinic_id',
+            'patient_id',
+            'user_id',
+            'status',
+            'current_visit_id',
+            'fulfilled_visit_id',
+            'metadata',
+            'created_at',
+            'updated_at',
+            'last_modified',
+            'is_deleted',
+            'server_created_at',
+            'deleted_at',
+        ),
+        expressions=dict(
+            created_at='COALESCE(created_at, CURRENT_TIMESTAMP)',
+            updated_at='COALESCE(updated_at, CURRENT_TIMESTAMP)',
+        ),
+        conflict=('id',),
+        update=(
+            'timestamp',
+            'duration',
+            'reason',
+            'notes',
+            'provider_id',
+            'clinic_id',
+            'patient_id',
+            'user_id',
+            'status',
+            'current_visit_id',
+            'fulfilled_visit_id',
+            'metadata',
+            'created_at',
+            'updated_at',
+            'last_modified',
+            'is_deleted',
+            'deleted_at',
+        ),
+    )
+
     @classmethod
     def transform_delta(cls, ctx, action: str, data: Any):
         if action == sync.ACTION_CREATE or action == sync.ACTION_UPDATE:
@@ -1209,7 +1417,7 @@ class Appointment(SyncToClient, SyncToServer):
             return appointment
 
     @classmethod
-    def create_from_delta(cls, ctx, cur: Cursor, data: dict):
+    def prepare_row(cls, ctx, cur: Cursor, data: dict):
         assert data['id'] is not None
 
         if data.get('patient_id') is not None:
@@ -1229,7 +1437,7 @@ class Appointment(SyncToClient, SyncToServer):
 
         curr_vid = data.get('current_visit_id')
         if curr_vid is not None:
-            visit_exists = row_exists('visits', curr_vid)
+            visit_exists = row_exists('visits', curr_vid, ctx.conn)
 
             if not visit_exists:
                 data['current_visit_id'] = curr_vid
@@ -1247,11 +1455,12 @@ class Appointment(SyncToClient, SyncToServer):
             data.get('provider_name', ''),
             data.get('check_in_timestamp', utc.now()),
             with_server_metadata,
+            conn=ctx.conn,
         )
 
         fulfilled_vid = data.get('fulfilled_visit_id')
         if fulfilled_vid is not None:
-            visit_exists = row_exists('visits', fulfilled_vid)
+            visit_exists = row_exists('visits', fulfilled_vid, ctx.conn)
 
             if not visit_exists:
                 data['fulfilled_visit_id'] = fulfilled_vid
@@ -1267,8 +1476,15 @@ class Appointment(SyncToClient, SyncToServer):
                 data.get('provider_name', ''),
                 data.get('check_in_timestamp', utc.now()),
                 with_server_metadata,
+                conn=ctx.conn,
             )
 
+        return data
+
+    @classmethod
+    def create_from_delta(cls, ctx, cur: Cursor, data: dict):
+        data = cls.prepare_row(ctx, cur, data)
+
         cur.execute(
             """
             INSERT INTO appointments
@@ -1539,6 +1755,7 @@ class Appointment(SyncToClient, SyncToServer):
 @core.dataentity
 class Prescription(SyncToClient, SyncToServer, SimpleCRUD):
     TABLE_NAME = 'prescriptions'
+    CLINIC_SCOPE_PATIENT_COLUMN = 'patient_id'
 
     id: str
     patient_id: str
@@ -1560,6 +1777,52 @@ class Prescription(SyncToClient, SyncToServer, SimpleCRUD):
     last_modified: fields.UTCDateTime = fields.UTCDateTime(default_factory=utc.now)
     server_created_at: fields.UTCDateTime = fields.UTCDateTime(default_factory=utc.now)
 
+    BULK_UPSERT = BulkUpsert(
+        columns=(
+            'id',
+            'patient_id',
+            'provider_id',
+            'filled_by',
+            'pickup_clinic_id',
+            'visit_id',
+            'priority',
+            'expiration_date',
+            'prescribed_at',
+            'filled_at',
+            'status',
+            'items',
+            'notes',
+            'metadata',
+            'is_deleted',
+            'created_at',
+            'updated_at',
+            'deleted_at',
+            'last_modified',
+            'server_created_at',
+        ),
+        conflict=('id',),
+        update=(
+            'patient_id',
+            'provider_id',
+            'filled_by',
+            'pickup_clinic_id',
+            'visit_id',
+            'priority',
+            'expiration_date',
+            'prescribed_at',
+            'filled_at',
+            'status',
+            'items',
+            'notes',
+            'metadata',
+            'is_deleted',
+            'created_at',
+            'updated_at',
+            'deleted_at',
+            'last_modified',
+        ),
+    )
+
     @classmethod
     def transform_delta(cls, ctx, action, data):
         if action == sync.ACTION_CREATE or action == sync.ACTION_UPDATE:
@@ -1705,6 +1968,18 @@ class Prescription(SyncToClient, SyncToServer, SimpleCRUD):
 ######### HELPER DB METHODS #########
 
 
+@contextmanager
+def _connection(conn: Connection | None) -> Iterator[Connection]:
+    """Uses `conn`, leaving its transaction to the caller. When missing, uses a
+    new connection, committed on exit"""
+    if conn is not None:
+        yield conn
+        return
+
+    with db.get_connection() as conn:
+        yield conn
+
+
 # Upsert a patient visit into the table
 def upsert_visit(
     visit_id: str | None,
@@ -1715,10 +1990,14 @@ def upsert_visit(
     check_in_timestamp: datetime,
     metadata: dict | None = None,
     is_deleted: bool = False,
+    conn: Connection | None = None,
 ):
     """
     Upsert a visit into the table.
     This makes sure a visit exists and handles conflicts of primary keys (visit_id)
+
+    With `conn`, the visit is written in its transaction, to be committed along
+    with it. Otherwise it's committed on a connection of its own.
     """
     vid = visit_id
     if vid is None:
@@ -1726,7 +2005,7 @@ def upsert_visit(
 
     current_time = utc.now()
 
-    with db.get_connection() as conn:
+    with _connection(conn) as conn:
         with conn.cursor() as cur:
             cur.execute(
                 """
@@ -1765,7 +2044,6 @@ def upsert_visit(
             )
 
             result = cur.fetchone()
-            conn.commit()
             return vid  # Return the visit_id
 
 
@@ -1798,42 +2076,57 @@ def insert_placeholder_patient(conn, patient_id, is_deleted=False):
                 'photo_url': '',
             }
 
-            cur.execute(
-                """
-                INSERT INTO patients (
-                    id, given_name, surname, date_of_birth, sex, camp, citizenship, hometown, phone,
-                    additional_data, government_id, external_patient_id, created_at, updated_at,
-                    last_modified, server_created_at, deleted_at, is_deleted, image_timestamp, photo_url
-                ) VALUES (
-                    %(id)s, %(given_name)s, %(surname)s, %(date_of_birth)s, %(sex)s, %(camp)s,
-                    %(citizenship)s, %(hometown)s, %(phone)s, %(additional_data)s, %(government_id)s,
-                    %(external_patient_id)s, %(created_at)s, %(updated_at)s, %(last_modified)s,
-                    %(server_created_at)s, %(deleted_at)s, %(is_deleted)s, %(image_timestamp)s, %(photo_url)s
+            # in a savepoint when part of a push, so that it's committed along
+            # with the push, and a failed insert doesn't abort the push
+            with conn.transaction():
+                cur.execute(
+                    """
+                    INSERT INTO patients (
+                        id, given_name, surname, date_of_birth, sex, camp, citizenship, hometown, phone,
+                        additional_data, government_id, external_patient_id, created_at, updated_at,
+                        last_modified, server_created_at, deleted_at, is_deleted, image_timestamp, photo_url
+                    ) VALUES (
+                        %(id)s, %(given_name)s, %(surname)s, %(date_of_birth)s, %(sex)s, %(camp)s,
+                        %(citizenship)s, %(hometown)s, %(phone)s, %(additional_data)s, %(government_id)s,
+                        %(external_patient_id)s, %(created_at)s, %(updated_at)s, %(last_modified)s,
+                        %(server_created_at)s, %(deleted_at)s, %(is_deleted)s, %(image_timestamp)s, %(photo_url)s
+                    )
+                """,
+                    placeholder_data,
                 )
-            """,
-                placeholder_data,
-            )
 
-            conn.commit()
             print(f'Placeholder patient with ID {patient_id} inserted successfully.')
         except Exception as e:
-            conn.rollback()
             print(f'Error inserting placeholder patient: {str(e)}')
 
 
 # Check if a row exists in a table given its id
-def row_exists(table_name: str, id: str) -> bool:
+def _get_existing_ids(cur: Cursor, table_name: str, ids: list[str]) -> set[str]:
+    """Returns which of the `ids` have a row in the table"""
+    if len(ids) == 0:
+        return set()
+
+    cur.execute(
+        f'SELECT id FROM {table_name} WHERE id = ANY(%s::uuid[])',
+        (list(set(map(str, ids))),),
+    )
+    return {str(row[0]) for row in cur.fetchall()}
+
+
+def row_exists(table_name: str, id: str, conn: Connection | None = None) -> bool:
     """
     Check if a row exists in a table given its id.
 
     Args:
     table_name (str): The name of the table to check.
     id (str): The id of the row to check for.
+    conn (Connection): The connection to check on, which sees the rows written
+        by its transaction. A new connection is used when missing.
 
     Returns:
     bool: True if the row exists, False otherwise.
     """
-    with db.get_connection() as conn:
+    with _connection(conn) as conn:
         with conn.cursor() as cur:
             cur.execute(
                 f"""
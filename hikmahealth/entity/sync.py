@@ -1,21 +1,69 @@
 from __future__ import annotations
 
 from abc import abstractmethod
-from dataclasses import dataclass
-from typing import Any, override
+from contextlib import AbstractContextManager, nullcontext
+from dataclasses import dataclass, field
+import queue
+import threading
+from typing import Any, Callable, Iterator, override
 
-from psycopg import Cursor
+from psycopg import Cursor, IsolationLevel, sql
 from psycopg.connection import Connection
 from psycopg.rows import dict_row
 
 from hikmahealth import sync
 from hikmahealth.entity import core
+from hikmahealth.server import config
 from hikmahealth.sync.errors import SyncPushError
 from hikmahealth.sync.operation import ISyncPull, ISyncPush
 from hikmahealth.utils.datetime import local as dtutils
 
 import datetime
 from hikmahealth.sync import DeltaData
+from hikmahealth.sync.data import ActionType
+
+
+DELTA_ACTION_COLUMN = '__delta_action'
+"""Name of the column used by the single pass query to label each row with the
+sync action it belongs to. It's removed from the rows before being returned."""
+
+
+DELTA_AT_COLUMN = '__delta_at'
+"""Name of the column holding the time a row was created, updated or deleted,
+used to order the rows of a paginated pull."""
+
+
+_CLINIC_PATIENTS_QUERY = """
+    SELECT patient_id FROM visits WHERE clinic_id = ANY(%(clinic_ids)s::uuid[])
+    UNION
+    SELECT patient_id FROM appointments WHERE clinic_id = ANY(%(clinic_ids)s::uuid[])
+"""
+"""Patients seen at any of the clinics, through their visits or appointments"""
+
+
+_NEW_CLINIC_PATIENTS_QUERY = """
+    SELECT s.patient_id FROM (
+        SELECT patient_id FROM visits
+        WHERE clinic_id = ANY(%(clinic_ids)s::uuid[])
+            AND server_created_at > %(last_sync_time)s
+        UNION
+        SELECT patient_id FROM appointments
+        WHERE clinic_id = ANY(%(clinic_ids)s::uuid[])
+            AND server_created_at > %(last_sync_time)s
+    ) s
+    WHERE NOT EXISTS (
+        SELECT 1 FROM visits v
+        WHERE v.patient_id = s.patient_id
+            AND v.clinic_id = ANY(%(clinic_ids)s::uuid[])
+            AND v.server_created_at <= %(last_sync_time)s
+    ) AND NOT EXISTS (
+        SELECT 1 FROM appointments a
+        WHERE a.patient_id = s.patient_id
+            AND a.clinic_id = ANY(%(clinic_ids)s::uuid[])
+            AND a.server_created_at <= %(last_sync_time)s
+    )
+"""
+"""Patients first seen at any of the clinics since the last sync"""
 
 
 # should be move to a different structure. since it depends on psycopg to
@@ -23,11 +71,311 @@ from hikmahealth.sync import DeltaData
 class SyncToClient(ISyncPull[Connection], core.Entity):
     """For entity that expects to apply changes from server to client"""
 
+    SYNC_KEY_COLUMNS: tuple[str, ...] = ('id',)
+    """Columns that uniquely identify a row of the table. Used along with the
+    time of change to keep the position of a paginated pull"""
+
+    CLINIC_SCOPE_PATIENT_COLUMN: str | None = None
+    """Column with the id of the patient the row belongs to. When set, pulls
+    scoped to a set of clinics only include the rows of the patients seen at
+    those clinics. Otherwise, the rows are pulled by every device"""
+
+    SYNC_VERSIONED: bool = False
+    """Whether the table is given a version on pull (see `get_sync_versions`),
+    so that clients holding the current version can skip it altogether. Meant
+    for reference tables, that rarely change"""
+
+    SYNC_EXCLUDED_COLUMNS: tuple[str, ...] = ()
+    """Columns of the table that are kept by the server only, and are left out of
+    the records pulled by the clients"""
+
+    @classmethod
+    def _delta_row_factory(cls, cursor: Cursor):
+        """Same as `dict_row`, without the `SYNC_EXCLUDED_COLUMNS`"""
+        make_row = dict_row(cursor)
+        if len(cls.SYNC_EXCLUDED_COLUMNS) == 0:
+            return make_row
+
+        def make_pulled_row(values):
+            row = make_row(values)
+            for column in cls.SYNC_EXCLUDED_COLUMNS:
+                row.pop(column, None)
+            return row
+
+        return make_pulled_row
+
     @classmethod
     @override
-    def get_delta_records(cls, last_sync_time: datetime.datetime, conn: Connection):
+    def get_delta_records(
+        cls,
+        last_sync_time: datetime.datetime,
+        conn: Connection,
+        single_pass: bool = True,
+        from_log: bool = False,
+        clinic_ids: list[str] | None = None,
+    ):
+        """Returns the records created, updated and deleted since `last_sync_time`.
+
+        When `single_pass` is set, the table is read once and each of the
+        changed rows are labelled by the database. Otherwise, the table is
+        scanned once per action.
+
+        With `from_log`, only the rows with a change recorded in `sync_changes`
+        since `last_sync_time` are read, instead of scanning the table.
+
+        With `clinic_ids`, the records are scoped to the patients seen at those
+        clinics (see `CLINIC_SCOPE_PATIENT_COLUMN`)."""
+        if from_log or clinic_ids is not None:
+            return cls.get_delta_records_single_pass(
+                last_sync_time, conn, from_log=from_log, clinic_ids=clinic_ids
+            )
+
+        if single_pass:
+            return cls.get_delta_records_single_pass(last_sync_time, conn)
+
+        return cls.get_delta_records_multi_pass(last_sync_time, conn)
+
+    @classmethod
+    def _delta_records_query(
+        cls,
+        last_sync_time: datetime.datetime,
+        from_log: bool = False,
+        clinic_ids: list[str] | None = None,
+    ):
+        """Returns the query (and its parameters) that reads all the changed rows
+        once, labelling each one with the sync action it belongs to.
+
+        Each of the actions is matched by its own arm of the `WHERE` clause, so
+        that the rows can be looked up from the sync indices of the table.
+
+        With `from_log`, the rows are looked up from the changes logged since
+        `last_sync_time`. The log is written by triggers on the synced tables.
+
+        With `clinic_ids`, only the rows of the patients seen at the clinics are
+        read. The rows of patients first seen there since `last_sync_time` are
+        all read, as the device never got them."""
+        query = """
+            SELECT
+                t.*,
+                CASE
+                    WHEN t.is_deleted THEN %(delete)s
+                    WHEN t.server_created_at > %(last_sync_time)s THEN %(create)s
+                    ELSE %(update)s
+                END AS {action}
+            FROM {table} t
+            WHERE (
+                t.is_deleted = false
+                AND t.deleted_at IS NULL
+                AND t.server_created_at > %(last_sync_time)s
+            ) OR (
+                t.is_deleted = false
+                AND t.deleted_at IS NULL
+                AND t.last_modified > %(last_sync_time)s
+                AND t.server_created_at < %(last_sync_time)s
+            ) OR (t.is_deleted = true AND t.deleted_at > %(last_sync_time)s)
+            """.format(table=cls.TABLE_NAME, action=DELTA_ACTION_COLUMN)
+
+        params = dict(
+            last_sync_time=last_sync_time,
+            create=sync.ACTION_CREATE,
+            update=sync.ACTION_UPDATE,
+            delete=sync.ACTION_DELETE,
+        )
+
+        if from_log:
+            query = """
+            SELECT * FROM ({query}) t
+            WHERE t.id IN (
+                SELECT row_id FROM sync_changes
+                WHERE table_name = %(table_name)s AND changed_at > %(last_sync_time)s
+            )
+            """.format(query=query)
+            params.update(table_name=cls.TABLE_NAME)
+
+        if clinic_ids is not None and cls.CLINIC_SCOPE_PATIENT_COLUMN is not None:
+            query = """
+            SELECT * FROM ({query}) t
+            WHERE t.{patient} IN ({patients})
+            UNION ALL
+            SELECT t.*, %(update)s AS {action}
+            FROM {table} t
+            WHERE t.is_deleted = false
+                AND t.deleted_at IS NULL
+                AND t.server_created_at <= %(last_sync_time)s
+                AND (
+                    t.last_modified > %(last_sync_time)s
+                    AND t.server_created_at < %(last_sync_time)s
+                ) IS NOT TRUE
+                AND t.{patient} IN ({new_patients})
+            """.format(
+                query=query,
+                table=cls.TABLE_NAME,
+                action=DELTA_ACTION_COLUMN,
+                patient=cls.CLINIC_SCOPE_PATIENT_COLUMN,
+                patients=_CLINIC_PATIENTS_QUERY,
+                new_patients=_NEW_CLINIC_PATIENTS_QUERY,
+            )
+            params.update(clinic_ids=clinic_ids)
+
+        return query, params
+
+    @classmethod
+    def get_delta_records_single_pass(
+        cls,
+        last_sync_time: datetime.datetime,
+        conn: Connection,
+        from_log: bool = False,
+        clinic_ids: list[str] | None = None,
+    ):
+        created, updated, deleted = [], [], []
+
+        with conn.cursor(row_factory=cls._delta_row_factory) as cur:
+            cur.execute(
+                *cls._delta_records_query(last_sync_time, from_log, clinic_ids)
+            )
+
+            for row in cur:
+                action = row.pop(DELTA_ACTION_COLUMN)
+                if action == sync.ACTION_CREATE:
+                    created.append(row)
+                elif action == sync.ACTION_UPDATE:
+                    updated.append(row)
+                else:
+                    deleted.append(row['id'])
+
+        return DeltaData(created=created, updated=updated, deleted=deleted)
+
+    @classmethod
+    def iter_delta_records(
+        cls,
+        last_sync_time: datetime.datetime,
+        conn: Connection,
+        batch_size: int = 1000,
+        from_log: bool = False,
+        clinic_ids: list[str] | None = None,
+    ) -> Iterator[tuple[ActionType, Any]]:
+        """Yields the `(action, record)` pairs changed since `last_sync_time`,
+        grouped by action. Deleted records only yield their `id`.
+
+        Rows are read through a server-side cursor, so that at most `batch_size`
+        rows are held in memory at a time. The connection must not be in
+        autocommit mode."""
+        query, params = cls._delta_records_query(
+            last_sync_time, from_log=from_log, clinic_ids=clinic_ids
+        )
+
+        with conn.cursor(
+            name='delta_{}'.format(cls.TABLE_NAME),
+            row_factory=cls._delta_row_factory,
+        ) as cur:
+            cur.itersize = batch_size
+            cur.execute(query + ' ORDER BY {}'.format(DELTA_ACTION_COLUMN), params)
+
+            for row in cur:
+                action = row.pop(DELTA_ACTION_COLUMN)
+                if action == sync.ACTION_DELETE:
+                    yield action, row['id']
+                else:
+                    yield action, row
+
+    @classmethod
+    def get_delta_records_page(
+        cls,
+        last_sync_time: datetime.datetime,
+        high_watermark: datetime.datetime,
+        conn: Connection,
+        limit: int,
+        after: tuple[datetime.datetime, list[Any]] | None = None,
+        from_log: bool = False,
+        clinic_ids: list[str] | None = None,
+    ):
+        """Returns up to `limit` of the records changed between `last_sync_time`
+        and `high_watermark`, ordered by the time they were changed.
+
+        `after` is the position `(changed_at, key)` of the last record of the
+        previous page, where `key` holds the values of `SYNC_KEY_COLUMNS`.
+        Along with the records, returns the position of the last record read, or
+        `None` when there are no more records left for the entity."""
+        query, params = cls._delta_records_query(
+            last_sync_time, from_log=from_log, clinic_ids=clinic_ids
+        )
+        keys = ', '.join('p.{}'.format(c) for c in cls.SYNC_KEY_COLUMNS)
+
+        where = ['p.{} <= %(high_watermark)s'.format(DELTA_AT_COLUMN)]
+        params = params | dict(high_watermark=high_watermark, limit=limit)
+        if after is not None:
+            after_at, after_key = after
+            assert len(after_key) == len(cls.SYNC_KEY_COLUMNS), 'invalid position'
+
+            where.append(
+                '(p.{}, {}) > (%(after_at)s, {})'.format(
+                    DELTA_AT_COLUMN,
+                    keys,
+                    ', '.join(
+                        '%(after_{})s'.format(i) for i in range(len(after_key))
+                    ),
+                )
+            )
+            params |= dict(after_at=after_at)
+            params |= {'after_{}'.format(i): v for i, v in enumerate(after_key)}
+
+        created, updated, deleted = [], [], []
+        last_position = None
+
+        with conn.cursor(row_factory=cls._delta_row_factory) as cur:
+            cur.execute(
+                """
+                SELECT * FROM (
+                    SELECT
+                        d.*,
+                        CASE d.{action}
+                            WHEN %(delete)s THEN d.deleted_at
+                            WHEN %(create)s THEN d.server_created_at
+                            ELSE d.last_modified
+                        END AS {at}
+                    FROM ({query}) d
+                ) p
+                WHERE {where}
+                ORDER BY p.{at}, {keys}
+                LIMIT %(limit)s
+                """.format(
+                    action=DELTA_ACTION_COLUMN,
+                    at=DELTA_AT_COLUMN,
+                    query=query,
+                    where=' AND '.join(where),
+                    keys=keys,
+                ),
+                params,
+            )
+
+            rows = cur.fetchall()
+
+        for row in rows:
+            action = row.pop(DELTA_ACTION_COLUMN)
+            changed_at = row.pop(DELTA_AT_COLUMN)
+            last_position = (changed_at, [row[c] for c in cls.SYNC_KEY_COLUMNS])
+
+            if action == sync.ACTION_CREATE:
+                created.append(row)
+            elif action == sync.ACTION_UPDATE:
+                updated.append(row)
+            else:
+                deleted.append(row['id'])
+
+        if len(rows) < limit:
+            # read everything there's left to read
+            last_position = None
+
+        return DeltaData(
+            created=created, updated=updated, deleted=deleted
+        ), last_position
+
+    @classmethod
+    def get_delta_records_multi_pass(
+        cls, last_sync_time: datetime.datetime, conn: Connection
+    ):
         # print(last_sync_time)
-        with conn.cursor(row_factory=dict_row) as cur:
+        with conn.cursor(row_factory=cls._delta_row_factory) as cur:
             newrecords = cur.execute(
                 'SELECT * from {} WHERE server_created_at > %s AND deleted_at IS NULL AND is_deleted = false'.format(
                     cls.TABLE_NAME
@@ -62,9 +410,39 @@ class SyncContext:
     conn: Connection
 
 
+@dataclass(frozen=True)
+class BulkUpsert:
+    """Describes how the rows pushed for an entity are merged into its table
+    with a single `INSERT ... ON CONFLICT` statement, mirroring the per row
+    upsert done in `create_from_delta`"""
+
+    columns: tuple[str, ...]
+    """Columns taken from each of the rows"""
+
+    conflict: tuple[str, ...]
+    """Columns of the `ON CONFLICT` target"""
+
+    update: tuple[str, ...]
+    """Columns set from the conflicting row"""
+
+    expressions: dict[str, str] = field(default_factory=dict)
+    """Columns inserted with an SQL expression instead of their value as is.
+    The expressions may refer to the `columns` of the row"""
+
+    @property
+    def inserted_columns(self) -> tuple[str, ...]:
+        return self.columns + tuple(
+            c for c in self.expressions.keys() if c not in self.columns
+        )
+
+
 class SyncToServer(ISyncPush[Connection]):
     """Abstract for entities that expect to apply changes from client to server"""
 
+    BULK_UPSERT: BulkUpsert | None = None
+    """When defined, the created and updated rows can be applied in bulk
+    instead of one statement at a time"""
+
     @classmethod
     @abstractmethod
     def transform_delta(
@@ -87,57 +465,333 @@ class SyncToServer(ISyncPush[Connection]):
     def delete_from_delta(cls, ctx: SyncContext, cur: Cursor, id: str):
         raise NotImplementedError()
 
+    @classmethod
+    def delete_many_from_delta(cls, ctx: SyncContext, cur: Cursor, ids: list[str]):
+        """Deletes the records with the `ids`. Entities whose deletes cascade
+        to other tables can override this to delete them all at once"""
+        for id in ids:
+            cls.delete_from_delta(ctx, cur, id)
+
+    @classmethod
+    def prepare_row(cls, ctx: SyncContext, cur: Cursor, data: dict) -> dict:
+        """Readies a transformed row before it's written (e.g. making sure the
+        records it refers to exist). Applied to each row merged in bulk, so
+        `create_from_delta` should go through it as well"""
+        return data
+
+    @classmethod
+    def prepare_rows(
+        cls, ctx: SyncContext, cur: Cursor, rows: list[dict]
+    ) -> list[dict]:
+        """Readies all the rows merged in bulk. Entities checking the references
+        of their rows can override this to check them all at once"""
+        return [cls.prepare_row(ctx, cur, data) for data in rows]
+
+    @classmethod
+    def _transform(cls, ctx: SyncContext, action: str, data: Any):
+        try:
+            tdata = cls.transform_delta(ctx, action, data)
+            if tdata is None:
+                # `transformed_data` may not contain the
+                # resulting transformation for the data.
+                # Should use the original data
+                return data
+
+            return tdata
+
+        except NotImplementedError:
+            # if `transformed_data` logic missing,
+            # proceed with the same untransformed one
+            return data
+
     @classmethod
     def apply_delta_changes(
         cls,
         deltadata: sync.DeltaData[dict, dict, str],
         last_pushed_at: datetime.datetime,
         conn: Connection,
+        bulk: bool | None = None,
     ):
+        """Applies the changes pushed by the client, all or nothing.
+
+        The changes are committed once applied, unless a transaction is already
+        open on `conn`, in which case they're applied in a savepoint and left
+        for the caller to commit along with the rest of the push.
+
+        With `bulk` (by default, `config.SYNC_PUSH_BULK`), the created and
+        updated rows of entities defining `BULK_UPSERT` are copied to a staging
+        table and merged in a single statement."""
+        if bulk is None:
+            bulk = config.SYNC_PUSH_BULK
+
         ctx = SyncContext(last_pushed_at, conn)
 
         with conn.cursor() as cur:
             try:
-                # `cur.executemany` can be used instead
-                # batched updates??
-                for action, data in deltadata:
-                    transformed_data = data
-
-                    try:
-                        tdata = cls.transform_delta(ctx, action, data)
-                        if tdata is None:
-                            # `transformed_data` may not contain the
-                            # resulting transformation for the data.
-                            # Should use the original data
-                            transformed_data = data
-                        else:
-                            transformed_data = tdata
-
-                    except NotImplementedError:
-                        # if `transformed_data` logic missing,
-                        # proceed with the same untransformed one
-                        transformed_data = data
-
-                    if action in (sync.ACTION_CREATE, sync.ACTION_UPDATE):
-                        assert isinstance(transformed_data, dict), 'data must be a dict'
-
-                        if action == sync.ACTION_CREATE:
-                            cls.create_from_delta(ctx, cur, transformed_data)
-                        elif action == sync.ACTION_UPDATE:
-                            cls.update_from_delta(ctx, cur, transformed_data)
-
-                    elif action == sync.ACTION_DELETE:
-                        assert isinstance(transformed_data, str), (
-                            'expect transformed data to be a {}. instead got {}'.format(
-                                str, type(transformed_data)
-                            )
-                        )
-
-                        cls.delete_from_delta(ctx, cur, transformed_data)
-
                 # should commit the entire delta, or not
-                conn.commit()
+                with conn.transaction():
+                    if bulk and cls.BULK_UPSERT is not None:
+                        cls._apply_delta_changes_in_bulk(ctx, cur, deltadata)
+                    else:
+                        cls._apply_delta_changes_by_row(ctx, cur, deltadata)
             except Exception as e:
                 print(f'{cls.__name__} sync errors: {str(e)}')
-                conn.rollback()
                 raise SyncPushError(*e.args)
+
+    @classmethod
+    def _apply_delta_changes_by_row(
+        cls,
+        ctx: SyncContext,
+        cur: Cursor,
+        deltadata: sync.DeltaData[dict, dict, str],
+    ):
+        for action, data in deltadata:
+            if action not in (sync.ACTION_CREATE, sync.ACTION_UPDATE):
+                continue
+
+            transformed_data = cls._transform(ctx, action, data)
+            assert isinstance(transformed_data, dict), 'data must be a dict'
+
+            if action == sync.ACTION_CREATE:
+                cls.create_from_delta(ctx, cur, transformed_data)
+            elif action == sync.ACTION_UPDATE:
+                cls.update_from_delta(ctx, cur, transformed_data)
+
+        cls._apply_deletes(ctx, cur, deltadata)
+
+    @classmethod
+    def _apply_delta_changes_in_bulk(
+        cls,
+        ctx: SyncContext,
+        cur: Cursor,
+        deltadata: sync.DeltaData[dict, dict, str],
+    ):
+        rows = []
+        for action, data in deltadata:
+            if action not in (sync.ACTION_CREATE, sync.ACTION_UPDATE):
+                continue
+
+            transformed_data = cls._transform(ctx, action, data)
+            assert isinstance(transformed_data, dict), 'data must be a dict'
+            rows.append(transformed_data)
+
+        if len(rows) > 0:
+            cls._bulk_upsert(cur, cls.prepare_rows(ctx, cur, rows))
+
+        cls._apply_deletes(ctx, cur, deltadata)
+
+    @classmethod
+    def _apply_deletes(
+        cls,
+        ctx: SyncContext,
+        cur: Cursor,
+        deltadata: sync.DeltaData[dict, dict, str],
+    ):
+        """Deletes the records after all the upserts, in a single batch"""
+        ids = []
+        for data in deltadata.deleted:
+            transformed_data = cls._transform(ctx, sync.ACTION_DELETE, data)
+            assert isinstance(transformed_data, str), (
+                'expect transformed data to be a {}. instead got {}'.format(
+                    str, type(transformed_data)
+                )
+            )
+            ids.append(transformed_data)
+
+        if len(ids) > 0:
+            # the same record may be deleted more than once
+            cls.delete_many_from_delta(ctx, cur, list(dict.fromkeys(ids)))
+
+    @classmethod
+    def _bulk_upsert(cls, cur: Cursor, rows: list[dict]):
+        """Copies the rows to a staging table, then merges them into the table.
+
+        A statement can't update the same row twice, so rows sharing the same
+        key are merged in successive rounds, in the order they were pushed"""
+        spec = cls.BULK_UPSERT
+        assert spec is not None
+
+        table = sql.Identifier(cls.TABLE_NAME)
+        staging = sql.Identifier(f'_bulk_{cls.TABLE_NAME}')
+        columns = sql.SQL(', ').join(map(sql.Identifier, spec.columns))
+        inserted = spec.inserted_columns
+
+        cur.execute(
+            sql.SQL(
+                'CREATE TEMPORARY TABLE {staging} AS SELECT {columns} FROM {table} WITH NO DATA'
+            ).format(staging=staging, columns=columns, table=table)
+        )
+
+        merge = sql.SQL(
+            """
+            INSERT INTO {table} ({inserted})
+            SELECT {values} FROM {staging}
+            ON CONFLICT ({conflict}) DO UPDATE
+            SET {update}
+            """
+        ).format(
+            table=table,
+            inserted=sql.SQL(', ').join(map(sql.Identifier, inserted)),
+            values=sql.SQL(', ').join(
+                sql.SQL(spec.expressions[c])
+                if c in spec.expressions
+                else sql.Identifier(c)
+                for c in inserted
+            ),
+            staging=staging,
+            conflict=sql.SQL(', ').join(map(sql.Identifier, spec.conflict)),
+            update=sql.SQL(', ').join(
+                sql.SQL('{c} = EXCLUDED.{c}').format(c=sql.Identifier(c))
+                for c in spec.update
+            ),
+        )
+
+        # rounds[i] holds the (i + 1)th row pushed of each key
+        rounds: list[list[dict]] = []
+        seen: dict[tuple, int] = {}
+        for row in rows:
+            key = tuple(str(row[c]) for c in spec.conflict)
+            n = seen.get(key, 0)
+            seen[key] = n + 1
+
+            if n == len(rounds):
+                rounds.append([])
+            rounds[n].append(row)
+
+        for batch in rounds:
+            with cur.copy(
+                sql.SQL('COPY {staging} ({columns}) FROM STDIN').format(
+                    staging=staging, columns=columns
+                )
+            ) as copy:
+                for row in batch:
+                    copy.write_row([row[c] for c in spec.columns])
+
+            cur.execute(merge)
+            cur.execute(sql.SQL('TRUNCATE {staging}').format(staging=staging))
+
+        cur.execute(sql.SQL('DROP TABLE {staging}').format(staging=staging))
+
+
+def _begin_snapshot_transaction(conn: Connection):
+    """Configures the next transaction to read from a single, stable snapshot"""
+    conn.isolation_level = IsolationLevel.REPEATABLE_READ
+    conn.read_only = True
+
+
+def get_delta_records_concurrently(
+    entities: dict[str, type[SyncToClient]],
+    last_sync_time: datetime.datetime,
+    connect: Callable[[], Connection],
+    workers: int,
+    single_pass: bool = True,
+    from_log: bool = False,
+    clinic_ids: list[str] | None = None,
+    observe_entity: Callable[[str], AbstractContextManager] = lambda _: nullcontext(),
+) -> dict[str, DeltaData]:
+    """Fetches the delta records of the `entities` in parallel, on up to
+    `workers` connections created with `connect`. The records of each entity
+    are fetched within the context returned by `observe_entity`.
+
+    All the connections import the snapshot exported by a first connection,
+    so the records are as consistent as when fetched one after another in the
+    same transaction.
+
+    Workers are plain threads. When running with gevent's monkey patching (as in
+    `pywsgi.py`), these are greenlets, and psycopg waits on the sockets
+    cooperatively."""
+    pending: queue.Queue[str] = queue.Queue()
+    for changekey in entities:
+        pending.put(changekey)
+
+    results: dict[str, DeltaData] = {}
+    errors: list[Exception] = []
+
+    with connect() as conn:
+        _begin_snapshot_transaction(conn)
+        row = conn.execute('SELECT pg_export_snapshot()').fetchone()
+        assert row is not None, 'failed to export snapshot'
+        snapshot_id = row[0]
+
+        def work():
+            try:
+                with connect() as wconn:
+                    _begin_snapshot_transaction(wconn)
+                    wconn.execute(
+                        sql.SQL('SET TRANSACTION SNAPSHOT {}').format(
+                            sql.Literal(snapshot_id)
+                        )
+                    )
+
+                    while True:
+                        try:
+                            changekey = pending.get_nowait()
+                        except queue.Empty:
+                            return
+
+                        with observe_entity(changekey):
+                            results[changekey] = entities[
+                                changekey
+                            ].get_delta_records(
+                                last_sync_time,
+                                wconn,
+                                single_pass=single_pass,
+                                from_log=from_log,
+                                clinic_ids=clinic_ids,
+                            )
+            except Exception as err:
+                errors.append(err)
+
+        threads = [
+            threading.Thread(target=work, daemon=True)
+            for _ in range(max(1, min(workers, len(entities))))
+        ]
+        for t in threads:
+            t.start()
+
+        # the exported snapshot is only available while
+        # this transaction is open
+        for t in threads:
+            t.join()
+
+    if len(errors) > 0:
+        raise errors[0]
+
+    return {changekey: results[changekey] for changekey in entities}
+
+
+def get_sync_versions(
+    entities: dict[str, type[SyncToClient]], conn: Connection
+) -> dict[str, str]:
+    """Returns the current version of each of the `SYNC_VERSIONED` entities.
+
+    The version is a counter kept in `sync_versions`, bumped by the trigger that
+    logs the changes of the table, so it changes whenever a row of the table is
+    created, updated or deleted. A client that got the records of an entity
+    along with its version, and still holds the current version, has nothing to
+    pull for it.
+
+    The triggers of the table must be given the 'versioned' argument for the
+    counter to be bumped (see the `create_sync_versions_table` migration)"""
+    versioned = {
+        changekey: c.TABLE_NAME
+        for changekey, c in entities.items()
+        if c.SYNC_VERSIONED
+    }
+    if len(versioned) == 0:
+        return dict()
+
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT t.table_name, coalesce(v.version, 0)
+            FROM unnest(%s::text[]) AS t(table_name)
+            LEFT JOIN sync_versions v ON v.table_name = t.table_name
+            """,
+            [list(versioned.values())],
+        )
+        versions = {table_name: str(version) for table_name, version in cur.fetchall()}
+
+    return {
+        changekey: versions[table_name] for changekey, table_name in versioned.items()
+    }
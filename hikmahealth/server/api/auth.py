@@ -1,15 +1,24 @@
 from __future__ import annotations
 import bcrypt
 
+from hikmahealth.server import config
 from hikmahealth.server.client import db
 from hikmahealth.utils.errors import WebError
 
 from hikmahealth.entity import core
+from hikmahealth.utils.datetime import utc
 
 import bcrypt
 from psycopg.rows import dict_row
 
+import datetime
 import uuid
+import hashlib
+import hmac
+import secrets
+import threading
+
+from cachetools import TTLCache
 
 
 @core.dataentity
@@ -44,27 +53,72 @@ def invalidate_tokens(u: User):
         with conn.cursor() as cur:
             cur.execute('DELETE FROM tokens WHERE user_id = %s', [u.id])
 
+    invalidate_cached_tokens(user_id=u.id)
+
+
+# Users resolved from session tokens in the recent past, along with the
+# expiry of the token. Spares the burst of requests made by the admin
+# dashboard from looking up the same token over and over
+_token_cache: TTLCache[str, tuple[User, datetime.datetime]] = TTLCache(
+    maxsize=config.AUTH_TOKEN_CACHE_SIZE,
+    ttl=config.AUTH_TOKEN_CACHE_TTL,
+)
+_token_cache_lock = threading.Lock()
+
+
+def _get_cached_user_from_token(token: str) -> User | None:
+    with _token_cache_lock:
+        cached = _token_cache.get(token, None)
+
+    if cached is None:
+        return None
+
+    u, expiry = cached
+    if expiry <= utc.now():
+        with _token_cache_lock:
+            _token_cache.pop(token, None)
+        return None
+
+    return u
+
+
+def invalidate_cached_tokens(user_id: str):
+    """Forgets the users resolved from the tokens of the user with `user_id`"""
+    with _token_cache_lock:
+        for token, (u, _) in list(_token_cache.items()):
+            if str(u.id) == str(user_id):
+                _token_cache.pop(token, None)
+
 
 def get_user_from_token(token: str) -> User:
+    if config.AUTH_TOKEN_CACHE_TTL > 0:
+        u = _get_cached_user_from_token(token)
+        if u is not None:
+            return u
+
     with db.get_connection() as conn:
         with conn.cursor(row_factory=dict_row) as cur:
-            res = cur.execute(
-                'SELECT user_id FROM tokens WHERE token = %s AND expiry > now()',
+            urow = cur.execute(
+                """
+                SELECT users.*, tokens.expiry AS token_expiry
+                FROM tokens JOIN users ON users.id = tokens.user_id
+                WHERE tokens.token = %s AND tokens.expiry > now()
+                LIMIT 1
+                """,
                 (token,),
             ).fetchone()
 
-            if res is None:
-                # log here
-                raise WebError('invalid authentication token', 401)
+    if urow is None:
+        # log here
+        raise WebError('invalid authentication token', 401)
 
-            urow = cur.execute(
-                'SELECT * FROM users WHERE id = %s', (res['user_id'],)
-            ).fetchone()
+    u = User(**urow)
 
-            if urow is None:
-                raise WebError('invalid authentication token', 401)
+    if config.AUTH_TOKEN_CACHE_TTL > 0:
+        with _token_cache_lock:
+            _token_cache[token] = (u, urow['token_expiry'])
 
-            return User(**urow)
+    return u
 
 
 def get_user_from_email(email: str, password: str) -> User:
@@ -84,6 +138,60 @@ def get_user_from_email(email: str, password: str) -> User:
         return User(**row)
 
 
+# Credentials verified in the recent past. Entries are keyed by a keyed hash of
+# the credentials, so the plaintext password is never kept around
+_credentials_cache: TTLCache[bytes, User] = TTLCache(
+    maxsize=config.AUTH_CREDENTIALS_CACHE_SIZE,
+    ttl=config.AUTH_CREDENTIALS_CACHE_TTL,
+)
+_credentials_cache_lock = threading.Lock()
+# generated per process, so the hashes are useless anywhere else
+_credentials_cache_key = secrets.token_bytes(32)
+
+
+def _hash_credentials(email: str, password: str) -> bytes:
+    return hmac.digest(
+        _credentials_cache_key,
+        b'\0'.join([email.lower().encode(), password.encode()]),
+        hashlib.sha256,
+    )
+
+
+def get_user_from_credentials(email: str, password: str) -> User:
+    """Same as `get_user_from_email`, but remembers the credentials it verified
+    for a short while. Repeated requests from the same user skip the database
+    and the (purposely slow) password check."""
+    if config.AUTH_CREDENTIALS_CACHE_TTL <= 0:
+        return get_user_from_email(email, password)
+
+    key = _hash_credentials(email, password)
+    with _credentials_cache_lock:
+        u = _credentials_cache.get(key, None)
+
+    if u is not None:
+        return u
+
+    u = get_user_from_email(email, password)
+
+    with _credentials_cache_lock:
+        _credentials_cache[key] = u
+
+    return u
+
+
+def invalidate_cached_credentials(
+    user_id: str | None = None, email: str | None = None
+):
+    """Forgets the verified credentials of the user with the `user_id` or `email`.
+    Must be called when a password changes or the user is removed"""
+    with _credentials_cache_lock:
+        for key, u in list(_credentials_cache.items()):
+            if (user_id is not None and str(u.id) == str(user_id)) or (
+                email is not None and u.email.lower() == email.lower()
+            ):
+                _credentials_cache.pop(key, None)
+
+
 def reset_password(user: User, new_password: str):
     """Updates the password of the user object"""
     with db.get_connection().cursor() as cur:
@@ -98,3 +206,5 @@ def reset_password(user: User, new_password: str):
                 user.id,
             ),
         )
+
+    invalidate_cached_credentials(user_id=user.id)
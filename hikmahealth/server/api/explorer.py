@@ -0,0 +1,257 @@
+"""Compiles the filters of the data explorer into a single SQL statement, so
+that the patients and events matching them are found by Postgres, without
+reading the events in between"""
+
+from __future__ import annotations
+
+from typing import Any
+
+from psycopg import sql
+
+from hikmahealth.utils.errors import WebError
+from hikmahealth.utils.misc import convert_operator
+
+# columns of the patients returned by the explorer, which are also the only
+# columns the base fields of the patient filter can be compared on
+PATIENT_COLUMNS = (
+    'id',
+    'given_name',
+    'surname',
+    'date_of_birth',
+    'sex',
+    'camp',
+    'citizenship',
+    'hometown',
+    'phone',
+    'government_id',
+    'external_patient_id',
+    'created_at',
+    'updated_at',
+    'last_modified',
+    'server_created_at',
+    'deleted_at',
+)
+
+# casts of the event field values compared with `<`, `>`, `<=`, `>=` and `!=`,
+# by the `dataType` of the filter. Other values are compared as text
+_EVENT_VALUE_CASTS = {
+    'date': sql.SQL('timestamp'),
+    'number': sql.SQL('numeric'),
+    'boolean': sql.SQL('boolean'),
+}
+
+_WILDCARD_OPERATORS = ('ILIKE', 'NOT ILIKE', 'LIKE', 'NOT LIKE')
+_NULL_OPERATORS = ('IS NULL', 'IS NOT NULL')
+
+_ATTRIBUTE_VALUE = sql.SQL(
+    'COALESCE(pa.string_value, CAST(pa.number_value AS TEXT), '
+    'CAST(pa.boolean_value AS TEXT), CAST(pa.date_value AS TEXT))'
+)
+
+
+class _Params(dict):
+    """Parameters of the compiled statement, named in the order they're added"""
+
+    def add(self, value: Any) -> sql.Placeholder:
+        name = f'p{len(self)}'
+        self[name] = value
+        return sql.Placeholder(name)
+
+
+def _compare(
+    expr: sql.Composable,
+    operator: str,
+    value: Any,
+    params: _Params,
+    cast: sql.Composable | None = None,
+) -> sql.Composable:
+    """Returns `expr <operator> value`, for the operators of `convert_operator`.
+    The values of `contains` and `does not contain` are wrapped in wildcards"""
+    if operator in _NULL_OPERATORS:
+        return sql.SQL('{} {}').format(expr, sql.SQL(operator))
+
+    if operator in _WILDCARD_OPERATORS:
+        value = f'%{value}%'
+
+    placeholder = params.add(value)
+    if cast is not None:
+        placeholder = sql.SQL('{}::{}').format(placeholder, cast)
+
+    return sql.SQL('{} {} {}').format(expr, sql.SQL(operator), placeholder)
+
+
+def _event_condition(rule: dict, params: _Params) -> sql.Composable:
+    """Matches the events of the form with a field meeting the `rule`. The
+    `fieldId` of the rule is written as `formId;fieldId`"""
+    form_id, field_id = rule['fieldId'].split(';')
+    operator = convert_operator(rule['operator'])
+    value = sql.SQL("(field->>'value')")
+
+    cast = None
+    if operator in ('<', '>', '<=', '>=', '!='):
+        cast = _EVENT_VALUE_CASTS.get(rule.get('dataType'))
+
+    if cast is None:
+        condition = _compare(value, operator, str(rule.get('value')), params)
+    else:
+        condition = sql.SQL(
+            "{value} IS NOT NULL AND {value} != '' AND {comparison}"
+        ).format(
+            value=value,
+            comparison=_compare(
+                sql.SQL('{}::{}').format(value, cast),
+                operator,
+                str(rule['value']),
+                params,
+                cast=cast,
+            ),
+        )
+
+    return sql.SQL(
+        """(
+            e.form_id = {form_id} AND EXISTS (
+                SELECT 1 FROM jsonb_array_elements(e.form_data) AS field
+                WHERE field->>'fieldId' = {field_id} AND {condition}
+            )
+        )"""
+    ).format(
+        form_id=params.add(form_id),
+        field_id=params.add(field_id),
+        condition=condition,
+    )
+
+
+def _base_field_condition(rule: dict, params: _Params) -> sql.Composable:
+    if rule['field'] not in PATIENT_COLUMNS:
+        raise WebError(f'Unknown patient field: {rule["field"]}', 400)
+
+    return _compare(
+        sql.SQL('p.{}').format(sql.Identifier(rule['field'])),
+        convert_operator(rule['operator']),
+        rule.get('value'),
+        params,
+    )
+
+
+def _attribute_condition(rule: dict, params: _Params) -> sql.Composable:
+    """Semi-join on the attribute of the patient. A patient without the
+    attribute is empty, so `is empty` matches when no value is set"""
+    operator = convert_operator(rule['operator'])
+    if operator == 'IS NULL':
+        exists, operator = sql.SQL('NOT EXISTS'), 'IS NOT NULL'
+    else:
+        exists = sql.SQL('EXISTS')
+
+    return sql.SQL(
+        """{exists} (
+            SELECT 1 FROM patient_additional_attributes pa
+            WHERE pa.patient_id = p.id
+            AND pa.attribute_id = {attribute_id}
+            AND pa.is_deleted = false
+            AND {condition}
+        )"""
+    ).format(
+        exists=exists,
+        attribute_id=params.add(rule['fieldId']),
+        condition=_compare(_ATTRIBUTE_VALUE, operator, rule.get('value'), params),
+    )
+
+
+def compile_filters(
+    filters: dict, return_events: bool = True
+) -> tuple[sql.Composed, dict]:
+    """Compiles the `filters` of the explorer into a statement returning a
+    single row, with the matching patients and events as JSON arrays in its
+    `patients` and `events` columns.
+
+    Events match when they meet any of the event rules. Patients meet all of
+    the patient rules and, when any other filter is set, have a matching
+    event. The `events` are only returned with `return_events`, and are NULL
+    otherwise. The `patients` are returned with a patient filter, or instead
+    of the events when these aren't returned, and are NULL otherwise.
+
+    The rows are encoded to JSON by Postgres, so their dates are written in
+    ISO 8601 as Postgres does, without trailing zeros in the fractions of
+    seconds, instead of by the JSON provider of the app.
+
+    Appointment and prescription filters are not supported yet, and match no
+    patients"""
+    try:
+        return _compile_filters(filters, return_events)
+    except (KeyError, TypeError, ValueError, AttributeError) as e:
+        raise WebError(f'Invalid filter: {e}', 400)
+
+
+def _compile_filters(filters: dict, return_events: bool) -> tuple[sql.Composed, dict]:
+    params = _Params()
+    ctes = []
+
+    event_rules = filters['event'] if isinstance(filters['event'], list) else []
+    if event_rules:
+        ctes.append(
+            sql.SQL(
+                """matched_events AS MATERIALIZED (
+                    SELECT e.* FROM events e
+                    WHERE e.is_deleted = FALSE AND ({})
+                )"""
+            ).format(
+                sql.SQL(' OR ').join(_event_condition(r, params) for r in event_rules)
+            )
+        )
+
+    patient_filter = filters['patient']
+    events_selected = return_events and bool(event_rules)
+    patients_selected = bool(patient_filter) or (
+        bool(event_rules) and not return_events
+    )
+
+    if patients_selected:
+        patient_filter = patient_filter or {}
+        conditions = [
+            _base_field_condition(r, params)
+            for r in patient_filter.get('baseFields') or []
+        ]
+        conditions += [
+            _attribute_condition(r, params)
+            for r in patient_filter.get('attributeFields') or []
+        ]
+
+        if event_rules:
+            conditions.append(
+                sql.SQL('p.id IN (SELECT patient_id FROM matched_events)')
+            )
+        elif filters['appointment'] or filters['prescription']:
+            conditions.append(sql.SQL('FALSE'))
+
+        ctes.append(
+            sql.SQL(
+                """matched_patients AS (
+                    SELECT {columns}, p.attributes_doc AS additional_attributes
+                    FROM patients p
+                    WHERE {conditions}
+                )"""
+            ).format(
+                columns=sql.SQL(', ').join(
+                    sql.SQL('p.{}').format(sql.Identifier(c)) for c in PATIENT_COLUMNS
+                ),
+                conditions=sql.SQL(' AND ').join(conditions or [sql.SQL('TRUE')]),
+            )
+        )
+        patients = sql.SQL(
+            "(SELECT COALESCE(json_agg(mp), '[]') FROM matched_patients mp)"
+        )
+    else:
+        patients = sql.SQL('NULL::json')
+
+    if events_selected:
+        events = sql.SQL("(SELECT COALESCE(json_agg(me), '[]') FROM matched_events me)")
+    else:
+        events = sql.SQL('NULL::json')
+
+    query = sql.SQL('SELECT {patients} AS patients, {events} AS events').format(
+        patients=patients, events=events
+    )
+    if ctes:
+        query = sql.SQL('WITH {} {}').format(sql.SQL(', ').join(ctes), query)
+
+    return query, dict(params)
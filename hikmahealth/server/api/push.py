@@ -0,0 +1,398 @@
+"""Keeps track of the pushes applied by the clients, so that a push retried
+after its response got lost isn't applied twice, and of the pushes queued to
+be applied in the background"""
+
+from __future__ import annotations
+
+import datetime
+import hashlib
+import logging
+import threading
+import uuid
+from typing import Any, Callable
+
+from flask import Flask
+from psycopg import Connection
+from psycopg.rows import dict_row
+from psycopg.types.json import Jsonb
+
+from hikmahealth.entity import core
+from hikmahealth.server import config
+from hikmahealth.server.client import db
+
+MAX_BATCH_ID_LENGTH = 128
+
+JOB_PENDING = 'pending'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+
+
+@core.dataentity
+class PushBatch(core.Entity):
+    id: str
+    payload_hash: str
+    response: dict
+
+
+@core.dataentity
+class PushJob(core.Entity):
+    id: str
+    batch_id: str | None
+    payload_hash: str
+    status: str
+    attempts: int
+    counts: dict
+    error: str | None
+    created_at: datetime.datetime
+    started_at: datetime.datetime | None
+    finished_at: datetime.datetime | None
+
+
+_JOB_COLUMNS = """
+    id::text, batch_id, payload_hash, status, attempts, counts, error,
+    created_at, started_at, finished_at
+"""
+
+
+def hash_payload(data: bytes) -> str:
+    """Returns the hash of the (decompressed) body of the push"""
+    return hashlib.sha256(data).hexdigest()
+
+
+def record_push_batch(
+    conn: Connection, batch_id: str, payload_hash: str, response: dict
+) -> PushBatch | None:
+    """Records the batch as applied, along with its `response`, as part of the
+    transaction applying it. So the batch is only recorded once committed.
+
+    Returns the batch already recorded with the same id, if any, in which case
+    nothing should be applied. When the same batch is being applied by another
+    transaction, this waits for it to complete first."""
+    with conn.cursor(row_factory=dict_row) as cur:
+        cur.execute(
+            """
+            INSERT INTO sync_push_batches (id, payload_hash, response)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (id) DO NOTHING
+            RETURNING id
+            """,
+            [batch_id, payload_hash, Jsonb(response)],
+        )
+        if cur.fetchone() is not None:
+            return None
+
+        cur.execute(
+            'SELECT id, payload_hash, response FROM sync_push_batches WHERE id = %s',
+            [batch_id],
+        )
+        row = cur.fetchone()
+
+    assert row is not None, 'recorded batch is missing'
+    return PushBatch(**row)
+
+
+def count_changes(body: dict[str, Any]) -> dict[str, dict[str, int]]:
+    """Number of records pushed per entity and action"""
+    return {
+        key: {
+            action: len(delta.get(action) or [])
+            for action in ('created', 'updated', 'deleted')
+        }
+        for key, delta in body.items()
+        if isinstance(delta, dict)
+    }
+
+
+def enqueue_push_job(
+    conn: Connection,
+    data: bytes,
+    body: dict[str, Any],
+    last_pulled_at: datetime.datetime,
+    batch_id: str | None = None,
+) -> PushJob:
+    """Persists the pushed `data` to be applied by the `PushWorker`.
+
+    When a job was already queued with the same `batch_id`, that job is returned
+    instead. Its `payload_hash` tells whether it holds the same changes. A job
+    that failed with the same changes is queued again, none of its changes
+    having been committed."""
+    with conn.cursor(row_factory=dict_row) as cur:
+        cur.execute(
+            """
+            INSERT INTO sync_push_jobs
+            (id, batch_id, payload, payload_hash, last_pulled_at, counts)
+            VALUES (%s, %s, %s, %s, %s, %s)
+            ON CONFLICT (batch_id) DO UPDATE SET
+                payload = EXCLUDED.payload,
+                last_pulled_at = EXCLUDED.last_pulled_at,
+                counts = EXCLUDED.counts,
+                status = %s,
+                attempts = 0,
+                error = NULL,
+                created_at = now(),
+                started_at = NULL,
+                heartbeat_at = NULL,
+                finished_at = NULL
+            WHERE sync_push_jobs.status = %s
+                AND sync_push_jobs.payload_hash = EXCLUDED.payload_hash
+            RETURNING {columns}
+            """.format(columns=_JOB_COLUMNS),
+            [
+                str(uuid.uuid4()),
+                batch_id,
+                data,
+                hash_payload(data),
+                last_pulled_at,
+                Jsonb(count_changes(body)),
+                JOB_PENDING,
+                JOB_FAILED,
+            ],
+        )
+        row = cur.fetchone()
+
+        if row is None:
+            cur.execute(
+                'SELECT {columns} FROM sync_push_jobs WHERE batch_id = %s'.format(
+                    columns=_JOB_COLUMNS
+                ),
+                [batch_id],
+            )
+            row = cur.fetchone()
+
+    assert row is not None, 'queued job is missing'
+    return PushJob(**row)
+
+
+def get_push_job(conn: Connection, job_id: str) -> PushJob | None:
+    try:
+        uuid.UUID(job_id)
+    except ValueError:
+        return None
+
+    with conn.cursor(row_factory=dict_row) as cur:
+        cur.execute(
+            'SELECT {columns} FROM sync_push_jobs WHERE id = %s'.format(
+                columns=_JOB_COLUMNS
+            ),
+            [job_id],
+        )
+        row = cur.fetchone()
+
+    if row is None:
+        return None
+
+    return PushJob(**row)
+
+
+def claim_push_job(
+    conn: Connection,
+) -> tuple[PushJob, bytes, datetime.datetime] | None:
+    """Marks the oldest pending job as running, and returns it along with its
+    payload and `last_pulled_at`.
+
+    Jobs whose worker hasn't sent a `heartbeat_push_job` for longer than
+    `config.SYNC_PUSH_JOB_LEASE` seconds are taken to belong to a worker that
+    stopped, and are claimed again, up to `config.SYNC_PUSH_JOB_MAX_ATTEMPTS`
+    times."""
+    lease = datetime.timedelta(seconds=config.SYNC_PUSH_JOB_LEASE)
+
+    with conn.cursor(row_factory=dict_row) as cur:
+        cur.execute(
+            """
+            UPDATE sync_push_jobs
+            SET status = %(failed)s,
+                error = 'stopped while being applied',
+                finished_at = now()
+            WHERE status = %(running)s
+                AND COALESCE(heartbeat_at, started_at) < now() - %(lease)s
+                AND attempts >= %(max_attempts)s
+            """,
+            dict(
+                failed=JOB_FAILED,
+                running=JOB_RUNNING,
+                lease=lease,
+                max_attempts=config.SYNC_PUSH_JOB_MAX_ATTEMPTS,
+            ),
+        )
+
+        cur.execute(
+            """
+            UPDATE sync_push_jobs
+            SET status = %(running)s,
+                attempts = attempts + 1,
+                started_at = now(),
+                heartbeat_at = now()
+            WHERE id = (
+                SELECT id FROM sync_push_jobs
+                WHERE status = %(pending)s
+                    OR (
+                        status = %(running)s
+                        AND COALESCE(heartbeat_at, started_at) < now() - %(lease)s
+                    )
+                ORDER BY created_at
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING {columns}, payload, last_pulled_at
+            """.format(columns=_JOB_COLUMNS),
+            dict(pending=JOB_PENDING, running=JOB_RUNNING, lease=lease),
+        )
+        row = cur.fetchone()
+
+    if row is None:
+        return None
+
+    payload = bytes(row.pop('payload'))
+    last_pulled_at = row.pop('last_pulled_at')
+    return PushJob(**row), payload, last_pulled_at
+
+
+def heartbeat_push_job(conn: Connection, job: PushJob):
+    """Extends the lease of the job, while it's being applied"""
+    conn.execute(
+        """
+        UPDATE sync_push_jobs SET heartbeat_at = now()
+        WHERE id = %s AND attempts = %s AND status = %s
+        """,
+        [job.id, job.attempts, JOB_RUNNING],
+    )
+
+
+def finish_push_job(conn: Connection, job: PushJob, error: str | None = None) -> bool:
+    """Marks the job as done, or as failed when there's an `error`.
+
+    Returns `False` when the job was claimed again since, by a worker that took
+    this one to have stopped, in which case it's left to that worker"""
+    cur = conn.execute(
+        """
+        UPDATE sync_push_jobs
+        SET status = %s, error = %s, finished_at = now()
+        WHERE id = %s AND attempts = %s AND status = %s
+        """,
+        [
+            JOB_DONE if error is None else JOB_FAILED,
+            error,
+            job.id,
+            job.attempts,
+            JOB_RUNNING,
+        ],
+    )
+    return cur.rowcount == 1
+
+
+class _Heartbeat:
+    """Sends the heartbeats of a job from a thread of its own, for as long as
+    the job is being applied"""
+
+    def __init__(self, job: PushJob):
+        self._job = job
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name=f'push-heartbeat-{job.id}', daemon=True
+        )
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def _run(self):
+        interval = max(config.SYNC_PUSH_JOB_LEASE / 3, 0.01)
+        while not self._stopped.wait(interval):
+            try:
+                with db.get_connection() as conn:
+                    heartbeat_push_job(conn, self._job)
+            except Exception:
+                logging.exception(f'failed to extend push job {self._job.id}')
+
+
+class _PushJobReclaimed(Exception):
+    """The job was claimed again while being applied, so its changes are rolled
+    back instead of committed"""
+
+
+type PushJobFunction = Callable[[Connection, PushJob, bytes, datetime.datetime], None]
+"""Applies the payload of the job, given along with its `last_pulled_at`"""
+
+
+class PushWorker:
+    """Applies the queued pushes one after the other, in a background thread.
+
+    The changes of a job are committed in the same transaction that marks the
+    job as done, so a job that fails, or whose worker stops, leaves none of its
+    changes committed. A job that fails is marked as failed, and is not retried
+    until its batch is pushed again."""
+
+    def __init__(self, apply: PushJobFunction):
+        self._apply = apply
+        self._app: Flask | None = None
+        self._thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+
+    def start(self, app: Flask):
+        """Starts the worker, unless it's already running"""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+
+            self._app = app
+            self._thread = threading.Thread(
+                target=self._run, name='push-worker', daemon=True
+            )
+            self._thread.start()
+
+    def notify(self):
+        """Wakes the worker up, for a job that was just queued"""
+        self._wakeup.set()
+
+    def run_once(self) -> bool:
+        """Applies the next queued job. Returns `False` when there was none"""
+        with db.get_connection() as conn:
+            claimed = claim_push_job(conn)
+
+        if claimed is None:
+            return False
+
+        job, payload, last_pulled_at = claimed
+        try:
+            with db.get_connection() as conn, conn.transaction():
+                with _Heartbeat(job) as heartbeat:
+                    self._apply(conn, job, payload, last_pulled_at)
+                    # stopped before the job's row is locked by this
+                    # transaction, which the heartbeat would wait on
+                    heartbeat.stop()
+
+                if not finish_push_job(conn, job):
+                    raise _PushJobReclaimed(job.id)
+        except _PushJobReclaimed:
+            logging.warning(f'push job {job.id} was claimed again, rolled back')
+        except Exception as err:
+            logging.exception(f'failed to apply push job {job.id}')
+            with db.get_connection() as conn:
+                finish_push_job(conn, job, error=str(err) or repr(err))
+
+        return True
+
+    def _run(self):
+        assert self._app is not None, 'worker started without an app'
+
+        while True:
+            try:
+                with self._app.app_context():
+                    found = self.run_once()
+            except Exception:
+                logging.exception('push worker failed to claim a job')
+                found = False
+
+            if not found:
+                self._wakeup.wait(config.SYNC_PUSH_JOB_POLL_INTERVAL)
+                self._wakeup.clear()
@@ -2,49 +2,17 @@ import psycopg
 
 # from psycopg.pool import ConnectionPool
 from psycopg_pool import ConnectionPool
+from flask import Flask, g, has_app_context
 from hikmahealth.server import config
 import logging
+import threading
 
-# _pool = None
-
-
-# def get_connection_pool():
-#     global _pool
-#     if _pool is None:
-#         try:
-#             _pool = ConnectionPool(
-#                 min_size=1,
-#                 max_size=10,
-#                 conninfo=dict(
-#                     host=config.PG_HOST,
-#                     port=config.PG_PORT,
-#                     dbname=config.PG_DB,
-#                     user=config.PG_USER,
-#                     password=config.PG_PASSWORD,
-#                     connect_timeout=10
-#                 )
-#             )
-#         except Exception as e:
-#             logging.error(f"Failed to create connection pool: {e}")
-#             raise
-
-#     return _pool
-
-
-# def get_connection():
-#     """Get a database connection from the pool with automatic reconnection"""
-#     try:
-#         pool = get_connection_pool()
-#         return pool.getconn()
-#     except Exception as e:
-#         logging.error(f"Database connection error: {e}")
-#         raise psycopg.OperationalError(
-#             "Failed to establish database connection")
+_pool: ConnectionPool | None = None
+_pool_lock = threading.Lock()
 
 
-def get_connection():
-	"""create a database connection instance"""
-	conn = psycopg.connect(
+def _connection_kwargs():
+	return dict(
 		host=config.PG_HOST,
 		port=config.PG_PORT,
 		dbname=config.PG_DB,
@@ -52,9 +20,166 @@ def get_connection():
 		password=config.PG_PASSWORD,
 	)
 
+
+def _reset_pooled_connection(conn: psycopg.Connection):
+	"""Restores the session defaults changed by whoever used the connection last"""
+	conn.isolation_level = None
+	conn.read_only = None
+	conn.autocommit = False
+
+
+def get_connection_pool() -> ConnectionPool:
+	"""Returns the connection pool, creating it on first use.
+
+	The pool is created lazily so that, when running with gevent, its worker
+	threads are created after the monkey patching in `pywsgi.py`"""
+	global _pool
+	if _pool is None:
+		with _pool_lock:
+			if _pool is None:
+				try:
+					_pool = ConnectionPool(
+						min_size=config.DB_POOL_MIN_SIZE,
+						max_size=config.DB_POOL_MAX_SIZE,
+						max_lifetime=config.DB_POOL_MAX_LIFETIME,
+						max_idle=config.DB_POOL_MAX_IDLE,
+						timeout=config.DB_POOL_TIMEOUT,
+						kwargs=_connection_kwargs() | dict(connect_timeout=10),
+						check=ConnectionPool.check_connection
+						if config.DB_POOL_CHECK
+						else None,
+						reset=_reset_pooled_connection,
+						name='hikmahealth',
+						open=True,
+					)
+				except Exception as e:
+					logging.error(f'Failed to create connection pool: {e}')
+					raise
+
+	return _pool
+
+
+def close_connection_pool():
+	"""Closes all the connections of the pool, if it was ever created"""
+	global _pool
+	with _pool_lock:
+		if _pool is not None:
+			_pool.close()
+			_pool = None
+
+
+def get_pool_stats() -> dict[str, int]:
+	"""Returns the usage statistics of the connection pool. Empty when the
+	pool is disabled or wasn't used yet"""
+	if _pool is None:
+		return dict()
+
+	return _pool.get_stats()
+
+
+class PooledConnection:
+	"""Connection checked out from the pool.
+
+	Behaves like the `psycopg.Connection` it wraps, except that leaving its
+	`with` block or calling `.close()` returns the connection to the pool
+	instead of closing it."""
+
+	def __init__(self, pool: ConnectionPool, conn: psycopg.Connection):
+		object.__setattr__(self, '_pool', pool)
+		object.__setattr__(self, '_conn', conn)
+
+	@property
+	def closed(self):
+		return self._conn is None or self._conn.closed
+
+	def _get_conn(self) -> psycopg.Connection:
+		if self._conn is None:
+			raise psycopg.OperationalError('the connection is closed')
+
+		return self._conn
+
+	def __getattr__(self, name: str):
+		return getattr(self._get_conn(), name)
+
+	def __setattr__(self, name: str, value):
+		setattr(self._get_conn(), name, value)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		if self.closed:
+			return
+
+		# same as `psycopg.Connection`
+		if exc_type:
+			try:
+				self._get_conn().rollback()
+			except Exception as exc2:
+				logging.warning(f'error ignored in rollback on {self}: {exc2}')
+		else:
+			self._get_conn().commit()
+
+		self.close()
+
+	def close(self):
+		"""Returns the connection to the pool. Uncommitted changes are rolled back"""
+		conn = self._conn
+		if conn is None:
+			return
+
+		object.__setattr__(self, '_conn', None)
+		self._pool.putconn(conn)
+
+
+def _get_pooled_connection():
+	conn = PooledConnection(get_connection_pool(), get_connection_pool().getconn())
+
+	# connections not closed by the end of the request
+	# are returned to the pool on teardown
+	if 'db_connections' not in g:
+		g.db_connections = []
+	g.db_connections.append(conn)
+
+	return conn
+
+
+def _return_pooled_connections(_err=None):
+	for conn in g.pop('db_connections', []):
+		conn.close()
+
+
+def register_connection_pool(app: Flask):
+	"""Returns the pooled connections left open by a request back to the pool,
+	once the request is done"""
+	app.teardown_appcontext(_return_pooled_connections)
+
+
+def get_connection():
+	"""create a database connection instance.
+
+	When the pool is enabled, connections requested while handling a request are
+	taken from the pool. Otherwise, a new connection is opened."""
+	if config.DB_POOL_ENABLED and has_app_context():
+		return _get_pooled_connection()
+
+	conn = psycopg.connect(**_connection_kwargs())
+
 	return conn
 
 
+def get_worker_connection():
+	"""Same as `get_connection`, for the threads that have no app context, such
+	as the workers of a pull. When the pool is enabled, the connection is taken
+	from the pool, and must be returned by closing it or leaving its `with`
+	block, since there is no request teardown to do it"""
+	if config.DB_POOL_ENABLED:
+		pool = get_connection_pool()
+		return PooledConnection(pool, pool.getconn())
+
+	return psycopg.connect(**_connection_kwargs())
+
+
 # Running this on test only
 if config.APP_ENV == config.EnvironmentType.Local:
 	# fun test connection to see it fail
@@ -90,3 +90,127 @@ if APP_ENV == EnvironmentType.Prod:
 PHOTOS_STORAGE_BUCKET = os.environ.get('PHOTOS_STORAGE_BUCKET')
 EXPORTS_STORAGE_BUCKET = os.environ.get('EXPORTS_STORAGE_BUCKET')
 LOCAL_PHOTO_STORAGE_DIR = os.environ.get('LOCAL_PHOTO_STORAGE_DIR', '/tmp/hikma_photos')
+
+
+def _get_env_flag(name: str, default: bool) -> bool:
+    """Reads a boolean environment variable, where `0` and `false` are false"""
+    value = os.environ.get(name, None)
+    if value is None:
+        return default
+
+    return value.lower() not in ('0', 'false')
+
+
+# Reads each synced table once per pull, labelling the rows as created, updated or
+# deleted in the database. Set to `false` to use the previous query-per-action pull
+SYNC_PULL_SINGLE_PASS = _get_env_flag('SYNC_PULL_SINGLE_PASS', True)
+
+# Reads the rows changed since the last pull from the `sync_changes` log, kept by
+# triggers on the synced tables, instead of scanning each table. The log holds the
+# last change of each row, for every way of pulling
+SYNC_PULL_FROM_LOG = _get_env_flag('SYNC_PULL_FROM_LOG', False)
+
+# Writes the pull response incrementally, entity by entity and row by row, as
+# opposed to building the entire set of changes in memory before responding
+SYNC_PULL_STREAMING = _get_env_flag('SYNC_PULL_STREAMING', False)
+
+# Number of rows fetched at a time from the database when streaming the pull
+SYNC_PULL_BATCH_SIZE = int(os.environ.get('SYNC_PULL_BATCH_SIZE', '1000'))
+
+# Upper bound to the number of rows returned in a single page of a paginated pull
+SYNC_PULL_MAX_PAGE_SIZE = int(os.environ.get('SYNC_PULL_MAX_PAGE_SIZE', '5000'))
+
+# Number of connections used to fetch the changes of the entities in parallel
+# during a pull. The connections share the same snapshot. 1 fetches them in turn.
+# With the pool enabled, they're taken from it, so `DB_POOL_MAX_SIZE` should leave
+# room for them
+SYNC_PULL_WORKERS = int(os.environ.get('SYNC_PULL_WORKERS', '1'))
+
+# Returns the version of the reference entities (forms, clinics, strings) with each
+# pull. Those the client already holds at their current version are not read
+SYNC_PULL_VERSIONS = _get_env_flag('SYNC_PULL_VERSIONS', True)
+
+# Only pulls the records of the patients seen at the clinic of the user (through
+# visits and appointments). Reference records, like forms, go to every device
+SYNC_PULL_CLINIC_SCOPED = _get_env_flag('SYNC_PULL_CLINIC_SCOPED', False)
+
+# Comma separated ids of the clinics the scoped pulls are restricted to, instead
+# of the clinic of the user
+SYNC_PULL_CLINIC_IDS = [
+    c.strip()
+    for c in os.environ.get('SYNC_PULL_CLINIC_IDS', '').split(',')
+    if c.strip()
+]
+
+# Copies the rows pushed for an entity to a staging table and merges them with a
+# single statement, instead of one statement per row
+SYNC_PUSH_BULK = _get_env_flag('SYNC_PUSH_BULK', True)
+
+# Queues the pushes sent with a `Prefer: respond-async` header, answering them
+# with `202 Accepted` right away. The changes are applied by a background worker
+SYNC_PUSH_ASYNC = _get_env_flag('SYNC_PUSH_ASYNC', True)
+
+# Seconds between the checks of the push worker for queued pushes. A push queued
+# by the same process wakes it up right away
+SYNC_PUSH_JOB_POLL_INTERVAL = float(os.environ.get('SYNC_PUSH_JOB_POLL_INTERVAL', '5'))
+
+# Seconds after which a push still being applied is taken to belong to a worker
+# that stopped, and is applied again. The worker applying a push extends it every
+# third of that time
+SYNC_PUSH_JOB_LEASE = int(os.environ.get('SYNC_PUSH_JOB_LEASE', '600'))
+
+# Number of times a queued push is attempted before being marked as failed
+SYNC_PUSH_JOB_MAX_ATTEMPTS = int(os.environ.get('SYNC_PUSH_JOB_MAX_ATTEMPTS', '3'))
+
+# Encodes the JSON responses with `orjson`, when installed. Either way, dates and
+# times are written in ISO 8601, except by the sync pulls, which keep the HTTP
+# date format of Flask's provider
+JSON_ORJSON = _get_env_flag('JSON_ORJSON', True)
+
+# Number of patients returned in a page of the admin patient list, when the page
+# size isn't given, and the upper bound to the page size asked for
+ADMIN_PATIENTS_PAGE_SIZE = int(os.environ.get('ADMIN_PATIENTS_PAGE_SIZE', '100'))
+ADMIN_PATIENTS_MAX_PAGE_SIZE = int(
+    os.environ.get('ADMIN_PATIENTS_MAX_PAGE_SIZE', '1000')
+)
+
+# Exports the metrics of the sync, in the Prometheus text format, on `/metrics`.
+# Requires a `METRICS_TOKEN`
+METRICS_ENABLED = _get_env_flag('METRICS_ENABLED', False)
+
+# Token the scrapes of `/metrics` must send as a `Authorization: Bearer` token
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', None)
+
+# Connection pool used by `db.get_connection()` while handling requests. When
+# disabled, every call opens a new connection
+DB_POOL_ENABLED = _get_env_flag('DB_POOL_ENABLED', False)
+DB_POOL_MIN_SIZE = int(os.environ.get('DB_POOL_MIN_SIZE', '1'))
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', '10'))
+# seconds a connection is kept around before being replaced
+DB_POOL_MAX_LIFETIME = float(os.environ.get('DB_POOL_MAX_LIFETIME', '3600'))
+# seconds an unused connection is kept before the pool shrinks back to min size
+DB_POOL_MAX_IDLE = float(os.environ.get('DB_POOL_MAX_IDLE', '600'))
+# seconds to wait for a connection when all of them are in use
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '30'))
+# checks the connection is still usable before handing it out
+DB_POOL_CHECK = _get_env_flag('DB_POOL_CHECK', True)
+
+# Seconds the credentials of a mobile user are trusted after being verified,
+# sparing repeated syncs the password check. 0 verifies them on every request
+AUTH_CREDENTIALS_CACHE_TTL = float(os.environ.get('AUTH_CREDENTIALS_CACHE_TTL', '300'))
+AUTH_CREDENTIALS_CACHE_SIZE = int(os.environ.get('AUTH_CREDENTIALS_CACHE_SIZE', '1024'))
+
+# Seconds the user behind a session token is remembered, sparing the admin
+# routes a lookup per request. 0 looks the token up on every request
+AUTH_TOKEN_CACHE_TTL = float(os.environ.get('AUTH_TOKEN_CACHE_TTL', '60'))
+AUTH_TOKEN_CACHE_SIZE = int(os.environ.get('AUTH_TOKEN_CACHE_SIZE', '1024'))
+
+# Sync payloads are compressed with gzip (or zstd, when `zstandard` is installed)
+# when the client accepts it. Smaller responses are sent as is
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', '1024'))
+COMPRESSION_GZIP_LEVEL = int(os.environ.get('COMPRESSION_GZIP_LEVEL', '6'))
+COMPRESSION_ZSTD_LEVEL = int(os.environ.get('COMPRESSION_ZSTD_LEVEL', '3'))
+# Upper bound to the size of a compressed request body, once decompressed
+COMPRESSION_MAX_DECOMPRESSED_SIZE = int(
+    os.environ.get('COMPRESSION_MAX_DECOMPRESSED_SIZE', str(512 * 1024 * 1024))
+)
@@ -0,0 +1,157 @@
+"""Negotiates the compression of request and response bodies, through the
+`Accept-Encoding` and `Content-Encoding` headers"""
+
+from functools import wraps
+from typing import IO, Any, Iterable, Iterator
+import gzip
+import json
+import zlib
+
+from flask import Request, Response, current_app, make_response, request
+
+from hikmahealth.server import config
+from hikmahealth.utils.errors import WebError
+
+try:
+    import zstandard
+except ImportError:
+    # zstd is only offered when `zstandard` is installed
+    zstandard = None
+
+
+GZIP = 'gzip'
+ZSTD = 'zstd'
+
+READ_CHUNK_SIZE = 64 * 1024
+
+_DECOMPRESSION_ERRORS: tuple[type[Exception], ...] = (zlib.error, OSError, EOFError)
+if zstandard is not None:
+    _DECOMPRESSION_ERRORS += (zstandard.ZstdError,)
+
+
+def supported_encodings() -> list[str]:
+    """Encodings understood by the server, in order of preference"""
+    if zstandard is not None:
+        return [ZSTD, GZIP]
+
+    return [GZIP]
+
+
+def _compressor(encoding: str):
+    if encoding == GZIP:
+        # `wbits` of 16 + 15 writes the gzip header and trailer
+        return zlib.compressobj(config.COMPRESSION_GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    if encoding == ZSTD and zstandard is not None:
+        return zstandard.ZstdCompressor(
+            level=config.COMPRESSION_ZSTD_LEVEL
+        ).compressobj()
+
+    raise ValueError(f'unsupported encoding {encoding}')
+
+
+def _decompressing_reader(encoding: str, stream: IO[bytes]) -> IO[bytes]:
+    if encoding == GZIP:
+        return gzip.GzipFile(fileobj=stream, mode='rb')
+
+    if encoding == ZSTD and zstandard is not None:
+        return zstandard.ZstdDecompressor().stream_reader(stream)
+
+    raise WebError(f'unsupported content encoding {encoding}', 415)
+
+
+def compress_chunks(chunks: Iterable[str | bytes], encoding: str) -> Iterator[bytes]:
+    """Compresses the `chunks` as they come"""
+    compressor = _compressor(encoding)
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+
+        out = compressor.compress(chunk)
+        if out:
+            yield out
+
+    yield compressor.flush()
+
+
+def compress_response(response: Response, req: Request) -> Response:
+    """Compresses the body of the response with the best of the encodings the
+    client accepts. Bodies smaller than `config.COMPRESSION_MIN_SIZE` are left
+    as is, while streamed bodies are compressed as they are written"""
+    response.vary.add('Accept-Encoding')
+
+    if (
+        response.status_code != 200
+        or 'Content-Encoding' in response.headers
+        or response.direct_passthrough
+    ):
+        return response
+
+    encoding = req.accept_encodings.best_match(supported_encodings())
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = compress_chunks(response.response, encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < config.COMPRESSION_MIN_SIZE:
+            return response
+
+        response.set_data(b''.join(compress_chunks([data], encoding)))
+
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def compressed(f):
+    """Compresses the responses of the route, when the client accepts it"""
+
+    @wraps(f)
+    def func(*args, **kwargs):
+        return compress_response(make_response(f(*args, **kwargs)), request)
+
+    return func
+
+
+def get_request_data(req: Request) -> bytes:
+    """Returns the body of the request, decompressing it as it's read when
+    sent with a `Content-Encoding`"""
+    encoding = req.headers.get('Content-Encoding', 'identity').strip().lower()
+    if encoding == 'identity':
+        return req.get_data()
+
+    reader = _decompressing_reader(encoding, req.stream)
+    max_size = config.COMPRESSION_MAX_DECOMPRESSED_SIZE
+
+    # read a bit at a time, so that a small body can't
+    # be inflated to more than `max_size`
+    out = bytearray()
+    try:
+        while True:
+            chunk = reader.read(READ_CHUNK_SIZE)
+            if not chunk:
+                break
+
+            out += chunk
+            if len(out) > max_size:
+                raise WebError('request body is too large', 413)
+    except _DECOMPRESSION_ERRORS as err:
+        raise WebError(f'failed to decompress request body: {err}', 400)
+
+    return bytes(out)
+
+
+def decode_json(data: bytes) -> Any:
+    """Decodes the JSON body returned by `get_request_data`, with the JSON
+    provider of the app"""
+    try:
+        return current_app.json.loads(data)
+    except json.JSONDecodeError as err:
+        raise WebError(f'failed to decode JSON body: {err}', 400)
+
+
+def get_request_json(req: Request) -> Any:
+    """Same as `req.get_json(force=True)`, for bodies that may be compressed"""
+    return decode_json(get_request_data(req))
@@ -0,0 +1,153 @@
+"""JSON providers of the Flask app, encoding the responses with `orjson` when
+it's installed and the standard library otherwise.
+
+The responses of the app write dates and times in ISO 8601. The pulls of the
+mobile sync keep writing dates and datetimes in the HTTP date format, as by
+Flask's provider, which the mobile clients parse (see `sync_json`)"""
+
+from datetime import date, datetime, time, timezone
+from decimal import Decimal
+from typing import Any
+import dataclasses
+import uuid
+
+from flask import Flask, Response
+from flask.json.provider import DefaultJSONProvider
+
+from hikmahealth.server import config
+
+try:
+    import orjson
+except ImportError:
+    # responses are encoded by the standard library when `orjson` isn't installed
+    orjson = None
+
+
+_DAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+_MONTHS = (
+    '',
+    'Jan',
+    'Feb',
+    'Mar',
+    'Apr',
+    'May',
+    'Jun',
+    'Jul',
+    'Aug',
+    'Sep',
+    'Oct',
+    'Nov',
+    'Dec',
+)
+
+
+def http_date(o: date) -> str:
+    """Same as `werkzeug.http.http_date`, used by Flask's provider, without
+    going through `email.utils`. Naive datetimes are taken to be in UTC"""
+    if isinstance(o, datetime):
+        if o.tzinfo is not None:
+            o = o.astimezone(timezone.utc)
+    else:
+        o = datetime(o.year, o.month, o.day)
+
+    return '%s, %02d %s %04d %02d:%02d:%02d GMT' % (
+        _DAYS[o.weekday()],
+        o.day,
+        _MONTHS[o.month],
+        o.year,
+        o.hour,
+        o.minute,
+        o.second,
+    )
+
+
+def _default(o: Any) -> Any:
+    """Converts the values that JSON has no type for"""
+    if isinstance(o, (datetime, date, time)):
+        return o.isoformat()
+
+    if isinstance(o, (uuid.UUID, Decimal)):
+        return str(o)
+
+    if dataclasses.is_dataclass(o) and not isinstance(o, type):
+        return dataclasses.asdict(o)
+
+    if hasattr(o, '__html__'):
+        return str(o.__html__())
+
+    raise TypeError(f'Object of type {type(o).__name__} is not JSON serializable')
+
+
+def _http_date_default(o: Any) -> Any:
+    """Same as `_default`, writing dates and datetimes as Flask's provider does.
+    Also used for the values of the msgpack pulls"""
+    if isinstance(o, date):
+        return http_date(o)
+
+    return _default(o)
+
+
+class IsoJSONProvider(DefaultJSONProvider):
+    """Same as Flask's provider, except that dates and times are written in
+    ISO 8601 instead of the HTTP date format"""
+
+    default = staticmethod(_default)
+
+
+class OrjsonProvider(IsoJSONProvider):
+    """Encodes with `orjson`, which writes dates, times and UUIDs by itself.
+    Keys are sorted, as by Flask's provider"""
+
+    passthrough_datetime = False
+    """Whether dates and times are converted by `default` instead"""
+
+    def _option(self, indent: bool = False) -> int:
+        option = orjson.OPT_NON_STR_KEYS
+        if self.passthrough_datetime:
+            option |= orjson.OPT_PASSTHROUGH_DATETIME
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return option
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        return orjson.dumps(obj, default=self.default, option=self._option()).decode()
+
+    def loads(self, s: str | bytes, **kwargs: Any) -> Any:
+        return orjson.loads(s)
+
+    def response(self, *args: Any, **kwargs: Any) -> Response:
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = self.compact is False or (self.compact is None and self._app.debug)
+
+        # written as bytes, without going through `str`
+        data = orjson.dumps(obj, default=self.default, option=self._option(indent))
+        return self._app.response_class(data + b'\n', mimetype=self.mimetype)
+
+
+class HttpDateOrjsonProvider(OrjsonProvider):
+    """Encodes with `orjson`, writing dates and datetimes as Flask's provider"""
+
+    default = staticmethod(_http_date_default)
+    passthrough_datetime = True
+
+
+_SYNC_JSON_EXTENSION = 'hikma_sync_json'
+
+
+def sync_json(app: Flask) -> DefaultJSONProvider:
+    """Returns the provider encoding the pulls of the mobile sync, which write
+    dates and datetimes in the HTTP date format"""
+    return app.extensions[_SYNC_JSON_EXTENSION]
+
+
+def register_json_provider(app: Flask):
+    """Sets the JSON providers of the app, using `orjson` when it's installed
+    and `config.JSON_ORJSON` is set"""
+    if config.JSON_ORJSON and orjson is not None:
+        app.json = OrjsonProvider(app)
+        app.extensions[_SYNC_JSON_EXTENSION] = HttpDateOrjsonProvider(app)
+    else:
+        app.json = IsoJSONProvider(app)
+        app.extensions[_SYNC_JSON_EXTENSION] = DefaultJSONProvider(app)
@@ -0,0 +1,203 @@
+"""Metrics of the server, exported in the Prometheus text format.
+
+The metrics are kept in memory, per process. With several worker processes,
+each one has to be scraped on its own."""
+
+from __future__ import annotations
+
+from contextlib import contextmanager
+import hmac
+import time
+from typing import Iterable, Iterator, TypeVar
+
+from flask import Flask, Response, request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+)
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.registry import Collector
+
+from hikmahealth.server import config
+from hikmahealth.server.client import db
+from hikmahealth.utils.errors import WebError
+
+T = TypeVar('T')
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+"""Buckets of the durations, in seconds"""
+
+SIZE_BUCKETS = tuple(1024 * 4**n for n in range(11))
+"""Buckets of the sizes, in bytes, from 1KB to 1GB"""
+
+registry = CollectorRegistry()
+
+sync_request_duration = Histogram(
+    'hikma_sync_request_duration_seconds',
+    'Time taken to handle a sync request',
+    ('operation', 'clinic', 'status'),
+    buckets=DURATION_BUCKETS,
+    registry=registry,
+)
+sync_response_size = Histogram(
+    'hikma_sync_response_size_bytes',
+    'Size of the body of the sync responses, as sent',
+    ('operation',),
+    buckets=SIZE_BUCKETS,
+    registry=registry,
+)
+sync_pull_entity_duration = Histogram(
+    'hikma_sync_pull_entity_duration_seconds',
+    'Time taken to read the changes of an entity during a pull',
+    ('entity',),
+    buckets=DURATION_BUCKETS,
+    registry=registry,
+)
+sync_pull_rows = Counter(
+    'hikma_sync_pull_rows_total',
+    'Records pulled, per entity and action',
+    ('entity', 'action'),
+    registry=registry,
+)
+sync_push_entity_duration = Histogram(
+    'hikma_sync_push_entity_duration_seconds',
+    'Time taken to apply the changes pushed to an entity',
+    ('entity',),
+    buckets=DURATION_BUCKETS,
+    registry=registry,
+)
+sync_push_rows = Counter(
+    'hikma_sync_push_rows_total',
+    'Records pushed, per entity and action',
+    ('entity', 'action'),
+    registry=registry,
+)
+sync_errors = Counter(
+    'hikma_sync_errors_total',
+    'Failures to pull or push the changes of an entity',
+    ('operation', 'entity'),
+    registry=registry,
+)
+
+_METRICS = (
+    sync_request_duration,
+    sync_response_size,
+    sync_pull_entity_duration,
+    sync_pull_rows,
+    sync_push_entity_duration,
+    sync_push_rows,
+    sync_errors,
+)
+
+PULL = 'pull'
+PUSH = 'push'
+
+
+def clear():
+    """Resets all the metrics"""
+    for metric in _METRICS:
+        metric.clear()
+
+
+def _entity_duration(operation: str) -> Histogram:
+    return sync_pull_entity_duration if operation == PULL else sync_push_entity_duration
+
+
+@contextmanager
+def observe_sync_entity(operation: str, entity: str):
+    """Observes the time taken to pull or push the changes of the entity in the
+    `with` block, and counts its failures"""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        sync_errors.labels(operation=operation, entity=entity).inc()
+        raise
+    finally:
+        _entity_duration(operation).labels(entity=entity).observe(
+            time.perf_counter() - start
+        )
+
+
+def observe_sync_entity_reads(
+    operation: str, entity: str, items: Iterable[T]
+) -> Iterator[T]:
+    """Passes the `items` of the entity through, like `observe_sync_entity`,
+    only observing the time taken to read them. The time the consumer spends
+    between two items, such as writing them to a slow client, isn't counted"""
+    items = iter(items)
+    elapsed = 0.0
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(items)
+            except StopIteration:
+                break
+            finally:
+                elapsed += time.perf_counter() - start
+
+            yield item
+    except Exception:
+        sync_errors.labels(operation=operation, entity=entity).inc()
+        raise
+    finally:
+        _entity_duration(operation).labels(entity=entity).observe(elapsed)
+
+
+def count_sync_rows(
+    operation: str, entity: str, created: int, updated: int, deleted: int
+):
+    rows = sync_pull_rows if operation == PULL else sync_push_rows
+    for action, count in (
+        ('created', created),
+        ('updated', updated),
+        ('deleted', deleted),
+    ):
+        if count > 0:
+            rows.labels(entity=entity, action=action).inc(count)
+
+
+class _PoolCollector(Collector):
+    """Reads the statistics of the connection pool at the time of the scrape"""
+
+    def collect(self):
+        stats = db.get_pool_stats()
+        if len(stats) == 0:
+            return
+
+        gauge = GaugeMetricFamily(
+            'hikma_db_pool',
+            'Statistics of the database connection pool',
+            labels=('stat',),
+        )
+        for stat, value in sorted(stats.items()):
+            gauge.add_metric((stat,), value)
+
+        yield gauge
+
+
+registry.register(_PoolCollector())
+
+
+def get_metrics():
+    token = request.headers.get('Authorization', '').removeprefix('Bearer ')
+    if not hmac.compare_digest(token.encode(), config.METRICS_TOKEN.encode()):
+        raise WebError('invalid metrics token', 401)
+
+    return Response(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
+
+
+def register_metrics(app: Flask):
+    """Exports the metrics on `/metrics` when enabled. Scrapes must send the
+    `METRICS_TOKEN`, without which the metrics aren't exported"""
+    if not config.METRICS_ENABLED:
+        return
+
+    if not config.METRICS_TOKEN:
+        raise Exception('METRICS_ENABLED is set without a METRICS_TOKEN.')
+
+    app.add_url_rule('/metrics', 'metrics', get_metrics, methods=['GET'])
@@ -2,7 +2,7 @@
 
 from flask import Request, request
 from functools import wraps
-from typing import Set, Dict, TypeVar, Generic
+from typing import Iterable, Set, Dict, TypeVar, Generic
 
 from hikmahealth.utils.errors import WebError
 from collections import defaultdict
@@ -60,3 +60,21 @@ def pluck_optional_data_keys(req: Request, optional_keys: set[str]):
 			plucked_opts.append((k, valuemaybe))
 
 	return dict(plucked_opts)
+
+
+def buffered_stream(chunks: Iterable[str], buffer_size: int = 64 * 1024):
+	"""Joins the small `chunks` of a streamed response to writes of
+	about `buffer_size` characters"""
+	buffer = []
+	size = 0
+	for chunk in chunks:
+		buffer.append(chunk)
+		size += len(chunk)
+
+		if size >= buffer_size:
+			yield ''.join(buffer)
+			buffer = []
+			size = 0
+
+	if buffer:
+		yield ''.join(buffer)
@@ -1,16 +1,18 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
 from datetime import datetime, timezone
 import logging
 from flask import Blueprint, request, jsonify
 
 
-from hikmahealth.server.api import middleware, auth
+from hikmahealth.server import config
+from hikmahealth.server.api import middleware, auth, explorer
 from hikmahealth.server.client import db
 from hikmahealth.server.helpers import web as webhelper
 
 from hikmahealth.entity import hh
 import hikmahealth.entity.fields as f
 
-from hikmahealth.utils.misc import convert_dict_keys_to_snake_case, convert_operator
+from hikmahealth.utils.misc import convert_dict_keys_to_snake_case
 from hikmahealth.utils.errors import WebError
 from psycopg import Error as PostgresError
 
@@ -142,6 +144,8 @@ def OLD_delete_user(u: auth.User):
         with conn.cursor(row_factory=class_row(auth.User)) as cur:
             all_users = cur.execute("""SELECT * FROM users""").fetchall()
 
+    auth.invalidate_cached_credentials(email=params['email'])
+
     return jsonify({'users': all_users})
 
 
@@ -150,30 +154,36 @@ def OLD_delete_user(u: auth.User):
 def delete_user(_, uid: str):
     with db.get_connection() as conn:
         with conn.cursor() as cur:
+            cur.execute('DELETE FROM tokens WHERE user_id = %s', (uid,))
             cur.execute(
                 """
                 DELETE FROM users WHERE id = %s;
                 """,
                 (uid,),
             )
+            deleted = cur.rowcount > 0
 
-            if cur.rowcount > 0:
-                return jsonify({
-                    'ok': True,
-                    'message': 'user deleted',
-                    'details': dict(
-                        uid=uid,
-                    ),
-                })
+    if deleted:
+        # once committed, so that the user and its tokens can't be cached
+        # again in between
+        auth.invalidate_cached_credentials(user_id=uid)
+        auth.invalidate_cached_tokens(user_id=uid)
+        return jsonify({
+            'ok': True,
+            'message': 'user deleted',
+            'details': dict(
+                uid=uid,
+            ),
+        })
 
-            else:
-                return jsonify(
-                    {
-                        'ok': True,
-                        'message': 'no such user record. might have already been deleted',
-                    },
-                    208,
-                )
+    else:
+        return jsonify(
+            {
+                'ok': True,
+                'message': 'no such user record. might have already been deleted',
+            },
+            208,
+        )
 
 
 @dataclass
@@ -198,6 +208,8 @@ def OLD_change_user_password(_):
                 [new_password_hashed, chg.email],
             )
 
+    auth.invalidate_cached_credentials(email=chg.email)
+
     return jsonify({'ok': True})
 
 
@@ -218,6 +230,8 @@ def change_user_password(_, uid: str):
                 [new_password_hashed, uid],
             )
 
+    auth.invalidate_cached_credentials(user_id=uid)
+
     return jsonify({
         'ok': True,
         'message': 'updated user password',
@@ -262,6 +276,8 @@ def update_user_info(_, uid: str):
 
             conn.commit()
 
+        auth.invalidate_cached_credentials(user_id=uid)
+
         return jsonify({
             'ok': True,
             'message': 'User information updated successfully',
@@ -279,13 +295,70 @@ def update_user_info(_, uid: str):
         return jsonify({'error': 'An unexpected error occurred'}), 500
 
 
+def _get_patients_page_size() -> int:
+    """Returns the size of the page of patients asked for, capped to
+    `config.ADMIN_PATIENTS_MAX_PAGE_SIZE`. `count` is the previous name of
+    `page_size`"""
+    page_size = request.args.get('page_size', request.args.get('count', None))
+    if page_size is None:
+        return config.ADMIN_PATIENTS_PAGE_SIZE
+
+    if not page_size.isnumeric() or int(page_size) < 1:
+        raise WebError('page_size must be a positive number', 400)
+
+    return min(int(page_size), config.ADMIN_PATIENTS_MAX_PAGE_SIZE)
+
+
+def _encode_patients_page_token(position: tuple[datetime, str]) -> str:
+    updated_at, patient_id = position
+    payload = dict(at=updated_at.isoformat(), id=patient_id)
+    return urlsafe_b64encode(json.dumps(payload).encode()).decode()
+
+
+def _decode_patients_page_token(token: str) -> tuple[datetime, str]:
+    """Returns the position `(updated_at, id)` encoded in the token"""
+    try:
+        payload = json.loads(urlsafe_b64decode(token.encode()))
+        updated_at = utc.from_iso8601(payload['at'])
+        patient_id = str(uuid.UUID(payload['id']))
+    except Exception:
+        raise WebError('invalid page_token', 400)
+
+    return updated_at, patient_id
+
+
 @admin_api.route('/all_patients', methods=['GET'])
 @api.route('/patients', methods=['GET'])
 @middleware.authenticated_with_role(['admin', 'provider', 'super_admin'])
 def get_patients(_):
-    count = request.args.get('count')
-    patients = hh.Patient.get_all_with_attributes(count)
-    return jsonify({'patients': patients})
+    """Returns a page of the patients, most recently updated first.
+
+    The next page is read by sending back the `next_page_token` of the response,
+    which is `null` on the last page. With `total=estimate`, the response also
+    holds an estimate of the number of patients"""
+    page_size = _get_patients_page_size()
+
+    after = None
+    page_token = request.args.get('page_token', None)
+    if page_token is not None:
+        after = _decode_patients_page_token(page_token)
+
+    with db.get_connection() as conn:
+        patients, position = hh.Patient.get_page_with_attributes(
+            conn, page_size, after=after
+        )
+
+        response = {
+            'patients': patients,
+            'next_page_token': _encode_patients_page_token(position)
+            if position is not None
+            else None,
+        }
+
+        if request.args.get('total', None) == 'estimate':
+            response['total_estimate'] = hh.Patient.estimate_count(conn)
+
+    return jsonify(response)
     # with db.get_connection() as conn:
     #     with conn.cursor(row_factory=dict_row) as cur:
     #         patients = cur.execute(patient_with_attrs_query).fetchall()
@@ -493,6 +566,23 @@ def get_patient_events(_, id: str):
     return jsonify(events)
 
 
+def _encode_search_page_token(offset: int) -> str:
+    return urlsafe_b64encode(json.dumps(dict(offset=offset)).encode()).decode()
+
+
+def _decode_search_page_token(token: str) -> int:
+    """Returns the number of search results to skip, encoded in the token"""
+    try:
+        offset = int(json.loads(urlsafe_b64decode(token.encode()))['offset'])
+    except Exception:
+        raise WebError('invalid page_token', 400)
+
+    if offset < 0:
+        raise WebError('invalid page_token', 400)
+
+    return offset
+
+
 @admin_api.route('/search_patients', methods=['POST'])
 @api.route('/search/patients', methods=['GET'])
 @middleware.authenticated_admin
@@ -505,14 +595,25 @@ def search_patients(_):
         query = searchparams.get('query')
 
     if not query:
-        return jsonify({'patients': []})
+        return jsonify({'patients': [], 'next_page_token': None})
+
+    page_size = _get_patients_page_size()
+    offset = 0
+    page_token = request.args.get('page_token', None)
+    if page_token is not None:
+        offset = _decode_search_page_token(page_token)
 
-    # search_query = f"%{query}%"
+    # reads one more patient, to tell whether there's a next page
     patients: list[dict] = list()
     with db.get_connection() as conn:
-        patients = hh.Patient.search(query, conn)
+        patients = hh.Patient.search(query, conn, limit=page_size + 1, offset=offset)
 
-    return jsonify({'patients': patients})
+    next_page_token = None
+    if len(patients) > page_size:
+        patients = patients[:page_size]
+        next_page_token = _encode_search_page_token(offset + page_size)
+
+    return jsonify({'patients': patients, 'next_page_token': next_page_token})
 
 
 @admin_api.route('/summary_stats', methods=['GET'])
@@ -1359,254 +1460,17 @@ def explore_data(_):
         if not all(key in filters for key in required_keys):
             return jsonify({'error': 'Missing required fields'}), 400
 
-        results = {}
-
-        patient_ids = set()
-
-        # Process the filters
-        if filters['event'] and isinstance(filters['event'], list):
-            # Event filters' fieldId is ';' separated like: 'formId;fieldId'
-            # The operators and values are as they are expressed in the patients filter
-            events_results = []  # Store results outside the connection block
-            with db.get_connection() as conn:
-                with conn.cursor(row_factory=dict_row) as cur:
-                    for event_filter in filters['event']:
-                        operator = convert_operator(event_filter['operator'])
-                        form_id, field_id = event_filter['fieldId'].split(';')
-                        query = """
-                            SELECT e.*
-                            FROM events e
-                            WHERE e.form_id = %s AND e.is_deleted = FALSE
-                        """
-                        params = [form_id]
-
-                        print('OPERATOR: ', operator)
-                        print('FIELD ID: ', field_id)
-
-                        if operator == '=':
-                            query += """
-                                AND EXISTS (
-                                    SELECT 1 FROM jsonb_array_elements(e.form_data::jsonb) AS field
-                                    WHERE field->>'fieldId' = %s AND field->>'value' = %s
-                                )
-                            """
-                            params.extend([field_id, str(event_filter['value'])])
-                        elif operator in ['ILIKE', 'LIKE']:
-                            query += """
-                                AND EXISTS (
-                                    SELECT 1 FROM jsonb_array_elements(e.form_data::jsonb) AS field
-                                    WHERE field->>'fieldId' = %s AND field->>'value' ILIKE %s
-                                )
-                            """
-                            params.extend([field_id, f'%{event_filter["value"]}%'])
-                        elif operator in ['<', '>', '<=', '>=', '!=']:
-                            input_type_query = "field->>'value' {0} %s".format(operator)
-                            value = str(event_filter['value'])
-
-                            print('VALUE: ', value)
-
-                            # dataType is one of: number, text, date or boolean
-                            if event_filter['dataType'] == 'date':
-                                # Handle ISO format date strings by casting through timestamp
-                                input_type_query = """
-                                    field->>'value' IS NOT NULL
-                                    AND field->>'value' != ''
-                                    AND (field->>'value')::timestamp {0} %s::timestamp
-                                """.format(operator)
-                            elif event_filter['dataType'] == 'number':
-                                input_type_query = """
-                                    field->>'value' IS NOT NULL
-                                    AND field->>'value' != ''
-                                    AND field->>'value'::numeric {0} %s::numeric
-                                """.format(operator)
-                            elif event_filter['dataType'] == 'boolean':
-                                input_type_query = (
-                                    "field->>'value'::boolean {0} %s::boolean".format(
-                                        operator
-                                    )
-                                )
-
-                            query += """
-                                AND EXISTS (
-                                    SELECT 1 FROM jsonb_array_elements(e.form_data::jsonb) AS field
-                                    WHERE field->>'fieldId' = %s
-                                    AND {1}
-                                )
-                            """.format(operator, input_type_query)
-                            params.extend([field_id, value])
-                        else:
-                            query += """
-                                AND EXISTS (
-                                    SELECT 1 FROM jsonb_array_elements(e.form_data::jsonb) AS field
-                                 WHERE field->>'fieldId' = %s AND field->>'value' {} %s
-                                )
-                            """.format(operator)
-                            params.extend([field_id, str(event_filter['value'])])
-
-                        cur.execute(query, params)
-                        events_results.extend(cur.fetchall())
-
-            # Process results after connection is closed
-            results['events'] = events_results
-            for event in events_results:
-                patient_ids.add(event['patient_id'])
-
-        if filters['appointment']:
-            pass
-
-        if filters['prescription']:
-            pass
-
-        print('patient_ids', patient_ids)
-
-        # Process the patient filter last, to take into account any of the other filters
-        # including any patient ids that are explicitly set to be limited to
-        # TODO: If the patient ids is not empty, only return patients that are in that set
-        if filters['patient']:
-            patient_filter = filters['patient']
-            with db.get_connection() as conn:
-                # base_query = """
-                #     SELECT DISTINCT p.*
-                #     FROM patients p
-                # """
-                base_query = """
-                    WITH distinct_patients AS (
-                        SELECT DISTINCT p.*
-                        FROM patients p
-                    )
-                    SELECT dp.id,
-                           dp.given_name,
-                           dp.surname,
-                           dp.date_of_birth,
-                           dp.sex,
-                           dp.camp,
-                           dp.citizenship,
-                           dp.hometown,
-                           dp.phone,
-                           dp.government_id,
-                           dp.external_patient_id,
-                           dp.created_at,
-                           dp.updated_at,
-                           dp.last_modified,
-                           dp.server_created_at,
-                           dp.deleted_at,
-                    COALESCE(json_object_agg(
-                        pa.attribute_id,
-                        json_build_object(
-                            'attribute', pa.attribute,
-                            'number_value', pa.number_value,
-                            'string_value', pa.string_value,
-                            'date_value', pa.date_value,
-                            'boolean_value', pa.boolean_value
-                        )
-                    ) FILTER (WHERE pa.attribute_id IS NOT NULL), '{}') AS additional_attributes
-                    FROM distinct_patients dp
-                    LEFT JOIN patient_additional_attributes pa ON dp.id = pa.patient_id AND pa.is_deleted = false
-                """
+        # with `returnEvents` false, only the patients having a matching event
+        # are returned, instead of the events themselves
+        query, params = explorer.compile_filters(
+            filters, return_events=filters.get('returnEvents', True) is not False
+        )
 
-                where_clauses = []
-                params = {}
-
-                # Process base fields
-                if patient_filter.get('baseFields'):
-                    for rule in patient_filter['baseFields']:
-                        operator = convert_operator(rule['operator'])
-                        param_name = f'p_{rule["id"]}'
-                        where_clauses.append(
-                            f'dp.{rule["field"]} {operator} %({param_name})s'
-                        )
-                        # Add wildcards for contains/does not contain operators
-                        if operator in ('ILIKE', 'NOT ILIKE'):
-                            params[param_name] = f'%{rule["value"]}%'
-                        else:
-                            params[param_name] = rule['value']
-
-                # Process attribute fields
-                if patient_filter.get('attributeFields'):
-                    for rule in patient_filter['attributeFields']:
-                        join_alias = f'paa_{rule["id"].replace("-", "_")}'
-                        base_query += f"""
-                            LEFT JOIN patient_additional_attributes {join_alias}
-                            ON dp.id = {join_alias}.patient_id
-                            AND {join_alias}.attribute_id = %(attr_id_{join_alias})s
-                            AND {join_alias}.is_deleted = false
-                        """
-                        params[f'attr_id_{join_alias}'] = rule['fieldId']
-
-                        operator = convert_operator(rule['operator'])
-                        param_name = f'a_{rule["id"]}'
-
-                        # Build the COALESCE expression to check all possible value types
-                        value_expr = f'COALESCE({join_alias}.string_value, CAST({join_alias}.number_value AS TEXT), CAST({join_alias}.boolean_value AS TEXT), CAST({join_alias}.date_value AS TEXT))'
-
-                        where_clauses.append(
-                            f'{value_expr} {operator} %({param_name})s'
-                        )
-
-                        # Add wildcards for contains/does not contain operators
-                        if operator in ('ILIKE', 'NOT ILIKE'):
-                            params[param_name] = f'%{rule["value"]}%'
-                        else:
-                            params[param_name] = rule['value']
-
-                # Add patient_ids filter if other filters exist
-                other_filters_exist = (
-                    isinstance(filters['event'], list)
-                    and len(filters['event']) > 0
-                    or filters['appointment']
-                    or filters['prescription']
-                )
-                if other_filters_exist:
-                    where_clauses.append('dp.id = ANY(%(patient_ids)s)')
-                    params['patient_ids'] = list(patient_ids)
-
-                # Add all WHERE conditions at once if any exist
-                if where_clauses:
-                    base_query += ' WHERE ' + ' AND '.join(where_clauses)
-
-                # Add GROUP BY since we're using aggregation
-                base_query += """
-                    GROUP BY dp.id,
-                           dp.given_name,
-                           dp.surname,
-                           dp.date_of_birth,
-                           dp.sex,
-                           dp.camp,
-                           dp.citizenship,
-                           dp.hometown,
-                           dp.phone,
-                           dp.government_id,
-                           dp.external_patient_id,
-                           dp.created_at,
-                           dp.updated_at,
-                           dp.last_modified,
-                           dp.server_created_at,
-                           dp.deleted_at
-                """
+        with db.get_connection() as conn:
+            with conn.cursor(row_factory=dict_row) as cur:
+                row = cur.execute(query, params).fetchone()
 
-                with conn.cursor(row_factory=dict_row) as cur:
-                    cur.execute(base_query, params)
-                    patients = cur.fetchall()
-
-                    # Process the results
-                    for patient in patients:
-                        # Convert datetime objects to ISO format strings
-                        for key in [
-                            'created_at',
-                            'updated_at',
-                            'last_modified',
-                            'deleted_at',
-                        ]:
-                            if patient[key]:
-                                patient[key] = patient[key].isoformat()
-
-                        # Convert date objects to ISO format strings
-                        if patient['date_of_birth']:
-                            patient['date_of_birth'] = patient[
-                                'date_of_birth'
-                            ].isoformat()
-
-                    results['patients'] = patients
+        results = {k: row[k] for k in ('events', 'patients') if row[k] is not None}
 
         return jsonify({
             'ok': True,
@@ -1636,6 +1500,10 @@ def explore_data(_):
 # START OF DATABASE IMPORT & EXPORT ENDPOINTS
 # =============================================================================
 
+# columns kept up to date by the database from other tables, which are left out
+# of the exports, and ignored when imported
+_DERIVED_COLUMNS = {hh.Patient.TABLE_NAME: hh.Patient.SYNC_EXCLUDED_COLUMNS}
+
 
 @api.get('/database/export')
 @middleware.authenticated_admin
@@ -1670,6 +1538,9 @@ def export_full_database(_):
                         """
                     )
                     results = cur.fetchall()
+                    for row in results:
+                        for column in _DERIVED_COLUMNS.get(table, ()):
+                            row.pop(column, None)
                     data[table] = results
 
                 return jsonify({
@@ -1754,7 +1625,11 @@ def import_full_database(_):
                     if not records:
                         continue
 
-                    columns = records[0].keys()
+                    columns = [
+                        col
+                        for col in records[0].keys()
+                        if col not in _DERIVED_COLUMNS.get(table_name, ())
+                    ]
                     column_str = ', '.join(f'"{col}"' for col in columns)
                     value_str = ', '.join(f'%({col})s' for col in columns)
 
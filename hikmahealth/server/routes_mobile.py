@@ -1,13 +1,31 @@
+from functools import wraps
 from io import BytesIO
 import logging
 import os
 from uuid import uuid1
 from boto3 import resource
-from flask import Blueprint, request, Request, jsonify, abort, send_file
+from flask import (
+    Blueprint,
+    Response,
+    current_app,
+    request,
+    Request,
+    jsonify,
+    abort,
+    g,
+    make_response,
+    send_file,
+    stream_with_context,
+    url_for,
+)
 from psycopg import Connection
 from psycopg.rows import dict_row
 
-from hikmahealth.entity.sync import SyncToClient
+from hikmahealth.entity.sync import (
+    SyncToClient,
+    get_delta_records_concurrently,
+    get_sync_versions,
+)
 from hikmahealth.server.client.keeper import get_keeper
 from hikmahealth.server.client.resources import (
     ResourceManager,
@@ -16,24 +34,32 @@ from hikmahealth.server.client.resources import (
     get_resource_manager,
 )
 from hikmahealth.server.helpers import web as webhelper
+from hikmahealth.server.helpers import compression
+from hikmahealth.server.helpers import metrics
+from hikmahealth.server.helpers import json_provider
 
 from hikmahealth.server.api.auth import User
 from hikmahealth.server.api import auth as auth
+from hikmahealth.server.api import push
+from hikmahealth.sync.errors import SyncPushError
 from hikmahealth.utils.errors import WebError
 
 import time
-from base64 import b64decode
+from base64 import b64decode, urlsafe_b64decode, urlsafe_b64encode
 
 from hikmahealth.utils.datetime import utc
 from hikmahealth.server.client import db
+from hikmahealth.server import config
 
 from hikmahealth.entity import hh
 from hikmahealth import sync
 
 from datetime import datetime
 
-from typing import Iterable
+from typing import Any, Iterable
 from collections import defaultdict
+import json
+import msgpack
 import traceback
 
 
@@ -73,10 +99,26 @@ def _get_authenticated_user_from_request(request: Request) -> User:
     # Split the decoded string into email and password
     email, password = decoded_username_password.split(':')
 
-    u = auth.get_user_from_email(email, password)
+    u = auth.get_user_from_credentials(email, password)
     return u
 
 
+def _get_pull_clinic_ids_for(u: User) -> list[str] | None:
+    """Returns the clinics the pull of the user is scoped to, or `None` when
+    the user should get the records of every clinic"""
+    if not config.SYNC_PULL_CLINIC_SCOPED:
+        return None
+
+    if len(config.SYNC_PULL_CLINIC_IDS) > 0:
+        return list(config.SYNC_PULL_CLINIC_IDS)
+
+    # users not attached to a clinic get everything
+    if u.clinic_id is None:
+        return None
+
+    return [str(u.clinic_id)]
+
+
 def _get_last_pulled_at_from(request: Request) -> datetime | None:
     """Uses the `last_pulled_at` part of the request query to return a `datetime.datetime` object"""
     last_pull_in_unix_time = request.args.get('last_pulled_at', None)
@@ -103,8 +145,45 @@ def _get_last_pulled_at_from(request: Request) -> datetime | None:
     return None
 
 
+def _get_sync_versions_from(request: Request) -> dict[str, str]:
+    """Returns the versions of the entities held by the client, from the
+    `versions` part of the query, given as `<entity>:<version>,...`"""
+    versions = request.args.get('versions', None)
+
+    if versions is None or versions == '':
+        return dict()
+
+    client_versions = dict()
+    for item in versions.split(','):
+        changekey, sep, version = item.partition(':')
+        if sep == '' or changekey == '' or version == '':
+            raise WebError(f'invalid entity version {item}', 400)
+
+        client_versions[changekey] = version
+
+    return client_versions
+
+
+def _get_current_sync_versions(conn: Connection) -> dict[str, str]:
+    if not config.SYNC_PULL_VERSIONS:
+        return dict()
+
+    return get_sync_versions(ENTITIES_TO_PUSH_TO_MOBILE, conn)
+
+
+def _get_unchanged_entities(
+    client_versions: dict[str, str], versions: dict[str, str]
+) -> set[str]:
+    """Entities the client holds at their current version, which are not read"""
+    return {
+        changekey
+        for changekey, version in versions.items()
+        if client_versions.get(changekey) == version
+    }
+
+
 # list of entities to get the diff from
-ENTITIES_TO_PUSH_TO_MOBILE: dict[str, SyncToClient] = {
+ENTITIES_TO_PUSH_TO_MOBILE: dict[str, type[SyncToClient]] = {
     'events': hh.Event,
     'patients': hh.Patient,
     'patient_additional_attributes': hh.PatientAttribute,
@@ -119,34 +198,481 @@ ENTITIES_TO_PUSH_TO_MOBILE: dict[str, SyncToClient] = {
 }
 
 
+def _observe_sync_request(
+    operation: str, start: float, status: int, clinic: str, size: int | None
+):
+    metrics.sync_request_duration.labels(
+        operation=operation, clinic=clinic, status=str(status)
+    ).observe(time.perf_counter() - start)
+    if size is not None:
+        metrics.sync_response_size.labels(operation=operation).observe(size)
+
+
+def _observed_sync(operation: str):
+    """Records the duration, status and size of the responses of the sync route.
+    Streamed responses are recorded once they are written out"""
+
+    def decorator(f):
+        @wraps(f)
+        def func(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                response = make_response(f(*args, **kwargs))
+            except Exception as err:
+                status = getattr(err, 'status_code', None) or getattr(err, 'code', 500)
+                _observe_sync_request(
+                    operation, start, status, g.get('sync_clinic', ''), None
+                )
+                raise
+
+            clinic = g.get('sync_clinic', '')
+            if not response.is_streamed:
+                _observe_sync_request(
+                    operation,
+                    start,
+                    response.status_code,
+                    clinic,
+                    response.calculate_content_length(),
+                )
+                return response
+
+            def observed(chunks, status: int):
+                size = 0
+                try:
+                    for chunk in chunks:
+                        size += len(chunk)
+                        yield chunk
+                finally:
+                    _observe_sync_request(operation, start, status, clinic, size)
+
+            response.response = observed(response.response, response.status_code)
+            return response
+
+        return func
+
+    return decorator
+
+
+def _count_pulled(changekey: str, deltadata: sync.DeltaData):
+    metrics.count_sync_rows(
+        metrics.PULL,
+        changekey,
+        len(deltadata.created),
+        len(deltadata.updated),
+        len(deltadata.deleted),
+    )
+
+
 @backcompatapi.route('/v2/sync', methods=['GET'])
 @api.route('/sync', methods=['GET'])
+@_observed_sync(metrics.PULL)
+@compression.compressed
 def sync_v2_pull():
-    _get_authenticated_user_from_request(request)
+    u = _get_authenticated_user_from_request(request)
+    g.sync_clinic = str(u.clinic_id or '')
+    clinic_ids = _get_pull_clinic_ids_for(u)
     last_synced_at = _get_last_pulled_at_from(request)
+    client_versions = _get_sync_versions_from(request)
     schemaVersion = request.args.get('schemaVersion', None)
     migration = request.args.get('migration', None)
 
     if last_synced_at is None:
         raise WebError('missing last_pulled_at from request query', 400)
 
+    pull_format = _get_pull_format_from(request)
+
+    page_request = _get_page_request_from(request)
+    if page_request is not None:
+        page_size, page_token = page_request
+        return _make_pull_response(
+            _sync_pull_page(
+                last_synced_at,
+                page_size,
+                page_token,
+                pull_format,
+                clinic_ids,
+                client_versions,
+            ),
+            pull_format,
+        )
+
+    # only the records are streamed one by one
+    if config.SYNC_PULL_STREAMING and pull_format == PULL_FORMAT_ROWS:
+        return Response(
+            stream_with_context(
+                webhelper.buffered_stream(
+                    _stream_sync_pull(last_synced_at, clinic_ids, client_versions)
+                )
+            ),
+            mimetype='application/json',
+        )
+
+    if config.SYNC_PULL_WORKERS > 1:
+        # read before the records, so that a change made in between
+        # is pulled again
+        with db.get_connection() as conn:
+            versions = _get_current_sync_versions(conn)
+
+        unchanged = _get_unchanged_entities(client_versions, versions)
+        deltas = get_delta_records_concurrently(
+            {
+                k: c
+                for k, c in ENTITIES_TO_PUSH_TO_MOBILE.items()
+                if k not in unchanged
+            },
+            last_synced_at,
+            # the workers have no app context, and take their connections
+            # from the pool by themselves
+            db.get_worker_connection,
+            config.SYNC_PULL_WORKERS,
+            single_pass=config.SYNC_PULL_SINGLE_PASS,
+            from_log=config.SYNC_PULL_FROM_LOG,
+            clinic_ids=clinic_ids,
+            observe_entity=lambda k: metrics.observe_sync_entity(metrics.PULL, k),
+        )
+        for changekey, deltadata in deltas.items():
+            _count_pulled(changekey, deltadata)
+
+        return _make_pull_response(
+            {
+                'changes': {
+                    k: _encode_delta(deltas.get(k, sync.DeltaData()), pull_format)
+                    for k in ENTITIES_TO_PUSH_TO_MOBILE
+                },
+                'versions': versions,
+                'timestamp': _get_timestamp_now(),
+            },
+            pull_format,
+        )
+
     changes_to_push_to_client = dict()
 
     with db.get_connection() as conn:
+        versions = _get_current_sync_versions(conn)
+        unchanged = _get_unchanged_entities(client_versions, versions)
+
         for changekey, c in ENTITIES_TO_PUSH_TO_MOBILE.items():
+            if changekey in unchanged:
+                changes_to_push_to_client[changekey] = _encode_delta(
+                    sync.DeltaData(), pull_format
+                )
+                continue
+
             # getNthTimeSyncData
             # --------
-            deltadata = c.get_delta_records(last_synced_at, conn)
+            with metrics.observe_sync_entity(metrics.PULL, changekey):
+                deltadata = c.get_delta_records(
+                    last_synced_at,
+                    conn,
+                    single_pass=config.SYNC_PULL_SINGLE_PASS,
+                    from_log=config.SYNC_PULL_FROM_LOG,
+                    clinic_ids=clinic_ids,
+                )
+            _count_pulled(changekey, deltadata)
 
             # if not deltadata.is_empty:
             # formatGETSyncResponse
             # --------
-            changes_to_push_to_client[changekey] = deltadata.to_dict()
+            changes_to_push_to_client[changekey] = _encode_delta(
+                deltadata, pull_format
+            )
 
     # server generated timestamp for the current data changes
     timestamp = _get_timestamp_now()
 
-    return jsonify({'changes': changes_to_push_to_client, 'timestamp': timestamp})
+    return _make_pull_response(
+        {
+            'changes': changes_to_push_to_client,
+            'versions': versions,
+            'timestamp': timestamp,
+        },
+        pull_format,
+    )
+
+
+PULL_FORMAT_ROWS = 'rows'
+"""Each record is an object, the default"""
+
+PULL_FORMAT_COLUMNAR = 'columnar'
+"""The created and updated records of each entity are given as a list of
+columns along with a list of values per record. See `DeltaData.to_columnar_dict`"""
+
+PULL_FORMAT_MSGPACK = 'msgpack'
+"""The columnar format, serialized with MessagePack instead of JSON"""
+
+MSGPACK_MIMETYPE = 'application/msgpack'
+
+
+def _get_pull_format_from(request: Request) -> str:
+    """Returns the format of the pulled changes, from the `format` part of the
+    query, or the `Accept` header for MessagePack"""
+    pull_format = request.args.get('format', None)
+
+    if pull_format is None:
+        if (
+            request.accept_mimetypes.best_match(['application/json', MSGPACK_MIMETYPE])
+            == MSGPACK_MIMETYPE
+        ):
+            return PULL_FORMAT_MSGPACK
+
+        return PULL_FORMAT_ROWS
+
+    if pull_format not in (PULL_FORMAT_ROWS, PULL_FORMAT_COLUMNAR, PULL_FORMAT_MSGPACK):
+        raise WebError(f'unsupported format {pull_format}', 400)
+
+    return pull_format
+
+
+def _encode_delta(deltadata: sync.DeltaData, pull_format: str) -> dict:
+    if pull_format == PULL_FORMAT_ROWS:
+        return deltadata.to_dict()
+
+    return deltadata.to_columnar_dict()
+
+
+def _make_pull_response(body: dict, pull_format: str) -> Response:
+    if pull_format == PULL_FORMAT_MSGPACK:
+        # values are converted the same way as they are for JSON
+        return Response(
+            msgpack.packb(body, default=json_provider.sync_json(current_app).default),
+            mimetype=MSGPACK_MIMETYPE,
+        )
+
+    return json_provider.sync_json(current_app).response(body)
+
+
+def _get_page_request_from(request: Request) -> tuple[int, str | None] | None:
+    """Returns the `(page_size, page_token)` of a paginated pull, or `None` when
+    the client expects the changes in a single response"""
+    page_size = request.args.get('page_size', None)
+    page_token = request.args.get('page_token', None)
+
+    if page_size is None and page_token is None:
+        return None
+
+    if page_size is None:
+        return config.SYNC_PULL_MAX_PAGE_SIZE, page_token
+
+    if not page_size.isnumeric() or int(page_size) < 1:
+        raise WebError('page_size must be a positive number', 400)
+
+    return min(int(page_size), config.SYNC_PULL_MAX_PAGE_SIZE), page_token
+
+
+def _encode_page_token(
+    high_watermark: datetime,
+    changekey: str,
+    position: tuple[datetime, list[Any]] | None,
+    versions: dict[str, str],
+) -> str:
+    """Encodes where the next page of the pull should continue from, along with
+    the versions of the entities read on the first page"""
+    payload = dict(hw=high_watermark.isoformat(), entity=changekey, v=versions)
+    if position is not None:
+        changed_at, key = position
+        payload.update(at=changed_at.isoformat(), key=[str(k) for k in key])
+
+    return urlsafe_b64encode(json.dumps(payload).encode()).decode()
+
+
+def _decode_page_token(token: str):
+    """Returns the `(high_watermark, changekey, position, versions)` encoded in
+    the token"""
+    try:
+        payload = json.loads(urlsafe_b64decode(token.encode()))
+        high_watermark = utc.from_iso8601(payload['hw'])
+        changekey = payload['entity']
+        versions = {str(k): str(v) for k, v in payload.get('v', {}).items()}
+
+        position = None
+        if 'at' in payload:
+            position = (utc.from_iso8601(payload['at']), list(payload['key']))
+    except Exception:
+        raise WebError('invalid page_token', 400)
+
+    if changekey not in ENTITIES_TO_PUSH_TO_MOBILE:
+        raise WebError('invalid page_token', 400)
+
+    return high_watermark, changekey, position, versions
+
+
+def _sync_pull_page(
+    last_synced_at: datetime,
+    page_size: int,
+    page_token: str | None,
+    pull_format: str = PULL_FORMAT_ROWS,
+    clinic_ids: list[str] | None = None,
+    client_versions: dict[str, str] | None = None,
+):
+    """Returns up to `page_size` changed records, continuing from `page_token`.
+
+    Every page of the same pull only includes changes made before the
+    high-watermark set on the first page, which is also the `timestamp` to use as
+    `last_pulled_at` once there's no `next_page_token` left. The same goes for
+    the entity versions."""
+    changekeys = list(ENTITIES_TO_PUSH_TO_MOBILE.keys())
+    versions = None
+
+    if page_token is None:
+        # truncated to the precision of the returned timestamp
+        now = utc.now()
+        high_watermark = now.replace(microsecond=now.microsecond // 1000 * 1000)
+        start_changekey, position = changekeys[0], None
+    else:
+        high_watermark, start_changekey, position, versions = _decode_page_token(
+            page_token
+        )
+
+    changes_to_push_to_client = {
+        changekey: _encode_delta(sync.DeltaData(), pull_format)
+        for changekey in changekeys
+    }
+    next_page_token = None
+    remaining = page_size
+
+    with db.get_connection() as conn:
+        if versions is None:
+            versions = _get_current_sync_versions(conn)
+
+        unchanged = _get_unchanged_entities(client_versions or dict(), versions)
+
+        for idx in range(changekeys.index(start_changekey), len(changekeys)):
+            changekey = changekeys[idx]
+            if changekey in unchanged:
+                continue
+
+            with metrics.observe_sync_entity(metrics.PULL, changekey):
+                deltadata, position = ENTITIES_TO_PUSH_TO_MOBILE[
+                    changekey
+                ].get_delta_records_page(
+                    last_synced_at,
+                    high_watermark,
+                    conn,
+                    remaining,
+                    after=position,
+                    from_log=config.SYNC_PULL_FROM_LOG,
+                    clinic_ids=clinic_ids,
+                )
+            _count_pulled(changekey, deltadata)
+
+            changes_to_push_to_client[changekey] = _encode_delta(
+                deltadata, pull_format
+            )
+            remaining -= deltadata.size
+
+            if position is not None:
+                next_page_token = _encode_page_token(
+                    high_watermark, changekey, position, versions
+                )
+                break
+
+            if remaining == 0:
+                if idx + 1 < len(changekeys):
+                    next_page_token = _encode_page_token(
+                        high_watermark, changekeys[idx + 1], None, versions
+                    )
+                break
+
+    return {
+        'changes': changes_to_push_to_client,
+        'versions': versions,
+        'timestamp': high_watermark.timestamp() * 1000,
+        'next_page_token': next_page_token,
+    }
+
+
+_DELTA_ACTION_KEYS = {
+    sync.ACTION_CREATE: 'created',
+    sync.ACTION_UPDATE: 'updated',
+    sync.ACTION_DELETE: 'deleted',
+}
+
+
+def _stream_delta_records(records: Iterable[tuple[str, Any]]):
+    """Writes the `(action, record)` pairs, grouped by action, as the same JSON
+    object produced by `DeltaData.to_dict()`"""
+    dumps = json_provider.sync_json(current_app).dumps
+    written = []
+
+    for action, record in records:
+        if len(written) == 0 or written[-1] != action:
+            yield '{' if len(written) == 0 else '],'
+            yield '{}:['.format(dumps(_DELTA_ACTION_KEYS[action]))
+            written.append(action)
+        else:
+            yield ','
+
+        yield dumps(record)
+
+    for action, key in _DELTA_ACTION_KEYS.items():
+        if action not in written:
+            yield '{' if len(written) == 0 else '],'
+            yield '{}:['.format(dumps(key))
+            written.append(action)
+
+    yield ']}'
+
+
+def _counted_records(changekey: str, records: Iterable[tuple[str, Any]]):
+    """Passes the `(action, record)` pairs through, counting them once read"""
+    counts = {action: 0 for action in _DELTA_ACTION_KEYS}
+    for action, record in records:
+        counts[action] += 1
+        yield action, record
+
+    metrics.count_sync_rows(
+        metrics.PULL,
+        changekey,
+        counts[sync.ACTION_CREATE],
+        counts[sync.ACTION_UPDATE],
+        counts[sync.ACTION_DELETE],
+    )
+
+
+def _stream_sync_pull(
+    last_synced_at: datetime,
+    clinic_ids: list[str] | None = None,
+    client_versions: dict[str, str] | None = None,
+):
+    """Writes the `{"changes": {...}, "versions": {...}, "timestamp": ...}` pull
+    response incrementally, reading the changes of each entity through a
+    server-side cursor"""
+    dumps = json_provider.sync_json(current_app).dumps
+
+    yield '{"changes":{'
+    with db.get_connection() as conn:
+        versions = _get_current_sync_versions(conn)
+        unchanged = _get_unchanged_entities(client_versions or dict(), versions)
+
+        for idx, (changekey, c) in enumerate(ENTITIES_TO_PUSH_TO_MOBILE.items()):
+            yield '{}{}:'.format('' if idx == 0 else ',', dumps(changekey))
+            if changekey in unchanged:
+                yield from _stream_delta_records([])
+                continue
+
+            # only the time spent reading the rows is observed, not the time
+            # the client takes to read the response
+            yield from _stream_delta_records(
+                _counted_records(
+                    changekey,
+                    metrics.observe_sync_entity_reads(
+                        metrics.PULL,
+                        changekey,
+                        c.iter_delta_records(
+                            last_synced_at,
+                            conn,
+                            batch_size=config.SYNC_PULL_BATCH_SIZE,
+                            from_log=config.SYNC_PULL_FROM_LOG,
+                            clinic_ids=clinic_ids,
+                        ),
+                    ),
+                )
+            )
+
+    # server generated timestamp for the current data changes
+    yield '}},"versions":{},"timestamp":{}}}'.format(
+        dumps(versions), dumps(_get_timestamp_now())
+    )
 
 
 def _get_timestamp_now():
@@ -175,44 +701,170 @@ sink.add('prescriptions', hh.Prescription)
 #   sink.add('<table_id>', NewTableEntity)
 
 
+def _get_push_batch_id_from(request: Request) -> str | None:
+    """Returns the id given by the client to the pushed batch of changes, from the
+    `batch_id` part of the query. Retries of a push must use the same id"""
+    batch_id = request.args.get('batch_id', None)
+
+    if batch_id is None:
+        return None
+
+    if batch_id == '' or len(batch_id) > push.MAX_BATCH_ID_LENGTH:
+        raise WebError('invalid batch_id', 400)
+
+    return batch_id
+
+
 @backcompatapi.route('/v2/sync', methods=['POST'])
 @api.route('/sync', methods=['POST'])
+@_observed_sync(metrics.PUSH)
+@compression.compressed
 def sync_v2_push():
     # _get_authenticated_user_from_request(request)
     last_synced_at = _get_last_pulled_at_from(request)
     schemaVersion = request.args.get('schemaVersion', None)  # NOT USED
     migration = request.args.get('migration', None)  # NOT USED
+    batch_id = _get_push_batch_id_from(request)
 
     if last_synced_at is None:
         raise WebError('missing `last_pulled_at` from request query', 400)
 
     # expected body structure
     # { [s in 'events' | 'patients' | ....]: { "created": Array<dict[str, any]>, "updated": Array<dict[str, any]>, deleted: []str }}
-    body = dict(request.get_json())
+    data = compression.get_request_data(request)
+    body = dict(compression.decode_json(data))
 
-    with db.get_connection() as conn:
-        try:
-            for key, newdeltajson in body.items():
-                # get the entity delta values
-                deltadata = defaultdict(None, newdeltajson)
-
-                # package delta data
-                deltadata = sync.DeltaData(
-                    created=deltadata.get('created'),
-                    updated=deltadata.get('updated'),
-                    # deleted=[{"id": id } for id in deltadata.get("deleted")] if deltadata.get("deleted") is not None else None,
-                    deleted=deltadata.get('deleted'),
-                )
+    if config.SYNC_PUSH_ASYNC and _prefers_async(request):
+        return _queue_push(data, body, last_synced_at, batch_id)
+
+    result = _get_push_result()
+
+    # the batch and all of the pushed entities are committed together, at the
+    # end of the transaction, or not at all
+    with db.get_connection() as conn, conn.transaction():
+        if batch_id is not None:
+            # recorded first, so that a retry sent while this push is
+            # still being applied waits for it, instead of applying it again
+            payload_hash = push.hash_payload(data)
+            batch = push.record_push_batch(conn, batch_id, payload_hash, result)
+
+            if batch is not None:
+                if batch.payload_hash != payload_hash:
+                    raise WebError(
+                        f'batch {batch_id} was already pushed with other changes', 409
+                    )
 
-                sink.push(key, deltadata, last_synced_at, conn)
-            # after leaving the `with` context, there's an implied db.commit()
+                return jsonify(batch.response)
+
+        try:
+            _apply_push(conn, body, last_synced_at)
         except Exception as err:
-            conn.close()
             print(err)
             print(traceback.format_exc())
             abort(500, description='An internal error occurred')
 
-    return jsonify({'ok': True, 'timestamp': utc.now().isoformat()})
+    return jsonify(result)
+
+
+def _get_push_result():
+    return {'ok': True, 'timestamp': utc.now().isoformat()}
+
+
+def _apply_push(conn: Connection, body: dict, last_synced_at: datetime):
+    for key, newdeltajson in body.items():
+        # get the entity delta values
+        deltadata = defaultdict(None, newdeltajson)
+
+        # package delta data
+        deltadata = sync.DeltaData(
+            created=deltadata.get('created'),
+            updated=deltadata.get('updated'),
+            # deleted=[{"id": id } for id in deltadata.get("deleted")] if deltadata.get("deleted") is not None else None,
+            deleted=deltadata.get('deleted'),
+        )
+
+        if key not in sink:
+            # not synced from the client. logged and skipped by the sink
+            sink.push(key, deltadata, last_synced_at, conn)
+            continue
+
+        with metrics.observe_sync_entity(metrics.PUSH, key):
+            sink.push(key, deltadata, last_synced_at, conn)
+
+        metrics.count_sync_rows(
+            metrics.PUSH,
+            key,
+            len(deltadata.created),
+            len(deltadata.updated),
+            len(deltadata.deleted),
+        )
+
+
+def _apply_push_job(
+    conn: Connection, job: push.PushJob, payload: bytes, last_synced_at: datetime
+):
+    """Applies a queued push, the same way it would be if it wasn't queued"""
+    if job.batch_id is not None:
+        batch = push.record_push_batch(
+            conn, job.batch_id, job.payload_hash, _get_push_result()
+        )
+
+        if batch is not None:
+            if batch.payload_hash != job.payload_hash:
+                raise SyncPushError(
+                    f'batch {job.batch_id} was already pushed with other changes'
+                )
+
+            # already applied, by a push that was not queued
+            return
+
+    _apply_push(conn, dict(json.loads(payload)), last_synced_at)
+
+
+# applies the pushes queued by the clients
+push_worker = push.PushWorker(_apply_push_job)
+
+
+def _prefers_async(request: Request) -> bool:
+    """Whether the client asked for the push to be queued, with the
+    `Prefer: respond-async` header"""
+    preferences = request.headers.get('Prefer', '')
+    return 'respond-async' in {p.strip().lower() for p in preferences.split(',')}
+
+
+def _queue_push(
+    data: bytes, body: dict, last_synced_at: datetime, batch_id: str | None
+):
+    with db.get_connection() as conn:
+        job = push.enqueue_push_job(conn, data, body, last_synced_at, batch_id)
+
+    if job.payload_hash != push.hash_payload(data):
+        raise WebError(f'batch {batch_id} was already pushed with other changes', 409)
+
+    push_worker.start(current_app._get_current_object())
+    push_worker.notify()
+
+    response = jsonify({'ok': True, 'job_id': job.id, 'status': job.status})
+    response.status_code = 202
+    response.headers['Location'] = url_for('.get_push_job_status', job_id=job.id)
+    response.headers['Preference-Applied'] = 'respond-async'
+    return response
+
+
+@backcompatapi.route('/v2/sync/jobs/<job_id>', methods=['GET'])
+@api.route('/sync/jobs/<job_id>', methods=['GET'])
+def get_push_job_status(job_id: str):
+    """Reports the progress of a queued push. `counts` holds the number of
+    records pushed per entity and action"""
+    _get_authenticated_user_from_request(request)
+
+    with db.get_connection() as conn:
+        job = push.get_push_job(conn, job_id)
+
+    if job is None:
+        return jsonify({'ok': False, 'message': 'Job not found'}), 404
+
+    return jsonify(job.to_dict())
 
 
 @api.route('/forms/resources', methods=['PUT'])
@@ -10,8 +10,11 @@ from hikmahealth.server import (
     test_routes,
 )
 
+from hikmahealth.server.client.db import register_connection_pool
 from hikmahealth.server.client.keeper import register_keeper
 from hikmahealth.server.client.resources import register_resource_manager
+from hikmahealth.server.helpers.json_provider import register_json_provider
+from hikmahealth.server.helpers.metrics import register_metrics
 from hikmahealth.utils.errors import WebError
 
 app = Flask(__name__)
@@ -20,8 +23,11 @@ app.url_map.strict_slashes = False
 CORS(app)
 # CORS(app, resources={r"/*": {"origins": "*"}})
 
+register_json_provider(app)
+register_connection_pool(app)
 register_keeper(app)
 register_resource_manager(app)
+register_metrics(app)
 
 
 # for backcompat
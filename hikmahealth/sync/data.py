@@ -34,6 +34,16 @@ class DeltaData[TCreate, TUpdate, TDelete]:
     def to_dict(self):
         return dict(created=self.created, updated=self.updated, deleted=self.deleted)
 
+    def to_columnar_dict(self):
+        """Same as `to_dict`, except the created and updated records are given
+        as the list of their columns, followed by the values of each record in
+        the order of the columns"""
+        return dict(
+            created=_to_columns(self.created),
+            updated=_to_columns(self.updated),
+            deleted=self.deleted,
+        )
+
     @property
     def size(self):
         return len(self.created) + len(self.updated) + len(self.deleted)
@@ -66,3 +76,10 @@ class DeltaData[TCreate, TUpdate, TDelete]:
         return (
             len(self.created) == 0 and len(self.deleted) == 0 and len(self.updated) == 0
         )
+
+
+def _to_columns(records: list) -> dict[str, list]:
+    # records of the same table mostly share the same columns,
+    # those missing from a record are given as `None`
+    columns = list(dict.fromkeys(k for r in records for k in r.keys()))
+    return dict(columns=columns, rows=[[r.get(c) for c in columns] for r in records])
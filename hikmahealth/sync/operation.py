@@ -85,6 +85,9 @@ class Sink[TArgs]:
 
         self._ops[key] = sync_operation
 
+    def __contains__(self, key: str) -> bool:
+        return key in self._ops
+
     def remove(self, key: str):
         """Removes operation that's registered for syncronization stored in `key` argument"""
         if key in self._ops:
@@ -0,0 +1,108 @@
+"""create sync changes log
+
+Revision ID: 5b7e3c1d9a24
+Revises: 18edc29dd7fd
+Create Date: 2026-10-18 17:20:00.000000
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b7e3c1d9a24'
+down_revision = '18edc29dd7fd'
+branch_labels = None
+depends_on = None
+
+
+# tables pulled by the mobile clients
+SYNCED_TABLES = (
+    'events',
+    'patients',
+    'patient_additional_attributes',
+    'clinics',
+    'visits',
+    'string_ids',
+    'string_content',
+    'event_forms',
+    'patient_registration_forms',
+    'appointments',
+    'prescriptions',
+)
+
+
+def upgrade():
+    # `changed_at` is never earlier than the timestamps written to the row,
+    # which may come from the clients. So any row a pull would return has a
+    # change logged after the last pull
+    op.execute(
+        """
+        CREATE TABLE sync_changes (
+            seq bigserial PRIMARY KEY,
+            table_name text NOT NULL,
+            row_id uuid NOT NULL,
+            changed_at timestamp with time zone NOT NULL DEFAULT now()
+        );
+        """
+    )
+
+    op.execute(
+        """
+        CREATE INDEX sync_changes_table_changed_at_ix
+        ON sync_changes (table_name, changed_at) INCLUDE (row_id);
+        """
+    )
+
+    op.execute(
+        """
+        CREATE FUNCTION record_sync_changes() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            INSERT INTO sync_changes (table_name, row_id, changed_at)
+            SELECT
+                TG_TABLE_NAME,
+                n.id,
+                GREATEST(now(), n.server_created_at, n.last_modified, n.deleted_at)
+            FROM changed_rows n;
+
+            RETURN NULL;
+        END;
+        $$;
+        """
+    )
+
+    for table in SYNCED_TABLES:
+        # a trigger with transition tables can only fire on a single event
+        for event in ('INSERT', 'UPDATE'):
+            op.execute(
+                f"""
+                CREATE TRIGGER record_sync_changes_on_{event.lower()}
+                AFTER {event} ON {table}
+                REFERENCING NEW TABLE AS changed_rows
+                FOR EACH STATEMENT EXECUTE FUNCTION record_sync_changes();
+                """
+            )
+
+        # the rows that exist before the log
+        op.execute(
+            f"""
+            INSERT INTO sync_changes (table_name, row_id, changed_at)
+            SELECT
+                '{table}',
+                id,
+                GREATEST(now(), server_created_at, last_modified, deleted_at)
+            FROM {table};
+            """
+        )
+
+
+def downgrade():
+    for table in SYNCED_TABLES:
+        for event in ('insert', 'update'):
+            op.execute(f'DROP TRIGGER record_sync_changes_on_{event} ON {table};')
+
+    op.execute('DROP FUNCTION record_sync_changes();')
+    op.execute('DROP INDEX sync_changes_table_changed_at_ix;')
+    op.execute('DROP TABLE sync_changes;')
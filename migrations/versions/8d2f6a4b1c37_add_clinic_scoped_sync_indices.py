@@ -0,0 +1,46 @@
+"""add clinic scoped sync indices
+
+Revision ID: 8d2f6a4b1c37
+Revises: 5b7e3c1d9a24
+Create Date: 2026-10-18 18:05:00.000000
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d2f6a4b1c37'
+down_revision = '5b7e3c1d9a24'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # patients seen at a clinic, and since when
+    op.execute(
+        """
+        CREATE INDEX ix_visits_clinic_id_patient_id
+        ON visits (clinic_id, patient_id) INCLUDE (server_created_at);
+        """
+    )
+    op.execute(
+        """
+        CREATE INDEX ix_appointments_clinic_id_patient_id
+        ON appointments (clinic_id, patient_id) INCLUDE (server_created_at);
+        """
+    )
+
+    # records of the patients in scope
+    op.execute('CREATE INDEX ix_visits_patient_id ON visits (patient_id);')
+    op.execute('CREATE INDEX ix_appointments_patient_id ON appointments (patient_id);')
+    op.execute('CREATE INDEX ix_events_patient_id ON events (patient_id);')
+
+
+def downgrade():
+    op.execute('DROP INDEX ix_events_patient_id;')
+    op.execute('DROP INDEX ix_appointments_patient_id;')
+    op.execute('DROP INDEX ix_visits_patient_id;')
+    op.execute('DROP INDEX ix_appointments_clinic_id_patient_id;')
+    op.execute('DROP INDEX ix_visits_clinic_id_patient_id;')
@@ -0,0 +1,32 @@
+"""add patients updated at index
+
+Revision ID: a7c2e9f4b815
+Revises: f3b8d1e6a920
+Create Date: 2026-10-18 22:00:00.000000
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a7c2e9f4b815'
+down_revision = 'f3b8d1e6a920'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # pages of the admin patient list, most recently updated first
+    op.execute(
+        """
+        CREATE INDEX ix_patients_updated_at_id
+        ON patients ((COALESCE(updated_at, 'epoch'::timestamptz)) DESC, id DESC)
+        WHERE is_deleted = false;
+        """
+    )
+
+
+def downgrade():
+    op.execute('DROP INDEX ix_patients_updated_at_id;')
@@ -0,0 +1,60 @@
+"""add patient search trigram indices
+
+Revision ID: b2d6f0a8c374
+Revises: a7c2e9f4b815
+Create Date: 2026-10-18 22:45:00.000000
+
+"""
+
+import logging
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b2d6f0a8c374'
+down_revision = 'a7c2e9f4b815'
+branch_labels = None
+depends_on = None
+
+
+# columns matched by the patient search
+SEARCH_COLUMNS = (
+    'given_name',
+    'surname',
+    'phone',
+    'government_id',
+    'external_patient_id',
+)
+
+
+def upgrade():
+    available = (
+        op
+        .get_bind()
+        .execute(
+            sa.text("SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'")
+        )
+        .scalar()
+    )
+    if available is None:
+        # the search falls back to matching the query as is
+        logging.warning('pg_trgm is not available, skipping the search indices')
+        return
+
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm;')
+    for column in SEARCH_COLUMNS:
+        op.execute(
+            f"""
+            CREATE INDEX ix_patients_{column}_trgm
+            ON patients USING gin ({column} gin_trgm_ops)
+            WHERE is_deleted = false;
+            """
+        )
+
+
+def downgrade():
+    # the extension is left in place, as it might be used by others
+    for column in reversed(SEARCH_COLUMNS):
+        op.execute(f'DROP INDEX IF EXISTS ix_patients_{column}_trgm;')
@@ -0,0 +1,44 @@
+"""create sync push batches table
+
+Revision ID: c41e7f0a2d58
+Revises: 8d2f6a4b1c37
+Create Date: 2026-10-18 19:10:00.000000
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c41e7f0a2d58'
+down_revision = '8d2f6a4b1c37'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # pushes applied with a client supplied batch id, along with the
+    # response sent back. A retry of the batch gets the same response
+    op.execute(
+        """
+        CREATE TABLE sync_push_batches (
+            id text PRIMARY KEY,
+            payload_hash text NOT NULL,
+            response jsonb NOT NULL,
+            created_at timestamp with time zone NOT NULL DEFAULT now()
+        );
+        """
+    )
+
+    op.execute(
+        """
+        CREATE INDEX sync_push_batches_created_at_ix
+        ON sync_push_batches (created_at);
+        """
+    )
+
+
+def downgrade():
+    op.execute('DROP INDEX sync_push_batches_created_at_ix;')
+    op.execute('DROP TABLE sync_push_batches;')
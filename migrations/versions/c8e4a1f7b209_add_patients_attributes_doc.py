@@ -0,0 +1,167 @@
+"""add patients attributes doc
+
+Revision ID: c8e4a1f7b209
+Revises: b2d6f0a8c374
+Create Date: 2026-10-18 23:30:00.000000
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c8e4a1f7b209'
+down_revision = 'b2d6f0a8c374'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # attributes of the patient, keyed by their `attribute_id`, as read by the
+    # admin app. Kept up to date by the triggers below
+    op.execute(
+        """
+        ALTER TABLE patients
+        ADD COLUMN attributes_doc jsonb NOT NULL DEFAULT '{}'::jsonb;
+        """
+    )
+
+    op.execute(
+        """
+        CREATE FUNCTION patient_attributes_doc(pid uuid) RETURNS jsonb
+        LANGUAGE sql STABLE AS $$
+            SELECT COALESCE(
+                jsonb_object_agg(
+                    pa.attribute_id,
+                    jsonb_build_object(
+                        'attribute', pa.attribute,
+                        'number_value', pa.number_value,
+                        'string_value', pa.string_value,
+                        'date_value', pa.date_value,
+                        'boolean_value', pa.boolean_value
+                    )
+                ),
+                '{}'::jsonb
+            )
+            FROM patient_additional_attributes pa
+            WHERE pa.patient_id = pid AND pa.is_deleted = false;
+        $$;
+        """
+    )
+
+    # only the patients whose attributes changed in the statement are updated
+    op.execute(
+        """
+        CREATE FUNCTION refresh_patient_attributes_doc() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                UPDATE patients p SET attributes_doc = patient_attributes_doc(p.id)
+                WHERE p.id IN (SELECT patient_id FROM new_rows);
+            ELSIF TG_OP = 'UPDATE' THEN
+                UPDATE patients p SET attributes_doc = patient_attributes_doc(p.id)
+                WHERE p.id IN (
+                    SELECT patient_id FROM new_rows
+                    UNION
+                    SELECT patient_id FROM old_rows
+                );
+            ELSE
+                UPDATE patients p SET attributes_doc = patient_attributes_doc(p.id)
+                WHERE p.id IN (SELECT patient_id FROM old_rows);
+            END IF;
+
+            RETURN NULL;
+        END;
+        $$;
+        """
+    )
+
+    op.execute(
+        """
+        CREATE TRIGGER refresh_patient_attributes_doc_on_insert
+        AFTER INSERT ON patient_additional_attributes
+        REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION refresh_patient_attributes_doc();
+        """
+    )
+    op.execute(
+        """
+        CREATE TRIGGER refresh_patient_attributes_doc_on_update
+        AFTER UPDATE ON patient_additional_attributes
+        REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION refresh_patient_attributes_doc();
+        """
+    )
+    op.execute(
+        """
+        CREATE TRIGGER refresh_patient_attributes_doc_on_delete
+        AFTER DELETE ON patient_additional_attributes
+        REFERENCING OLD TABLE AS old_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION refresh_patient_attributes_doc();
+        """
+    )
+
+    # attributes pushed before the patient they belong to
+    op.execute(
+        """
+        CREATE FUNCTION set_patient_attributes_doc() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            NEW.attributes_doc := patient_attributes_doc(NEW.id);
+            RETURN NEW;
+        END;
+        $$;
+        """
+    )
+    op.execute(
+        """
+        CREATE TRIGGER set_patient_attributes_doc_on_insert
+        BEFORE INSERT ON patients
+        FOR EACH ROW EXECUTE FUNCTION set_patient_attributes_doc();
+        """
+    )
+
+    # backfill. the patients are not changed for the clients, so the update
+    # isn't logged in `sync_changes`
+    op.execute('ALTER TABLE patients DISABLE TRIGGER record_sync_changes_on_update;')
+    op.execute(
+        """
+        UPDATE patients p SET attributes_doc = d.doc
+        FROM (
+            SELECT
+                pa.patient_id,
+                jsonb_object_agg(
+                    pa.attribute_id,
+                    jsonb_build_object(
+                        'attribute', pa.attribute,
+                        'number_value', pa.number_value,
+                        'string_value', pa.string_value,
+                        'date_value', pa.date_value,
+                        'boolean_value', pa.boolean_value
+                    )
+                ) AS doc
+            FROM patient_additional_attributes pa
+            WHERE pa.is_deleted = false
+            GROUP BY pa.patient_id
+        ) d
+        WHERE p.id = d.patient_id;
+        """
+    )
+    op.execute('ALTER TABLE patients ENABLE TRIGGER record_sync_changes_on_update;')
+
+
+def downgrade():
+    for event in ('insert', 'update', 'delete'):
+        op.execute(
+            f"""
+            DROP TRIGGER refresh_patient_attributes_doc_on_{event}
+            ON patient_additional_attributes;
+            """
+        )
+
+    op.execute('DROP TRIGGER set_patient_attributes_doc_on_insert ON patients;')
+    op.execute('DROP FUNCTION set_patient_attributes_doc();')
+    op.execute('DROP FUNCTION refresh_patient_attributes_doc();')
+    op.execute('DROP FUNCTION patient_attributes_doc(uuid);')
+    op.execute('ALTER TABLE patients DROP COLUMN attributes_doc;')
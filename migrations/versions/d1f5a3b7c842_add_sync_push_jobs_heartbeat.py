@@ -0,0 +1,32 @@
+"""add sync push jobs heartbeat
+
+Revision ID: d1f5a3b7c842
+Revises: c8e4a1f7b209
+Create Date: 2026-10-19 09:00:00.000000
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd1f5a3b7c842'
+down_revision = 'c8e4a1f7b209'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # last time the worker applying the job reported it was still at it. The
+    # lease of a running job is counted from there
+    op.execute(
+        """
+        ALTER TABLE sync_push_jobs
+        ADD COLUMN heartbeat_at timestamp with time zone DEFAULT NULL;
+        """
+    )
+
+
+def downgrade():
+    op.execute('ALTER TABLE sync_push_jobs DROP COLUMN heartbeat_at;')
@@ -0,0 +1,52 @@
+"""create sync push jobs table
+
+Revision ID: e5a9b2c7d013
+Revises: c41e7f0a2d58
+Create Date: 2026-10-18 20:00:00.000000
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5a9b2c7d013'
+down_revision = 'c41e7f0a2d58'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # pushes accepted to be applied in the background. `counts` holds the
+    # number of records pushed per entity and action
+    op.execute(
+        """
+        CREATE TABLE sync_push_jobs (
+            id uuid PRIMARY KEY,
+            batch_id text UNIQUE,
+            payload bytea NOT NULL,
+            payload_hash text NOT NULL,
+            last_pulled_at timestamp with time zone NOT NULL,
+            status text NOT NULL DEFAULT 'pending',
+            attempts integer NOT NULL DEFAULT 0,
+            counts jsonb NOT NULL DEFAULT '{}'::jsonb,
+            error text DEFAULT NULL,
+            created_at timestamp with time zone NOT NULL DEFAULT now(),
+            started_at timestamp with time zone DEFAULT NULL,
+            finished_at timestamp with time zone DEFAULT NULL
+        );
+        """
+    )
+
+    op.execute(
+        """
+        CREATE INDEX sync_push_jobs_unfinished_ix ON sync_push_jobs (created_at)
+        WHERE status IN ('pending', 'running');
+        """
+    )
+
+
+def downgrade():
+    op.execute('DROP INDEX sync_push_jobs_unfinished_ix;')
+    op.execute('DROP TABLE sync_push_jobs;')
@@ -0,0 +1,121 @@
+"""create sync versions table
+
+Revision ID: e7a2c4f9b316
+Revises: d1f5a3b7c842
+Create Date: 2026-10-19 10:00:00.000000
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e7a2c4f9b316'
+down_revision = 'd1f5a3b7c842'
+branch_labels = None
+depends_on = None
+
+
+# tables of the `SYNC_VERSIONED` entities
+VERSIONED_TABLES = (
+    'clinics',
+    'string_ids',
+    'string_content',
+    'event_forms',
+    'patient_registration_forms',
+)
+
+
+def _create_triggers(table: str, args: str):
+    for event in ('INSERT', 'UPDATE'):
+        op.execute(f'DROP TRIGGER record_sync_changes_on_{event.lower()} ON {table};')
+        op.execute(
+            f"""
+            CREATE TRIGGER record_sync_changes_on_{event.lower()}
+            AFTER {event} ON {table}
+            REFERENCING NEW TABLE AS changed_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION record_sync_changes({args});
+            """
+        )
+
+
+def upgrade():
+    # version of the reference tables, bumped by the statements changing them.
+    # Reading it doesn't depend on the size of the `sync_changes` log, and
+    # isn't affected by its pruning. Only kept for the versioned tables, as
+    # the row is locked until the changes are committed
+    op.execute(
+        """
+        CREATE TABLE sync_versions (
+            table_name text PRIMARY KEY,
+            version bigint NOT NULL DEFAULT 0
+        );
+        """
+    )
+
+    # starts past the versions given so far, derived from the log
+    tables = ', '.join(f"'{table}'" for table in VERSIONED_TABLES)
+    op.execute(
+        f"""
+        INSERT INTO sync_versions (table_name, version)
+        SELECT t.table_name, coalesce(max(s.seq), 0)
+        FROM unnest(ARRAY[{tables}]) AS t(table_name)
+        LEFT JOIN sync_changes s ON s.table_name = t.table_name
+        GROUP BY t.table_name;
+        """
+    )
+
+    op.execute(
+        """
+        CREATE OR REPLACE FUNCTION record_sync_changes() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            INSERT INTO sync_changes (table_name, row_id, changed_at)
+            SELECT
+                TG_TABLE_NAME,
+                n.id,
+                GREATEST(now(), n.server_created_at, n.last_modified, n.deleted_at)
+            FROM changed_rows n;
+
+            -- triggers of the versioned tables are given 'versioned'
+            IF FOUND AND TG_NARGS > 0 AND TG_ARGV[0] = 'versioned' THEN
+                INSERT INTO sync_versions (table_name, version)
+                VALUES (TG_TABLE_NAME, 1)
+                ON CONFLICT (table_name)
+                DO UPDATE SET version = sync_versions.version + 1;
+            END IF;
+
+            RETURN NULL;
+        END;
+        $$;
+        """
+    )
+
+    for table in VERSIONED_TABLES:
+        _create_triggers(table, "'versioned'")
+
+
+def downgrade():
+    for table in VERSIONED_TABLES:
+        _create_triggers(table, '')
+
+    op.execute(
+        """
+        CREATE OR REPLACE FUNCTION record_sync_changes() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            INSERT INTO sync_changes (table_name, row_id, changed_at)
+            SELECT
+                TG_TABLE_NAME,
+                n.id,
+                GREATEST(now(), n.server_created_at, n.last_modified, n.deleted_at)
+            FROM changed_rows n;
+
+            RETURN NULL;
+        END;
+        $$;
+        """
+    )
+
+    op.execute('DROP TABLE sync_versions;')
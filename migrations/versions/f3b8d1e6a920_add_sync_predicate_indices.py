@@ -0,0 +1,68 @@
+"""add sync predicate indices
+
+Revision ID: f3b8d1e6a920
+Revises: e5a9b2c7d013
+Create Date: 2026-10-18 21:10:00.000000
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f3b8d1e6a920'
+down_revision = 'e5a9b2c7d013'
+branch_labels = None
+depends_on = None
+
+
+# tables pulled by the mobile clients
+SYNCED_TABLES = (
+    'events',
+    'patients',
+    'patient_additional_attributes',
+    'clinics',
+    'visits',
+    'string_ids',
+    'string_content',
+    'event_forms',
+    'patient_registration_forms',
+    'appointments',
+    'prescriptions',
+)
+
+
+def upgrade():
+    for table in SYNCED_TABLES:
+        # rows created since the last sync
+        op.execute(
+            f"""
+            CREATE INDEX ix_{table}_sync_created ON {table} (server_created_at)
+            WHERE is_deleted = false AND deleted_at IS NULL;
+            """
+        )
+
+        # rows updated since the last sync, that were created before it
+        op.execute(
+            f"""
+            CREATE INDEX ix_{table}_sync_updated
+            ON {table} (last_modified, server_created_at)
+            WHERE is_deleted = false AND deleted_at IS NULL;
+            """
+        )
+
+        # rows deleted since the last sync
+        op.execute(
+            f"""
+            CREATE INDEX ix_{table}_sync_deleted ON {table} (deleted_at)
+            WHERE is_deleted = true;
+            """
+        )
+
+
+def downgrade():
+    for table in reversed(SYNCED_TABLES):
+        op.execute(f'DROP INDEX ix_{table}_sync_deleted;')
+        op.execute(f'DROP INDEX ix_{table}_sync_updated;')
+        op.execute(f'DROP INDEX ix_{table}_sync_created;')
@@ -0,0 +1,144 @@
+"""compact sync changes log
+
+Revision ID: f3b8d2a6c1e5
+Revises: e7a2c4f9b316
+Create Date: 2026-10-19 14:00:00.000000
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f3b8d2a6c1e5'
+down_revision = 'e7a2c4f9b316'
+branch_labels = None
+depends_on = None
+
+
+# tables pulled by the mobile clients
+SYNCED_TABLES = (
+    'events',
+    'patients',
+    'patient_additional_attributes',
+    'clinics',
+    'visits',
+    'string_ids',
+    'string_content',
+    'event_forms',
+    'patient_registration_forms',
+    'appointments',
+    'prescriptions',
+)
+
+
+def upgrade():
+    # a pull only needs the last change of a row, so the log keeps a single
+    # row per synced row, and doesn't grow past the size of the synced tables
+    op.execute(
+        """
+        DELETE FROM sync_changes s
+        USING sync_changes later
+        WHERE later.table_name = s.table_name
+            AND later.row_id = s.row_id
+            AND (later.changed_at, later.seq) > (s.changed_at, s.seq);
+        """
+    )
+    op.execute(
+        """
+        ALTER TABLE sync_changes
+        ADD CONSTRAINT sync_changes_table_row_key UNIQUE (table_name, row_id);
+        """
+    )
+
+    op.execute(
+        """
+        CREATE OR REPLACE FUNCTION record_sync_changes() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            INSERT INTO sync_changes (table_name, row_id, changed_at)
+            SELECT
+                TG_TABLE_NAME,
+                n.id,
+                GREATEST(now(), n.server_created_at, n.last_modified, n.deleted_at)
+            FROM changed_rows n
+            ON CONFLICT (table_name, row_id)
+            DO UPDATE SET changed_at = GREATEST(
+                sync_changes.changed_at, EXCLUDED.changed_at
+            );
+
+            -- triggers of the versioned tables are given 'versioned'
+            IF FOUND AND TG_NARGS > 0 AND TG_ARGV[0] = 'versioned' THEN
+                INSERT INTO sync_versions (table_name, version)
+                VALUES (TG_TABLE_NAME, 1)
+                ON CONFLICT (table_name)
+                DO UPDATE SET version = sync_versions.version + 1;
+            END IF;
+
+            RETURN NULL;
+        END;
+        $$;
+        """
+    )
+
+    # rows deleted from the synced tables are no longer pulled
+    op.execute(
+        """
+        CREATE FUNCTION forget_sync_changes() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            DELETE FROM sync_changes s
+            USING deleted_rows o
+            WHERE s.table_name = TG_TABLE_NAME AND s.row_id = o.id;
+
+            RETURN NULL;
+        END;
+        $$;
+        """
+    )
+
+    for table in SYNCED_TABLES:
+        op.execute(
+            f"""
+            CREATE TRIGGER forget_sync_changes_on_delete
+            AFTER DELETE ON {table}
+            REFERENCING OLD TABLE AS deleted_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION forget_sync_changes();
+            """
+        )
+
+
+def downgrade():
+    for table in SYNCED_TABLES:
+        op.execute(f'DROP TRIGGER forget_sync_changes_on_delete ON {table};')
+
+    op.execute('DROP FUNCTION forget_sync_changes();')
+
+    op.execute(
+        """
+        CREATE OR REPLACE FUNCTION record_sync_changes() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            INSERT INTO sync_changes (table_name, row_id, changed_at)
+            SELECT
+                TG_TABLE_NAME,
+                n.id,
+                GREATEST(now(), n.server_created_at, n.last_modified, n.deleted_at)
+            FROM changed_rows n;
+
+            -- triggers of the versioned tables are given 'versioned'
+            IF FOUND AND TG_NARGS > 0 AND TG_ARGV[0] = 'versioned' THEN
+                INSERT INTO sync_versions (table_name, version)
+                VALUES (TG_TABLE_NAME, 1)
+                ON CONFLICT (table_name)
+                DO UPDATE SET version = sync_versions.version + 1;
+            END IF;
+
+            RETURN NULL;
+        END;
+        $$;
+        """
+    )
+
+    op.execute('ALTER TABLE sync_changes DROP CONSTRAINT sync_changes_table_row_key;')
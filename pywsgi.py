@@ -4,7 +4,11 @@ monkey.patch_all()
 
 import os
 from gevent.pywsgi import WSGIServer
-from hikmahealth.server import server, config
+from hikmahealth.server import server, config, routes_mobile
+
+if config.SYNC_PUSH_ASYNC:
+	# also applies the pushes left queued by a previous run
+	routes_mobile.push_worker.start(server.app)
 
 print('running as', config.APP_ENV)
 print('on port', config.PG_PORT)
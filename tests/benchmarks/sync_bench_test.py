@@ -0,0 +1,45 @@
+"""Testing suite keeping the sync benchmarks runnable, on a tiny dataset"""
+
+import os
+
+import pytest
+
+from benchmarks import compare, datasets
+from benchmarks.sync import run_benchmarks
+
+
+# the benchmarks write to the synced tables, which bumps the sync versions of
+# the reference tables, so they only run against a database set aside for them
+@pytest.mark.skipif(
+    os.environ.get('RUN_BENCHMARKS') != '1',
+    reason='set RUN_BENCHMARKS=1 to run the benchmarks on a throwaway database',
+)
+def test_benchmarks_run_and_clean_up(app, db):
+    report = run_benchmarks(app, db, patients=20, repeat=1, touched=0.5)
+
+    assert report['rows']['patients'] == 20
+    assert report['rows']['events'] == (
+        20 * datasets.VISITS_PER_PATIENT * datasets.EVENTS_PER_VISIT
+    )
+    for name in ('initial_pull', 'incremental_pull', 'bulk_push'):
+        result = report['results'][name]
+        assert result['rows'] > 0, name
+        assert result['peak_memory_bytes'] > 0, name
+
+    with db.cursor() as cur:
+        cur.execute(
+            'SELECT count(*) FROM users WHERE email LIKE %s',
+            ['%@' + datasets.BENCHMARK_EMAIL_DOMAIN],
+        )
+        assert cur.fetchone() == (0,)
+    db.commit()
+
+
+def test_compare_flags_regressions():
+    base = dict(results=dict(pull=dict(seconds=1.0), push=dict(seconds=1.0)))
+    new = dict(results=dict(pull=dict(seconds=1.05), push=dict(seconds=1.5)))
+
+    changes, regressed = compare.compare(base, new, threshold=0.1)
+
+    assert regressed
+    assert {c['name']: c['regressed'] for c in changes} == dict(pull=False, push=True)
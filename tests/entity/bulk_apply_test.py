@@ -0,0 +1,228 @@
+"""Testing suite for applying the pushed changes in bulk"""
+
+import datetime
+import uuid
+
+import pytest
+from psycopg import Connection, Cursor
+from psycopg.rows import dict_row
+
+from hikmahealth.entity import hh
+from hikmahealth.entity.sync import SyncContext
+from hikmahealth.sync.data import DeltaData
+
+
+PATIENT_COLUMNS = (
+    'given_name',
+    'surname',
+    'date_of_birth',
+    'sex',
+    'camp',
+    'additional_data',
+    'government_id',
+    'is_deleted',
+)
+
+
+@pytest.fixture()
+def last_pushed_at():
+    return datetime.datetime.now(tz=datetime.UTC)
+
+
+@pytest.fixture()
+def patient_ids(db: Connection):
+    """Two sets of ids, for the same changes applied by row and in bulk"""
+    ids = dict(by_row=[str(uuid.uuid1()) for _ in range(3)])
+    ids['bulk'] = [str(uuid.uuid1()) for _ in range(3)]
+    yield ids
+
+    with db.cursor() as cur:
+        cur.execute(
+            'DELETE FROM patients WHERE id = ANY(%s)',
+            [ids['by_row'] + ids['bulk']],
+        )
+    db.commit()
+
+
+def _patient_changes(ids: list[str]):
+    """Creates 3 patients, updates the first one in the same push and
+    deletes the last one"""
+    now = int(datetime.datetime.now(tz=datetime.UTC).timestamp() * 1000)
+    created = [
+        dict(
+            id=id,
+            given_name=f'Bulk {n}',
+            surname='Apply',
+            date_of_birth='1990-01-01',
+            sex='female',
+            camp=None,
+            citizenship=None,
+            hometown=None,
+            phone=None,
+            government_id=None,
+            external_patient_id=None,
+            additional_data=dict(n=n),
+            created_at=now,
+            updated_at=now,
+        )
+        for n, id in enumerate(ids)
+    ]
+    updated = [created[0] | dict(given_name='Bulk updated', camp='camp')]
+
+    return DeltaData(created=created, updated=updated, deleted=[ids[-1]])
+
+
+def _get_patients(db: Connection, ids: list[str]):
+    with db.cursor(row_factory=dict_row) as cur:
+        rows = cur.execute(
+            'SELECT * FROM patients WHERE id = ANY(%s)', [ids]
+        ).fetchall()
+
+    rows = {str(r['id']): r for r in rows}
+    return [{c: rows[id][c] for c in PATIENT_COLUMNS} for id in ids]
+
+
+def test_bulk_apply_matches_apply_by_row(db, patient_ids, last_pushed_at):
+    hh.Patient.apply_delta_changes(
+        _patient_changes(patient_ids['by_row']), last_pushed_at, db, bulk=False
+    )
+    hh.Patient.apply_delta_changes(
+        _patient_changes(patient_ids['bulk']), last_pushed_at, db, bulk=True
+    )
+
+    by_row = _get_patients(db, patient_ids['by_row'])
+    bulk = _get_patients(db, patient_ids['bulk'])
+
+    assert bulk == by_row
+    assert bulk[0]['given_name'] == 'Bulk updated'
+    assert bulk[-1]['is_deleted']
+
+
+def test_bulk_apply_checks_event_references(db, last_pushed_at):
+    event = dict(
+        id=str(uuid.uuid1()),
+        patient_id=str(uuid.uuid1()),
+        visit_id=str(uuid.uuid1()),
+        form_id=str(uuid.uuid1()),
+        created_at=datetime.datetime.now(tz=datetime.UTC).isoformat(),
+        updated_at=datetime.datetime.now(tz=datetime.UTC).isoformat(),
+    )
+
+    hh.Event.apply_delta_changes(
+        DeltaData(created=[event]), last_pushed_at, db, bulk=True
+    )
+
+    with db.cursor(row_factory=dict_row) as cur:
+        row = cur.execute(
+            'SELECT * FROM events WHERE id = %s', [event['id']]
+        ).fetchone()
+        placeholder = cur.execute(
+            'SELECT is_deleted FROM patients WHERE id = %s', [event['patient_id']]
+        ).fetchone()
+
+        cur.execute('DELETE FROM events WHERE id = %s', [event['id']])
+        cur.execute('DELETE FROM patients WHERE id = %s', [event['patient_id']])
+    db.commit()
+
+    assert row is not None
+    assert row['visit_id'] is None
+    assert row['form_id'] is None
+    assert placeholder is not None and placeholder['is_deleted']
+
+
+class CountingCursor(Cursor):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.queries = []
+
+    def execute(self, query, *args, **kwargs):
+        self.queries.append(query)
+        return super().execute(query, *args, **kwargs)
+
+
+def test_event_references_are_checked_at_once(db, visit_data, last_pushed_at):
+    ctx = SyncContext(last_pushed_at, conn=db)
+    missing_patient = str(uuid.uuid1())
+    events = [
+        dict(
+            id=str(uuid.uuid1()),
+            patient_id=missing_patient if n % 2 else visit_data['patient_id'],
+            visit_id=visit_data['id'] if n % 3 else str(uuid.uuid1()),
+            form_id=None,
+        )
+        for n in range(30)
+    ]
+
+    with CountingCursor(db) as cur:
+        rows = hh.Event.prepare_rows(ctx, cur, [dict(e) for e in events])
+        queries = list(cur.queries)
+
+        cur.execute('DELETE FROM patients WHERE id = %s', [missing_patient])
+    db.commit()
+
+    assert len(queries) == 2, 'expected one placeholder insert and one visit lookup'
+    for n, row in enumerate(rows):
+        assert row['visit_id'] == (visit_data['id'] if n % 3 else None)
+
+
+def test_failed_event_push_keeps_no_placeholder(db, last_pushed_at, monkeypatch):
+    event = dict(
+        id=str(uuid.uuid1()),
+        patient_id=str(uuid.uuid1()),
+        created_at=datetime.datetime.now(tz=datetime.UTC).isoformat(),
+        updated_at=datetime.datetime.now(tz=datetime.UTC).isoformat(),
+    )
+
+    def failing_upsert(cur, rows):
+        raise ValueError('failed push')
+
+    monkeypatch.setattr(hh.Event, '_bulk_upsert', failing_upsert)
+
+    with pytest.raises(Exception):
+        hh.Event.apply_delta_changes(
+            DeltaData(created=[event]), last_pushed_at, db, bulk=True
+        )
+
+    with db.cursor() as cur:
+        placeholder = cur.execute(
+            'SELECT 1 FROM patients WHERE id = %s', [event['patient_id']]
+        ).fetchone()
+
+    assert placeholder is None
+
+
+def test_patient_deletes_cascade_in_one_batch(db, patient_ids, last_pushed_at):
+    ids = patient_ids['bulk']
+    hh.Patient.apply_delta_changes(_patient_changes(ids), last_pushed_at, db)
+
+    events = [
+        dict(
+            id=str(uuid.uuid1()),
+            patient_id=id,
+            created_at=datetime.datetime.now(tz=datetime.UTC).isoformat(),
+            updated_at=datetime.datetime.now(tz=datetime.UTC).isoformat(),
+        )
+        for id in ids
+    ]
+    hh.Event.apply_delta_changes(DeltaData(created=events), last_pushed_at, db)
+
+    ctx = SyncContext(last_pushed_at, conn=db)
+    with CountingCursor(db) as cur:
+        hh.Patient.delete_many_from_delta(ctx, cur, ids)
+        queries = list(cur.queries)
+
+        deleted = cur.execute(
+            'SELECT is_deleted, deleted_at FROM events WHERE id = ANY(%s)',
+            [[e['id'] for e in events]],
+        ).fetchall()
+
+        cur.execute(
+            'DELETE FROM events WHERE id = ANY(%s)', [[e['id'] for e in events]]
+        )
+    db.commit()
+
+    # the patients, then their attributes, visits, events and appointments
+    assert len(queries) == 5
+    assert len(deleted) == len(ids)
+    assert all(is_deleted for is_deleted, _ in deleted)
+    assert len({deleted_at for _, deleted_at in deleted}) == 1
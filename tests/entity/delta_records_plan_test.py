@@ -0,0 +1,94 @@
+"""Testing suite for the query plans of the delta records pulled by the client.
+
+Fails when the sync queries fall back to reading the whole table, which is
+what happens when the indices of the sync predicates are missing or no longer
+match the queries."""
+
+import datetime
+import uuid
+
+import pytest
+from psycopg import Connection
+
+from hikmahealth.entity import hh
+from hikmahealth.server.routes_mobile import ENTITIES_TO_PUSH_TO_MOBILE
+from hikmahealth.utils.datetime import utc
+
+
+_INDEX_SCANS = ('Index Scan', 'Index Only Scan', 'Bitmap Index Scan')
+
+
+def _full_scans(plan: dict, indices: bool = True) -> list[str]:
+    """Returns the tables read in full in the `plan` with a sequential scan.
+    With `indices`, also returns the indices read without any condition"""
+    scans = []
+    if plan['Node Type'] == 'Seq Scan':
+        scans.append(plan['Relation Name'])
+    elif indices and plan['Node Type'] in _INDEX_SCANS and 'Index Cond' not in plan:
+        scans.append(plan['Index Name'])
+
+    for subplan in plan.get('Plans', []):
+        scans.extend(_full_scans(subplan, indices))
+
+    return scans
+
+
+def _explain(conn: Connection, query: str, params: dict) -> dict:
+    with conn.cursor() as cur:
+        cur.execute('EXPLAIN (FORMAT JSON) ' + query, params)
+        return cur.fetchone()[0][0]['Plan']
+
+
+@pytest.fixture()
+def no_seqscan(db: Connection):
+    """Makes the planner avoid sequential scans whenever an index can be used
+    instead. Tables without a matching index are still scanned"""
+    with db.transaction(force_rollback=True):
+        db.execute('SET LOCAL enable_seqscan = off')
+        yield db
+
+
+@pytest.mark.parametrize('changekey', ENTITIES_TO_PUSH_TO_MOBILE.keys())
+def test_delta_records_are_read_from_indices(no_seqscan, changekey):
+    c = ENTITIES_TO_PUSH_TO_MOBILE[changekey]
+    last_sync_time = utc.now() - datetime.timedelta(days=1)
+
+    plan = _explain(no_seqscan, *c._delta_records_query(last_sync_time))
+
+    assert _full_scans(plan) == []
+
+
+@pytest.mark.parametrize('changekey', ['patients', 'visits', 'events'])
+def test_clinic_scoped_delta_records_are_read_from_indices(no_seqscan, changekey):
+    c = ENTITIES_TO_PUSH_TO_MOBILE[changekey]
+    last_sync_time = utc.now() - datetime.timedelta(days=1)
+
+    plan = _explain(
+        no_seqscan,
+        *c._delta_records_query(last_sync_time, clinic_ids=[str(uuid.uuid1())]),
+    )
+
+    # the records can be joined to the patients by walking their index in order
+    assert _full_scans(plan, indices=False) == []
+
+
+def test_seeded_delta_records_are_read_from_indices(db: Connection):
+    """With a table of patients mostly unchanged since the last sync, the
+    planner picks the indices by itself"""
+    last_sync_time = utc.now() - datetime.timedelta(days=1)
+
+    with db.transaction(force_rollback=True):
+        db.execute(
+            """
+            INSERT INTO patients
+            (id, given_name, is_deleted, created_at, updated_at, last_modified, server_created_at)
+            SELECT gen_random_uuid(), 'Seeded', false, t, t, t, t
+            FROM generate_series(1, 20000), (SELECT %s::timestamptz AS t) s
+            """,
+            [last_sync_time - datetime.timedelta(days=30)],
+        )
+        db.execute('ANALYZE patients')
+
+        plan = _explain(db, *hh.Patient._delta_records_query(last_sync_time))
+
+    assert _full_scans(plan) == []
@@ -0,0 +1,395 @@
+"""Testing suite for fetching the delta records pulled by the client"""
+
+import datetime
+import uuid
+
+import pytest
+from psycopg import Connection
+
+from hikmahealth.entity import hh
+from hikmahealth.entity.sync import (
+    get_delta_records_concurrently,
+    get_sync_versions,
+)
+from hikmahealth.server.client.db import get_connection
+from hikmahealth.server.routes_mobile import ENTITIES_TO_PUSH_TO_MOBILE
+from hikmahealth import sync
+from hikmahealth.sync import DeltaData
+from hikmahealth.utils.datetime import utc
+
+
+@pytest.fixture()
+def last_sync_time():
+    return utc.now() - datetime.timedelta(days=1)
+
+
+@pytest.fixture()
+def changed_patients(db: Connection, last_sync_time):
+    """Inserts patients that should be labelled as created, updated and deleted,
+    along with one that was not changed since the last sync"""
+    before = last_sync_time - datetime.timedelta(days=1)
+    after = last_sync_time + datetime.timedelta(hours=1)
+
+    patients = dict(
+        created=dict(server_created_at=after, last_modified=after, deleted_at=None),
+        updated=dict(server_created_at=before, last_modified=after, deleted_at=None),
+        deleted=dict(server_created_at=before, last_modified=after, deleted_at=after),
+        unchanged=dict(server_created_at=before, last_modified=before, deleted_at=None),
+    )
+
+    ids = {}
+    with db.cursor() as cur:
+        for label, p in patients.items():
+            ids[label] = str(uuid.uuid1())
+            cur.execute(
+                """
+                INSERT INTO patients
+                (id, given_name, is_deleted, deleted_at, created_at, updated_at, last_modified, server_created_at)
+                VALUES
+                (%(id)s, 'Delta', %(is_deleted)s, %(deleted_at)s, %(created_at)s, %(created_at)s, %(last_modified)s, %(server_created_at)s)
+                """,
+                p
+                | dict(
+                    id=ids[label],
+                    is_deleted=p['deleted_at'] is not None,
+                    created_at=before,
+                ),
+            )
+    db.commit()
+
+    yield ids
+
+    with db.cursor() as cur:
+        cur.execute('DELETE FROM patients WHERE id = ANY(%s)', [list(ids.values())])
+    db.commit()
+
+
+def _ids_from(deltadata, ids):
+    """Restricts the delta to the rows inserted by the test"""
+    known = set(ids.values())
+    return dict(
+        created={str(r['id']) for r in deltadata.created if str(r['id']) in known},
+        updated={str(r['id']) for r in deltadata.updated if str(r['id']) in known},
+        deleted={str(d) for d in deltadata.deleted if str(d) in known},
+    )
+
+
+def test_single_pass_labels_each_action(db, changed_patients, last_sync_time):
+    deltadata = hh.Patient.get_delta_records(last_sync_time, db, single_pass=True)
+
+    assert _ids_from(deltadata, changed_patients) == dict(
+        created={changed_patients['created']},
+        updated={changed_patients['updated']},
+        deleted={changed_patients['deleted']},
+    )
+
+    for row in deltadata.created + deltadata.updated:
+        assert '__delta_action' not in row, 'action label leaked into the record'
+
+
+def test_single_pass_matches_multi_pass(db, changed_patients, last_sync_time):
+    single = hh.Patient.get_delta_records(last_sync_time, db, single_pass=True)
+    multi = hh.Patient.get_delta_records(last_sync_time, db, single_pass=False)
+
+    assert _ids_from(single, changed_patients) == _ids_from(multi, changed_patients)
+
+
+def test_paginated_records_are_not_skipped_or_repeated(
+    db, changed_patients, last_sync_time
+):
+    high_watermark = utc.now()
+    expected = _ids_from(
+        hh.Patient.get_delta_records(last_sync_time, db), changed_patients
+    )
+
+    pages = []
+    position = None
+    while True:
+        deltadata, position = hh.Patient.get_delta_records_page(
+            last_sync_time, high_watermark, db, 1, after=position
+        )
+        pages.append(_ids_from(deltadata, changed_patients))
+
+        if position is None:
+            break
+
+    for action in ('created', 'updated', 'deleted'):
+        seen = [i for page in pages for i in page[action]]
+        assert len(seen) == len(set(seen)), f'repeated {action} records'
+        assert set(seen) == expected[action], f'skipped {action} records'
+
+
+def test_paginated_records_exclude_changes_after_watermark(
+    db, changed_patients, last_sync_time
+):
+    # the changes were made an hour after the last sync
+    high_watermark = last_sync_time + datetime.timedelta(minutes=30)
+
+    deltadata, position = hh.Patient.get_delta_records_page(
+        last_sync_time, high_watermark, db, 100
+    )
+
+    assert position is None
+    assert _ids_from(deltadata, changed_patients) == dict(
+        created=set(), updated=set(), deleted=set()
+    )
+
+
+def test_concurrent_records_match_sequential(db, changed_patients, last_sync_time):
+    entities = {
+        'patients': hh.Patient,
+        'visits': hh.Visit,
+        'string_content': hh.StringContent,
+    }
+
+    deltas = get_delta_records_concurrently(
+        entities, last_sync_time, get_connection, workers=2
+    )
+
+    assert list(deltas.keys()) == list(entities.keys())
+    assert _ids_from(deltas['patients'], changed_patients) == _ids_from(
+        hh.Patient.get_delta_records(last_sync_time, db), changed_patients
+    )
+    for changekey, c in entities.items():
+        assert deltas[changekey].size == c.get_delta_records(last_sync_time, db).size
+
+
+def test_log_records_match_table_scan(db, changed_patients, last_sync_time):
+    from_log = hh.Patient.get_delta_records(last_sync_time, db, from_log=True)
+    scanned = hh.Patient.get_delta_records(last_sync_time, db)
+
+    assert _ids_from(from_log, changed_patients) == _ids_from(scanned, changed_patients)
+    assert from_log.size == scanned.size
+
+
+def test_streamed_and_paginated_log_records_match_table_scan(
+    db, changed_patients, last_sync_time
+):
+    expected = _ids_from(
+        hh.Patient.get_delta_records(last_sync_time, db), changed_patients
+    )
+
+    streamed = {
+        sync.ACTION_CREATE: [],
+        sync.ACTION_UPDATE: [],
+        sync.ACTION_DELETE: [],
+    }
+    with db.transaction(force_rollback=True):
+        for action, record in hh.Patient.iter_delta_records(
+            last_sync_time, db, from_log=True
+        ):
+            streamed[action].append(record)
+    deltadata = DeltaData(
+        created=streamed[sync.ACTION_CREATE],
+        updated=streamed[sync.ACTION_UPDATE],
+        deleted=streamed[sync.ACTION_DELETE],
+    )
+    assert _ids_from(deltadata, changed_patients) == expected
+
+    deltadata, position = hh.Patient.get_delta_records_page(
+        last_sync_time, utc.now(), db, 1000, from_log=True
+    )
+    assert position is None
+    assert _ids_from(deltadata, changed_patients) == expected
+
+
+def test_log_keeps_the_last_change_of_each_row(db, changed_patients):
+    patient_id = changed_patients['unchanged']
+
+    def logged():
+        with db.cursor() as cur:
+            return cur.execute(
+                """
+                SELECT changed_at FROM sync_changes
+                WHERE table_name = 'patients' AND row_id = %s
+                """,
+                [patient_id],
+            ).fetchall()
+
+    with db.transaction(force_rollback=True):
+        [(first,)] = logged()
+        for _ in range(3):
+            db.execute(
+                "UPDATE patients SET given_name = 'Logged' WHERE id = %s",
+                [patient_id],
+            )
+        [(last,)] = logged()
+        assert last >= first
+
+        # rows deleted from the table are no longer kept
+        db.execute('DELETE FROM patients WHERE id = %s', [patient_id])
+        assert logged() == []
+
+
+def test_log_records_include_changes_from_clients_ahead(db, changed_patients):
+    # deleted with a timestamp from a client whose clock is ahead
+    ahead = utc.now() + datetime.timedelta(hours=1)
+    with db.cursor() as cur:
+        cur.execute(
+            'UPDATE patients SET is_deleted = true, deleted_at = %s WHERE id = %s',
+            [ahead, changed_patients['unchanged']],
+        )
+    db.commit()
+
+    last_sync_time = utc.now() + datetime.timedelta(minutes=30)
+    deltadata = hh.Patient.get_delta_records(last_sync_time, db, from_log=True)
+
+    assert str(changed_patients['unchanged']) in {str(i) for i in deltadata.deleted}
+
+
+@pytest.fixture()
+def clinic_patients(db: Connection, last_sync_time):
+    """Inserts two clinics, with a patient seen at each, and a patient seen at
+    the other clinic before the last sync and at the first one after it"""
+    before = last_sync_time - datetime.timedelta(days=1)
+    after = last_sync_time + datetime.timedelta(hours=1)
+
+    clinics = dict(here=str(uuid.uuid1()), elsewhere=str(uuid.uuid1()))
+    patients = dict(
+        here=str(uuid.uuid1()), elsewhere=str(uuid.uuid1()), moved=str(uuid.uuid1())
+    )
+    visits = [
+        (patients['here'], clinics['here'], before),
+        (patients['elsewhere'], clinics['elsewhere'], before),
+        (patients['moved'], clinics['elsewhere'], before),
+        (patients['moved'], clinics['here'], after),
+    ]
+
+    with db.cursor() as cur:
+        for clinic_id in clinics.values():
+            cur.execute(
+                "INSERT INTO clinics (id, name) VALUES (%s, 'Scoped')", [clinic_id]
+            )
+
+        for patient_id in patients.values():
+            cur.execute(
+                """
+                INSERT INTO patients
+                (id, given_name, is_deleted, created_at, updated_at, last_modified, server_created_at)
+                VALUES (%(id)s, 'Scoped', false, %(t)s, %(t)s, %(t)s, %(t)s)
+                """,
+                dict(id=patient_id, t=before),
+            )
+
+        for patient_id, clinic_id, t in visits:
+            cur.execute(
+                """
+                INSERT INTO visits
+                (id, patient_id, clinic_id, is_deleted, created_at, updated_at, last_modified, server_created_at)
+                VALUES (%(id)s, %(patient_id)s, %(clinic_id)s, false, %(t)s, %(t)s, %(t)s, %(t)s)
+                """,
+                dict(
+                    id=str(uuid.uuid1()),
+                    patient_id=patient_id,
+                    clinic_id=clinic_id,
+                    t=t,
+                ),
+            )
+    db.commit()
+
+    yield clinics, patients
+
+    with db.cursor() as cur:
+        cur.execute(
+            'DELETE FROM patients WHERE id = ANY(%s)', [list(patients.values())]
+        )
+        cur.execute('DELETE FROM clinics WHERE id = ANY(%s)', [list(clinics.values())])
+    db.commit()
+
+
+def _patient_ids_from(deltadata, patients, column='id'):
+    known = set(patients.values())
+    return {
+        str(r[column])
+        for r in deltadata.created + deltadata.updated
+        if str(r[column]) in known
+    }
+
+
+def test_clinic_scoped_records_only_include_clinic_patients(db, clinic_patients):
+    clinics, patients = clinic_patients
+    epoch = datetime.datetime.fromtimestamp(0, datetime.timezone.utc)
+
+    scoped = hh.Patient.get_delta_records(epoch, db, clinic_ids=[clinics['here']])
+    assert _patient_ids_from(scoped, patients) == {patients['here'], patients['moved']}
+
+    visits = hh.Visit.get_delta_records(epoch, db, clinic_ids=[clinics['here']])
+    assert _patient_ids_from(visits, patients, 'patient_id') == {
+        patients['here'],
+        patients['moved'],
+    }
+
+
+def test_clinic_scoped_records_include_history_of_new_patients(
+    db, clinic_patients, last_sync_time
+):
+    clinics, patients = clinic_patients
+
+    patients_delta = hh.Patient.get_delta_records(
+        last_sync_time, db, clinic_ids=[clinics['here']]
+    )
+    assert _patient_ids_from(patients_delta, patients) == {patients['moved']}
+
+    # the visit at the other clinic was never pulled by this client
+    visits = hh.Visit.get_delta_records(
+        last_sync_time, db, clinic_ids=[clinics['here']]
+    )
+    moved_visits = [
+        r
+        for r in visits.updated + visits.created
+        if str(r['patient_id']) == patients['moved']
+    ]
+    assert len(moved_visits) == 2
+
+
+def test_clinic_scope_leaves_reference_records_alone(db, clinic_patients):
+    clinics, _ = clinic_patients
+    epoch = datetime.datetime.fromtimestamp(0, datetime.timezone.utc)
+
+    scoped = hh.Clinic.get_delta_records(epoch, db, clinic_ids=[clinics['here']])
+    assert scoped.size == hh.Clinic.get_delta_records(epoch, db).size
+
+
+@pytest.mark.parametrize(
+    'changekey',
+    [k for k, c in ENTITIES_TO_PUSH_TO_MOBILE.items() if c.SYNC_VERSIONED],
+)
+def test_versioned_tables_triggers_bump_version(db: Connection, changekey):
+    """The version of a `SYNC_VERSIONED` table is only bumped when its triggers
+    are given 'versioned'"""
+    table_name = ENTITIES_TO_PUSH_TO_MOBILE[changekey].TABLE_NAME
+
+    with db.cursor() as cur:
+        cur.execute(
+            """
+            SELECT tgname FROM pg_trigger
+            WHERE tgrelid = %s::regclass
+                AND tgnargs = 1
+                AND encode(tgargs, 'escape') = 'versioned\\000'
+            """,
+            [table_name],
+        )
+        triggers = {name for (name,) in cur.fetchall()}
+    db.commit()
+
+    assert triggers == {
+        'record_sync_changes_on_insert',
+        'record_sync_changes_on_update',
+    }
+
+
+def test_version_is_bumped_by_changes(db: Connection):
+    clinics = dict(clinics=hh.Clinic)
+
+    with db.transaction(force_rollback=True):
+        version = get_sync_versions(clinics, db)['clinics']
+
+        # a statement changing no rows leaves it as is
+        db.execute("UPDATE clinics SET name = name WHERE name = 'no such clinic'")
+        assert get_sync_versions(clinics, db)['clinics'] == version
+
+        db.execute(
+            "INSERT INTO clinics (id, name) VALUES (%s, 'Versioned')",
+            [str(uuid.uuid1())],
+        )
+        assert get_sync_versions(clinics, db)['clinics'] != version
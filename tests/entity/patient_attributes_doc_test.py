@@ -0,0 +1,121 @@
+"""Testing suite for the `attributes_doc` of the patients, kept up to date with
+their attributes by triggers"""
+
+import datetime
+import uuid
+
+import pytest
+from psycopg import Connection
+
+from hikmahealth.entity import hh
+from hikmahealth.utils.datetime import utc
+
+
+def _insert_patient(db: Connection, patient_id: str):
+    db.execute(
+        "INSERT INTO patients (id, given_name, is_deleted) VALUES (%s, 'Doc', false)",
+        [patient_id],
+    )
+
+
+def _insert_attribute(db: Connection, patient_id: str, attribute_id: str, value: str):
+    db.execute(
+        """
+        INSERT INTO patient_additional_attributes
+        (id, patient_id, attribute_id, attribute, string_value, is_deleted, created_at, updated_at, last_modified, server_created_at)
+        VALUES (%s, %s, %s, 'Attribute', %s, false, now(), now(), now(), now())
+        """,
+        [str(uuid.uuid1()), patient_id, attribute_id, value],
+    )
+
+
+def _get_doc(db: Connection, patient_id: str) -> dict:
+    return db.execute(
+        'SELECT attributes_doc FROM patients WHERE id = %s', [patient_id]
+    ).fetchone()[0]
+
+
+@pytest.fixture()
+def patient_id(db: Connection):
+    patient_id = str(uuid.uuid1())
+    yield patient_id
+
+    db.rollback()
+    db.execute(
+        'DELETE FROM patient_additional_attributes WHERE patient_id = %s',
+        [patient_id],
+    )
+    db.execute('DELETE FROM patients WHERE id = %s', [patient_id])
+    db.commit()
+
+
+def test_doc_follows_attribute_changes(db, patient_id):
+    _insert_patient(db, patient_id)
+    assert _get_doc(db, patient_id) == {}
+
+    _insert_attribute(db, patient_id, 'a', 'first')
+    _insert_attribute(db, patient_id, 'b', 'second')
+    assert _get_doc(db, patient_id) == {
+        'a': dict(
+            attribute='Attribute',
+            number_value=None,
+            string_value='first',
+            date_value=None,
+            boolean_value=None,
+        ),
+        'b': dict(
+            attribute='Attribute',
+            number_value=None,
+            string_value='second',
+            date_value=None,
+            boolean_value=None,
+        ),
+    }
+
+    db.execute(
+        """
+        UPDATE patient_additional_attributes SET string_value = 'changed'
+        WHERE patient_id = %s AND attribute_id = 'a'
+        """,
+        [patient_id],
+    )
+    assert _get_doc(db, patient_id)['a']['string_value'] == 'changed'
+
+    # soft deleted attributes are left out
+    db.execute(
+        """
+        UPDATE patient_additional_attributes SET is_deleted = true, deleted_at = now()
+        WHERE patient_id = %s AND attribute_id = 'a'
+        """,
+        [patient_id],
+    )
+    assert set(_get_doc(db, patient_id).keys()) == {'b'}
+
+    db.execute(
+        'DELETE FROM patient_additional_attributes WHERE patient_id = %s',
+        [patient_id],
+    )
+    assert _get_doc(db, patient_id) == {}
+
+
+def test_doc_includes_attributes_written_before_patient(db, patient_id):
+    _insert_attribute(db, patient_id, 'a', 'early')
+    _insert_patient(db, patient_id)
+
+    assert _get_doc(db, patient_id)['a']['string_value'] == 'early'
+
+
+def test_doc_is_not_pulled(db, patient_id):
+    last_sync_time = utc.now() - datetime.timedelta(minutes=1)
+    _insert_patient(db, patient_id)
+    _insert_attribute(db, patient_id, 'a', 'value')
+    db.commit()
+
+    deltadata = hh.Patient.get_delta_records(last_sync_time, db)
+    pulled = [r for r in deltadata.created if str(r['id']) == patient_id]
+
+    assert len(pulled) == 1
+    assert 'attributes_doc' not in pulled[0]
+
+    rows = list(hh.Patient.iter_delta_records(last_sync_time, db))
+    assert all('attributes_doc' not in r for _, r in rows if isinstance(r, dict))
@@ -0,0 +1,161 @@
+"""Testing suite for the caches of verified credentials and session tokens"""
+
+import uuid
+
+import pytest
+
+from hikmahealth.server.api import auth
+from hikmahealth.server.client import db
+from hikmahealth.utils.errors import WebError
+from tests.conftest import test_email, test_password
+
+
+@pytest.fixture()
+def checkpw_calls(app, monkeypatch):
+    """Counts the password checks done while verifying credentials"""
+    calls = []
+    checkpw = auth.bcrypt.checkpw
+
+    def counted_checkpw(*args):
+        calls.append(args)
+        return checkpw(*args)
+
+    monkeypatch.setattr(auth.bcrypt, 'checkpw', counted_checkpw)
+    auth._credentials_cache.clear()
+    yield calls
+
+    auth._credentials_cache.clear()
+
+
+def test_verified_credentials_are_cached(checkpw_calls):
+    u = auth.get_user_from_credentials(test_email, test_password)
+    for _ in range(3):
+        assert auth.get_user_from_credentials(test_email, test_password) == u
+
+    assert len(checkpw_calls) == 1
+
+
+def test_wrong_password_is_not_cached(checkpw_calls):
+    auth.get_user_from_credentials(test_email, test_password)
+
+    for _ in range(2):
+        with pytest.raises(WebError):
+            auth.get_user_from_credentials(test_email, test_password + 'x')
+
+    assert len(checkpw_calls) == 3
+
+
+def test_plaintext_password_is_not_cached(checkpw_calls):
+    auth.get_user_from_credentials(test_email, test_password)
+
+    for key in auth._credentials_cache.keys():
+        assert test_password.encode() not in key
+
+
+def test_invalidated_credentials_are_checked_again(checkpw_calls):
+    u = auth.get_user_from_credentials(test_email, test_password)
+
+    auth.invalidate_cached_credentials(user_id=u.id)
+    auth.get_user_from_credentials(test_email, test_password)
+
+    auth.invalidate_cached_credentials(email=test_email.upper())
+    auth.get_user_from_credentials(test_email, test_password)
+
+    assert len(checkpw_calls) == 3
+
+
+@pytest.fixture()
+def session_token(app):
+    u = auth.get_user_from_email(test_email, test_password)
+    auth._token_cache.clear()
+    yield u, auth.create_session_token(u)
+
+    auth.invalidate_tokens(u)
+    auth._token_cache.clear()
+
+
+@pytest.fixture()
+def connections(monkeypatch):
+    """Counts the connections opened to resolve tokens"""
+    opened = []
+    get_connection = db.get_connection
+
+    def counted_get_connection():
+        opened.append(None)
+        return get_connection()
+
+    monkeypatch.setattr(db, 'get_connection', counted_get_connection)
+    return opened
+
+
+def test_resolved_tokens_are_cached(session_token, connections):
+    u, token = session_token
+
+    for _ in range(3):
+        assert str(auth.get_user_from_token(token).id) == str(u.id)
+
+    assert len(connections) == 1
+
+
+def test_invalidated_tokens_are_rejected(session_token):
+    u, token = session_token
+    auth.get_user_from_token(token)
+
+    auth.invalidate_tokens(u)
+
+    with pytest.raises(WebError):
+        auth.get_user_from_token(token)
+
+
+def test_expired_cached_tokens_are_rejected(session_token):
+    u, token = session_token
+    auth.get_user_from_token(token)
+
+    with db.get_connection() as conn:
+        conn.execute(
+            "UPDATE tokens SET expiry = now() - INTERVAL '1 minute' WHERE token = %s",
+            [token],
+        )
+
+    # the cache still holds the expiry it read first
+    cached_user, _ = auth._token_cache[token]
+    auth._token_cache[token] = (cached_user, auth.utc.now())
+
+    with pytest.raises(WebError):
+        auth.get_user_from_token(token)
+
+
+def test_deleted_user_tokens_are_rejected(client, session_token):
+    _, admin_token = session_token
+
+    u = auth.User(
+        id=str(uuid.uuid4()),
+        name='Deleted',
+        role='admin',
+        email=f'deleted-{uuid.uuid4()}@example.com',
+        clinic_id=None,
+    )
+    with db.get_connection() as conn:
+        conn.execute(
+            """
+            INSERT INTO users (id, name, role, email, hashed_password)
+            VALUES (%s, %s, %s, %s, '')
+            """,
+            [u.id, u.name, u.role, u.email],
+        )
+    token = auth.create_session_token(u)
+
+    headers = dict(Authorization=token)
+    assert client.get('/admin_api/is_authenticated', headers=headers).status_code == (
+        200
+    )
+
+    response = client.delete(
+        f'/v1/admin/users/{u.id}', headers=dict(Authorization=admin_token)
+    )
+    assert response.status_code == 200
+
+    # rejected right away, not once the cached token expires
+    assert client.get('/admin_api/is_authenticated', headers=headers).status_code == (
+        401
+    )
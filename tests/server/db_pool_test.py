@@ -0,0 +1,97 @@
+"""Testing suite for the pooled connections handed out by `db.get_connection`"""
+
+import psycopg
+import pytest
+
+from hikmahealth.entity import hh
+from hikmahealth.entity.sync import get_delta_records_concurrently
+from hikmahealth.server import config
+from hikmahealth.server.client import db
+from hikmahealth.utils.datetime import utc
+
+
+@pytest.fixture()
+def pooled(app, test_db, monkeypatch):
+    monkeypatch.setattr(config, 'DB_POOL_ENABLED', True)
+    monkeypatch.setattr(config, 'DB_POOL_MIN_SIZE', 1)
+    monkeypatch.setattr(config, 'DB_POOL_MAX_SIZE', 2)
+    monkeypatch.setattr(config, 'DB_POOL_TIMEOUT', 5)
+
+    # starts from a new pool, with the sizes above
+    db.close_connection_pool()
+    yield app
+
+    db.close_connection_pool()
+
+
+def test_connection_is_returned_to_pool(pooled):
+    with pooled.app_context():
+        with db.get_connection() as conn:
+            assert isinstance(conn, db.PooledConnection)
+            conn.execute('SELECT 1')
+
+        assert conn.closed, 'connection should be handed back after `with`'
+
+        with pytest.raises(psycopg.OperationalError):
+            conn.execute('SELECT 1')
+
+        # the pool only has 2 connections. this would time out if they
+        # were not returned
+        for _ in range(5):
+            with db.get_connection() as conn:
+                conn.execute('SELECT 1')
+
+    stats = db.get_pool_stats()
+    assert stats['requests_num'] == 6
+    assert stats['pool_max'] == 2
+
+
+def test_unclosed_connections_are_returned_on_teardown(pooled):
+    for _ in range(5):
+        with pooled.app_context():
+            # call sites that never close their connection
+            with db.get_connection().cursor() as cur:
+                cur.execute('SELECT 1')
+
+    assert db.get_pool_stats()['requests_num'] == 5
+
+
+def test_session_settings_are_reset(pooled):
+    with pooled.app_context():
+        with db.get_connection() as conn:
+            conn.read_only = True
+            conn.execute('SELECT 1')
+
+        with db.get_connection() as conn:
+            assert not conn.read_only
+
+
+def test_connections_outside_requests_are_not_pooled(pooled):
+    with db.get_connection() as conn:
+        assert isinstance(conn, psycopg.Connection)
+
+
+def test_worker_connections_are_pooled(pooled):
+    # no app context, as in the workers of a pull
+    with db.get_worker_connection() as conn:
+        assert isinstance(conn, db.PooledConnection)
+        conn.execute('SELECT 1')
+
+    assert conn.closed
+    assert db.get_pool_stats()['requests_num'] == 1
+
+
+def test_concurrent_pull_is_bounded_by_pool(pooled):
+    deltas = get_delta_records_concurrently(
+        dict(patients=hh.Patient, visits=hh.Visit, events=hh.Event),
+        utc.now(),
+        db.get_worker_connection,
+        workers=3,
+    )
+
+    assert set(deltas) == {'patients', 'visits', 'events'}
+    stats = db.get_pool_stats()
+    # the snapshot connection and the 3 workers were all taken from the pool of
+    # 2, the workers waiting for the connections in use to be returned
+    assert stats['requests_num'] == 4
+    assert stats['connections_num'] <= 2
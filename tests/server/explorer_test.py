@@ -0,0 +1,220 @@
+"""Testing suite for the data explorer, and the compiler of its filters"""
+
+import uuid
+
+import pytest
+from psycopg import Connection
+from psycopg.types.json import Jsonb
+
+from hikmahealth.server.api import explorer
+from hikmahealth.utils.errors import WebError
+from tests.conftest import test_email, test_password
+
+
+@pytest.fixture()
+def admin_headers(client):
+    response = client.post(
+        '/v1/admin/auth/login', json=dict(email=test_email, password=test_password)
+    )
+    assert response.status_code == 200
+    return {'Authorization': response.get_json()['token']}
+
+
+@pytest.fixture()
+def explored(db: Connection):
+    """Inserts a form and three patients: `heavy` with an event of weight 70
+    and a `village` attribute, `light` with an event of weight 50 and no
+    attribute, and `absent` with an attribute and no event"""
+    form_id = str(uuid.uuid1())
+    ids = {name: str(uuid.uuid1()) for name in ('heavy', 'light', 'absent')}
+
+    with db.cursor() as cur:
+        cur.execute(
+            "INSERT INTO event_forms (id, name) VALUES (%s, 'Explored')", [form_id]
+        )
+        for patient_id in ids.values():
+            cur.execute(
+                """
+                INSERT INTO patients (id, given_name, is_deleted)
+                VALUES (%s, 'Explored', false)
+                """,
+                [patient_id],
+            )
+        for name, weight in (('heavy', '70'), ('light', '50')):
+            cur.execute(
+                """
+                INSERT INTO events (id, patient_id, form_id, form_data, is_deleted)
+                VALUES (%s, %s, %s, %s, false)
+                """,
+                [
+                    str(uuid.uuid1()),
+                    ids[name],
+                    form_id,
+                    Jsonb([dict(fieldId='weight', value=weight)]),
+                ],
+            )
+        for name, village in (('heavy', 'north'), ('absent', 'south')):
+            cur.execute(
+                """
+                INSERT INTO patient_additional_attributes
+                (id, patient_id, attribute_id, attribute, string_value, is_deleted, created_at, updated_at, last_modified, server_created_at)
+                VALUES (%s, %s, 'village', 'Village', %s, false, now(), now(), now(), now())
+                """,
+                [str(uuid.uuid1()), ids[name], village],
+            )
+    db.commit()
+
+    yield dict(ids, form_id=form_id)
+
+    with db.cursor() as cur:
+        cur.execute(
+            'DELETE FROM patient_additional_attributes WHERE patient_id = ANY(%s)',
+            [list(ids.values())],
+        )
+        cur.execute('DELETE FROM patients WHERE id = ANY(%s)', [list(ids.values())])
+        cur.execute('DELETE FROM event_forms WHERE id = %s', [form_id])
+    db.commit()
+
+
+_EXPLORED = dict(
+    baseFields=[dict(id='1', field='given_name', operator='=', value='Explored')]
+)
+
+
+def _filters(explored, patient=_EXPLORED, event=(), **kwargs):
+    return dict(
+        patient=patient,
+        event=[
+            dict(fieldId=f'{explored["form_id"]};weight', dataType='number', **rule)
+            for rule in event
+        ],
+        appointment=None,
+        prescription=None,
+        **kwargs,
+    )
+
+
+def _explore(client, headers, filters) -> dict:
+    response = client.post('/v1/admin/data-explorer', headers=headers, json=filters)
+    assert response.status_code == 200, response.get_json()
+    return response.get_json()['data']
+
+
+def _patient_ids(data: dict) -> set[str]:
+    return {p['id'] for p in data['patients']}
+
+
+def test_events_and_patients_are_matched(client, admin_headers, explored):
+    data = _explore(
+        client,
+        admin_headers,
+        _filters(explored, event=[dict(operator='>', value=60)]),
+    )
+
+    assert [e['patient_id'] for e in data['events']] == [explored['heavy']]
+    assert _patient_ids(data) == {explored['heavy']}
+    attributes = data['patients'][0]['additional_attributes']
+    assert attributes['village']['string_value'] == 'north'
+
+
+def test_dates_are_written_by_postgres(client, admin_headers, db, explored):
+    # events and patients are encoded to JSON by Postgres, which writes dates in
+    # ISO 8601, without trailing zeros in the fractions of seconds
+    with db.cursor() as cur:
+        cur.execute(
+            """
+            UPDATE events SET created_at = '2024-05-01 10:30:15.12+00'
+            WHERE patient_id = %s
+            """,
+            [explored['heavy']],
+        )
+        cur.execute(
+            """
+            UPDATE patients
+            SET created_at = '2024-05-01 10:30:15+00', date_of_birth = '1990-01-02'
+            WHERE id = %s
+            """,
+            [explored['heavy']],
+        )
+    db.commit()
+
+    data = _explore(
+        client,
+        admin_headers,
+        _filters(explored, event=[dict(operator='>', value=60)]),
+    )
+
+    assert data['events'][0]['created_at'] == '2024-05-01T10:30:15.12+00:00'
+    assert data['patients'][0]['created_at'] == '2024-05-01T10:30:15+00:00'
+    assert data['patients'][0]['date_of_birth'] == '1990-01-02'
+
+
+def test_only_patients_are_returned_without_events(client, admin_headers, explored):
+    filters = _filters(
+        explored,
+        patient=None,
+        event=[dict(operator='<=', value=70)],
+        returnEvents=False,
+    )
+    data = _explore(client, admin_headers, filters)
+
+    assert 'events' not in data
+    assert _patient_ids(data) == {explored['heavy'], explored['light']}
+
+
+@pytest.mark.parametrize(
+    'operator, value, expected',
+    [
+        ('contains', 'NOR', {'heavy'}),
+        ('does not contain', 'nor', {'absent'}),
+        ('is empty', None, {'light'}),
+        ('is not empty', None, {'heavy', 'absent'}),
+    ],
+)
+def test_attribute_rules_are_matched(
+    client, admin_headers, explored, operator, value, expected
+):
+    patient = dict(
+        _EXPLORED,
+        attributeFields=[
+            dict(id='2', fieldId='village', operator=operator, value=value)
+        ],
+    )
+    data = _explore(client, admin_headers, _filters(explored, patient=patient))
+
+    assert _patient_ids(data) == {explored[name] for name in expected}
+
+
+def test_empty_filters_return_nothing(client, admin_headers, explored):
+    assert _explore(client, admin_headers, _filters(explored, patient=None)) == {}
+
+
+def test_unknown_patient_field_is_rejected(client, admin_headers, explored):
+    patient = dict(
+        baseFields=[
+            dict(id='1', field='id; DROP TABLE patients', operator='=', value=1)
+        ]
+    )
+    response = client.post(
+        '/v1/admin/data-explorer',
+        headers=admin_headers,
+        json=_filters(explored, patient=patient),
+    )
+    assert response.status_code == 400
+
+    with pytest.raises(WebError):
+        explorer.compile_filters(
+            dict(patient={}, event=[{}], appointment=None, prescription=None)
+        )
+
+
+def test_filters_are_compiled_to_a_single_statement(db, explored):
+    query, params = explorer.compile_filters(
+        _filters(explored, event=[dict(operator='>', value=60)])
+    )
+
+    # values are passed as parameters, never written in the statement
+    assert 'Explored' in params.values()
+    assert 'Explored' not in query.as_string(db)
+    with db.cursor() as cur:
+        assert len(cur.execute(query, params).fetchall()) == 1
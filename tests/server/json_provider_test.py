@@ -0,0 +1,165 @@
+"""Testing suite for the JSON providers of the app"""
+
+import dataclasses
+import datetime
+from decimal import Decimal
+import json
+import re
+import uuid
+
+import msgpack
+import pytest
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+from werkzeug import http
+
+from hikmahealth.server import config
+from hikmahealth.server.helpers import json_provider
+
+
+@dataclasses.dataclass
+class Point:
+    x: int
+    y: int
+
+
+VALUE = {
+    'at': datetime.datetime(2024, 5, 1, 10, 30, 15, 120, tzinfo=datetime.timezone.utc),
+    'naive': datetime.datetime(2024, 5, 1, 10, 30),
+    'local': datetime.datetime(
+        2024, 1, 1, 1, 5, tzinfo=datetime.timezone(datetime.timedelta(hours=3))
+    ),
+    'day': datetime.date(2024, 5, 1),
+    'id': uuid.UUID('6f1c2f0e-8e3a-11ee-b9d1-0242ac120002'),
+    'amount': Decimal('10.50'),
+    'point': Point(1, 2),
+    'nested': [{'none': None, 'flag': True, 'number': 1.5}],
+}
+
+EXPECTED = {
+    'at': '2024-05-01T10:30:15.000120+00:00',
+    'naive': '2024-05-01T10:30:00',
+    'local': '2024-01-01T01:05:00+03:00',
+    'day': '2024-05-01',
+    'id': '6f1c2f0e-8e3a-11ee-b9d1-0242ac120002',
+    'amount': '10.50',
+    'point': {'x': 1, 'y': 2},
+    'nested': [{'none': None, 'flag': True, 'number': 1.5}],
+}
+
+EXPECTED_SYNC = EXPECTED | {
+    'at': 'Wed, 01 May 2024 10:30:15 GMT',
+    'naive': 'Wed, 01 May 2024 10:30:00 GMT',
+    'local': 'Sun, 31 Dec 2023 22:05:00 GMT',
+    'day': 'Wed, 01 May 2024 00:00:00 GMT',
+}
+
+HTTP_DATE = re.compile(r'^\w{3}, \d{2} \w{3} \d{4} \d{2}:\d{2}:\d{2} GMT$')
+
+
+def _providers():
+    """Pairs of the providers of the app, with the expected values"""
+    providers = [
+        (json_provider.IsoJSONProvider, EXPECTED),
+        (DefaultJSONProvider, EXPECTED_SYNC),
+    ]
+    if json_provider.orjson is not None:
+        providers += [
+            (json_provider.OrjsonProvider, EXPECTED),
+            (json_provider.HttpDateOrjsonProvider, EXPECTED_SYNC),
+        ]
+    return providers
+
+
+@pytest.mark.parametrize('provider, expected', _providers())
+def test_values_are_written(provider, expected):
+    app = Flask(__name__)
+    app.json = provider(app)
+
+    assert json.loads(app.json.dumps(VALUE)) == expected
+
+    with app.app_context():
+        response = app.json.response(VALUE)
+
+    assert response.mimetype == 'application/json'
+    assert json.loads(response.get_data()) == expected
+    assert app.json.loads(response.get_data()) == expected
+
+
+def test_orjson_matches_standard_library():
+    if json_provider.orjson is None:
+        pytest.skip('orjson is not installed')
+
+    app = Flask(__name__)
+    for fast, standard in (
+        (json_provider.OrjsonProvider, json_provider.IsoJSONProvider),
+        (json_provider.HttpDateOrjsonProvider, DefaultJSONProvider),
+    ):
+        # including the order of the keys
+        assert fast(app).dumps(VALUE) == json.dumps(
+            json.loads(standard(app).dumps(VALUE)), separators=(',', ':')
+        )
+
+
+def test_http_date_matches_werkzeug():
+    start = datetime.datetime(1999, 12, 25, 23, 59, 59)
+    for days in range(0, 10000, 97):
+        at = start + datetime.timedelta(days=days, minutes=days)
+        for value in (at, at.date(), at.replace(tzinfo=datetime.timezone.utc)):
+            assert json_provider.http_date(value) == http.http_date(value)
+
+
+def test_sync_default_converts_msgpack_values(app):
+    packed = msgpack.packb(VALUE, default=json_provider.sync_json(app).default)
+    assert msgpack.unpackb(packed) == EXPECTED_SYNC
+
+
+def test_app_uses_orjson_when_installed(app):
+    enabled = config.JSON_ORJSON and json_provider.orjson is not None
+
+    assert isinstance(app.json, json_provider.IsoJSONProvider)
+    assert isinstance(app.json, json_provider.OrjsonProvider) == enabled
+    assert (
+        isinstance(json_provider.sync_json(app), json_provider.HttpDateOrjsonProvider)
+        == enabled
+    )
+
+
+def test_flask_provider_writes_pulls_when_disabled(monkeypatch):
+    monkeypatch.setattr(config, 'JSON_ORJSON', False)
+
+    app = Flask(__name__)
+    json_provider.register_json_provider(app)
+
+    assert type(app.json) is json_provider.IsoJSONProvider
+    assert type(json_provider.sync_json(app)) is DefaultJSONProvider
+
+
+@pytest.mark.parametrize(
+    'pull_format, streaming',
+    [('rows', False), ('rows', True), ('columnar', False), ('msgpack', False)],
+)
+def test_pulled_dates_are_written_as_http_dates(
+    client, auth_headers, monkeypatch, pull_format, streaming
+):
+    monkeypatch.setattr(config, 'SYNC_PULL_STREAMING', streaming)
+
+    response = client.get(
+        '/api/v2/sync',
+        headers=auth_headers,
+        query_string=dict(last_pulled_at=0, format=pull_format),
+    )
+    assert response.status_code == 200
+
+    if pull_format == 'msgpack':
+        body = msgpack.unpackb(response.get_data())
+    else:
+        body = json.loads(response.get_data())
+
+    rows = body['changes']['patients']['created']
+    if pull_format != 'rows':
+        rows = [dict(zip(rows['columns'], values)) for values in rows['rows']]
+
+    assert len(rows) > 0
+    for row in rows:
+        assert HTTP_DATE.match(row['server_created_at']), row['server_created_at']
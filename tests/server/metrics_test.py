@@ -0,0 +1,122 @@
+"""Testing suite for the metrics exported on `/metrics`"""
+
+import time
+
+import pytest
+from flask import Flask
+from prometheus_client import generate_latest
+
+from hikmahealth.server import config
+from hikmahealth.server.helpers import metrics
+from hikmahealth.utils.errors import WebError
+
+
+@pytest.fixture()
+def registry(app):
+    metrics.clear()
+    yield metrics.registry
+
+    metrics.clear()
+
+
+@pytest.fixture()
+def metrics_client(monkeypatch):
+    """Client of an app exporting the metrics, scraped with the `secret` token"""
+    monkeypatch.setattr(config, 'METRICS_ENABLED', True)
+    monkeypatch.setattr(config, 'METRICS_TOKEN', 'secret')
+
+    app = Flask(__name__)
+    app.register_error_handler(WebError, lambda e: (e.to_dict(), e.status_code))
+    metrics.register_metrics(app)
+    return app.test_client()
+
+
+def _count(registry, name: str, **labels) -> float:
+    return registry.get_sample_value(f'{name}_count', labels) or 0
+
+
+def test_metrics_are_not_exported_by_default(client):
+    assert client.get('/metrics').status_code == 404
+
+
+def test_metrics_are_not_exported_without_token(monkeypatch):
+    monkeypatch.setattr(config, 'METRICS_ENABLED', True)
+    monkeypatch.setattr(config, 'METRICS_TOKEN', None)
+
+    with pytest.raises(Exception, match='METRICS_TOKEN'):
+        metrics.register_metrics(Flask(__name__))
+
+
+def test_pull_is_observed_per_entity(client, auth_headers, registry):
+    response = client.get(
+        '/v1/api/sync', headers=auth_headers, query_string=dict(last_pulled_at=0)
+    )
+    assert response.status_code == 200
+
+    for changekey in response.get_json()['changes']:
+        assert (
+            _count(
+                registry,
+                'hikma_sync_pull_entity_duration_seconds',
+                entity=changekey,
+            )
+            == 1
+        )
+
+    body = generate_latest(registry).decode()
+    assert 'hikma_sync_request_duration_seconds_count{clinic=' in body
+    assert 'hikma_sync_pull_entity_duration_seconds_count{entity="patients"} 1' in (
+        body
+    )
+    assert 'hikma_sync_response_size_bytes_count{operation="pull"} 1' in body
+
+
+def test_streamed_pull_is_observed_once_written(
+    client, auth_headers, registry, monkeypatch
+):
+    monkeypatch.setattr(config, 'SYNC_PULL_STREAMING', True)
+
+    response = client.get(
+        '/v1/api/sync', headers=auth_headers, query_string=dict(last_pulled_at=0)
+    )
+    size = len(response.get_data())
+
+    assert _count(registry, 'hikma_sync_response_size_bytes', operation='pull') == 1
+    assert (
+        registry.get_sample_value(
+            'hikma_sync_response_size_bytes_sum', dict(operation='pull')
+        )
+        == size
+    )
+
+
+def test_entity_reads_exclude_time_spent_by_the_consumer(registry):
+    for _ in metrics.observe_sync_entity_reads(metrics.PULL, 'tested', range(3)):
+        time.sleep(0.05)
+
+    assert (
+        _count(registry, 'hikma_sync_pull_entity_duration_seconds', entity='tested')
+        == 1
+    )
+    assert (
+        registry.get_sample_value(
+            'hikma_sync_pull_entity_duration_seconds_sum', dict(entity='tested')
+        )
+        < 0.05
+    )
+
+
+def test_metrics_token_is_checked(metrics_client, registry):
+    assert metrics_client.get('/metrics').status_code == 401
+    assert (
+        metrics_client.get(
+            '/metrics', headers=dict(Authorization='Bearer wrong')
+        ).status_code
+        == 401
+    )
+
+    response = metrics_client.get(
+        '/metrics', headers=dict(Authorization='Bearer secret')
+    )
+    assert response.status_code == 200
+    assert 'hikma_sync_request_duration_seconds' in response.get_data(as_text=True)
@@ -0,0 +1,258 @@
+"""Testing suite for the routes of the admin app"""
+
+import datetime
+import uuid
+
+import pytest
+from psycopg import Connection
+
+from hikmahealth.entity import hh
+from hikmahealth.server import config
+from hikmahealth.utils.datetime import utc
+from tests.conftest import test_email, test_password
+
+
+@pytest.fixture()
+def admin_headers(client):
+    response = client.post(
+        '/v1/admin/auth/login', json=dict(email=test_email, password=test_password)
+    )
+    assert response.status_code == 200
+    return {'Authorization': response.get_json()['token']}
+
+
+@pytest.fixture()
+def listed_patients(db: Connection):
+    """Inserts patients sharing the same `updated_at`, along with one without
+    an `updated_at` and one that is deleted"""
+    updated_at = utc.now() - datetime.timedelta(days=1)
+    ids = dict(
+        same=[str(uuid.uuid1()) for _ in range(5)],
+        missing=str(uuid.uuid1()),
+        deleted=str(uuid.uuid1()),
+    )
+
+    rows = [(i, updated_at, False) for i in ids['same']]
+    rows += [(ids['missing'], None, False), (ids['deleted'], updated_at, True)]
+
+    with db.cursor() as cur:
+        for patient_id, t, is_deleted in rows:
+            cur.execute(
+                """
+                INSERT INTO patients (id, given_name, is_deleted, updated_at)
+                VALUES (%s, 'Listed', %s, %s)
+                """,
+                [patient_id, is_deleted, t],
+            )
+        cur.execute(
+            """
+            INSERT INTO patient_additional_attributes
+            (id, patient_id, attribute_id, attribute, string_value, is_deleted, created_at, updated_at, last_modified, server_created_at)
+            VALUES (%s, %s, 'attr', 'Attribute', 'value', false, now(), now(), now(), now())
+            """,
+            [str(uuid.uuid1()), ids['same'][0]],
+        )
+    db.commit()
+
+    yield ids
+
+    with db.cursor() as cur:
+        cur.execute(
+            'DELETE FROM patient_additional_attributes WHERE patient_id = %s',
+            [ids['same'][0]],
+        )
+        cur.execute(
+            'DELETE FROM patients WHERE id = ANY(%s)',
+            [ids['same'] + [ids['missing'], ids['deleted']]],
+        )
+    db.commit()
+
+
+def _get_all_patient_pages(client, headers, **query):
+    pages = []
+    page_token = None
+    while True:
+        params = dict(query)
+        if page_token is not None:
+            params.update(page_token=page_token)
+
+        response = client.get(
+            '/v1/admin/patients', headers=headers, query_string=params
+        )
+        assert response.status_code == 200
+
+        body = response.get_json()
+        pages.append(body['patients'])
+        page_token = body['next_page_token']
+        if page_token is None:
+            return pages
+
+
+def test_patient_pages_are_not_skipped_or_repeated(
+    client, admin_headers, listed_patients
+):
+    pages = _get_all_patient_pages(client, admin_headers, page_size=3)
+    ids = [p['id'] for page in pages for p in page]
+
+    assert all(len(page) <= 3 for page in pages)
+    assert len(ids) == len(set(ids)), 'repeated patients'
+    assert set(listed_patients['same']) | {listed_patients['missing']} <= set(ids)
+    assert listed_patients['deleted'] not in ids
+
+    # most recently updated first, without an update time last
+    updated = [p['updated_at'] for page in pages for p in page]
+    known = [utc.from_iso8601(t) for t in updated if t is not None]
+    assert known == sorted(known, reverse=True)
+    assert updated[len(known) :] == [None] * (len(updated) - len(known))
+
+
+def test_patient_pages_hold_attributes(client, admin_headers, listed_patients):
+    pages = _get_all_patient_pages(client, admin_headers, page_size=50)
+    patients = {p['id']: p for page in pages for p in page}
+
+    attributes = patients[listed_patients['same'][0]]['additional_attributes']
+    assert attributes['attr']['string_value'] == 'value'
+    assert patients[listed_patients['same'][1]]['additional_attributes'] == {}
+
+
+def test_patient_responses_leave_out_attributes_doc(
+    client, admin_headers, listed_patients
+):
+    patient_id = listed_patients['same'][0]
+
+    pages = _get_all_patient_pages(client, admin_headers, page_size=50)
+    assert all('attributes_doc' not in p for page in pages for p in page)
+
+    response = client.get(f'/v1/admin/patients/{patient_id}', headers=admin_headers)
+    assert response.status_code == 200
+    assert 'attributes_doc' not in response.get_json()['patient']
+
+    response = client.get('/v1/admin/database/export', headers=admin_headers)
+    assert response.status_code == 200
+    exported = response.get_json()['data']['patients']
+    assert patient_id in {p['id'] for p in exported}
+    assert all('attributes_doc' not in p for p in exported)
+
+
+def test_patient_page_size_is_capped(
+    client, admin_headers, listed_patients, monkeypatch
+):
+    monkeypatch.setattr(config, 'ADMIN_PATIENTS_MAX_PAGE_SIZE', 2)
+
+    response = client.get(
+        '/v1/admin/patients',
+        headers=admin_headers,
+        query_string=dict(page_size=100, total='estimate'),
+    )
+    body = response.get_json()
+
+    assert len(body['patients']) == 2
+    assert body['next_page_token'] is not None
+    assert isinstance(body['total_estimate'], int)
+
+
+@pytest.mark.parametrize(
+    'query', [dict(page_size='0'), dict(page_size='a'), dict(page_token='bad')]
+)
+def test_invalid_patient_page_is_rejected(client, admin_headers, query):
+    response = client.get(
+        '/v1/admin/patients', headers=admin_headers, query_string=query
+    )
+    assert response.status_code == 400
+
+
+@pytest.fixture()
+def searched_patients(db: Connection):
+    """Inserts patients matched by their names or by their identifiers"""
+    suffix = uuid.uuid4().hex[:8]
+    patients = dict(
+        name=dict(given_name=f'Amira{suffix}', surname='Haddad'),
+        surname=dict(given_name='Omar', surname=f'Amira{suffix}'),
+        government_id=dict(given_name='Lina', government_id=f'GOV-amira{suffix}'),
+        other=dict(given_name='Other', surname=f'Unmatched{suffix}'),
+    )
+    ids = {label: str(uuid.uuid1()) for label in patients}
+
+    with db.cursor() as cur:
+        for label, p in patients.items():
+            cur.execute(
+                """
+                INSERT INTO patients
+                (id, given_name, surname, government_id, is_deleted, updated_at)
+                VALUES (%s, %s, %s, %s, false, now())
+                """,
+                [
+                    ids[label],
+                    p['given_name'],
+                    p.get('surname'),
+                    p.get('government_id'),
+                ],
+            )
+    db.commit()
+
+    yield f'amira{suffix}', ids
+
+    with db.cursor() as cur:
+        cur.execute('DELETE FROM patients WHERE id = ANY(%s)', [list(ids.values())])
+    db.commit()
+
+
+def _search_patients(client, headers, **query):
+    response = client.get(
+        '/v1/admin/search/patients', headers=headers, query_string=query
+    )
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def test_search_matches_names_and_identifiers(client, admin_headers, searched_patients):
+    query, ids = searched_patients
+    body = _search_patients(client, admin_headers, query=query.upper())
+
+    assert {p['id'] for p in body['patients']} == {
+        ids['name'],
+        ids['surname'],
+        ids['government_id'],
+    }
+    assert body['next_page_token'] is None
+
+
+def test_search_pages_are_not_skipped_or_repeated(
+    client, admin_headers, searched_patients
+):
+    query, ids = searched_patients
+
+    found = []
+    page_token = None
+    while True:
+        params = dict(query=query, page_size=1)
+        if page_token is not None:
+            params.update(page_token=page_token)
+
+        body = _search_patients(client, admin_headers, **params)
+        assert len(body['patients']) <= 1
+        found += [p['id'] for p in body['patients']]
+
+        page_token = body['next_page_token']
+        if page_token is None:
+            break
+
+    assert len(found) == len(set(found)) == 3
+
+
+def test_search_wildcards_are_matched_as_is(client, admin_headers, searched_patients):
+    body = _search_patients(client, admin_headers, query='%')
+    assert body['patients'] == []
+
+
+def test_trigram_search_ranks_closest_first(
+    db, client, admin_headers, searched_patients
+):
+    if not hh.has_trigram_search(db):
+        pytest.skip('pg_trgm is not installed')
+
+    query, ids = searched_patients
+    # misspelled
+    body = _search_patients(client, admin_headers, query=query[:-1] + 'x')
+
+    assert body['patients'][0]['id'] in {ids['name'], ids['surname']}
@@ -34,3 +34,16 @@ def test_deltadata_is_empty():
 
     assert dataloader.size == 0, 'size == 0'
     assert dataloader.is_empty, 'this is empty'
+
+
+def test_deltadata_to_columnar_dict():
+    dataloader = DeltaData(
+        created=[dict(id=1, name='a'), dict(id=2, name='b', age=3)],
+        deleted=[9],
+    )
+
+    assert dataloader.to_columnar_dict() == dict(
+        created=dict(columns=['id', 'name', 'age'], rows=[[1, 'a', None], [2, 'b', 3]]),
+        updated=dict(columns=[], rows=[]),
+        deleted=[9],
+    )